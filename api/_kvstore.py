@@ -0,0 +1,394 @@
+"""
+KV 存储的键布局、读写操作和进程内替身
+
+api/todos_kv.py 和 backend 的 KVTodoRepository 都通过这个模块读写 KV，
+两者指向同一个 Redis 时读写的是同一份数据。文件名以下划线开头，
+Vercel 不会把它当作单独的 API 函数部署。
+
+键布局:
+    todos_next_id          INCR 原子分配的自增ID
+    todo:{id}              单个任务的 JSON
+    todos:index:all        有序集合，成员为ID，分数也是ID (ID 按创建顺序分配，分数不会重复)
+    todos:index:active     未完成任务的有序集合
+    todos:index:completed  已完成任务的有序集合
+    todos:version          同步版本号：每写入或删除一个任务加一，用于增量同步和生成 ETag
+    todos:changes          有序集合，成员为现存任务的ID，分数是该任务最后一次写入时的同步版本号
+    todos:tombstones       有序集合，成员为已删除任务的ID，分数是删除时的同步版本号
+    todos:epoch            随机值，KV 被清空后重新生成，避免版本号从 0 重新计数时 ETag 碰撞
+    todos:health           就绪检查的写探测键，值为最近一次探测的时间戳
+
+每个写操作是一个事务 (MULTI/EXEC)，任务键、状态索引和版本号要么全部写入，要么都不写。
+写操作先 WATCH 版本号 (更新和删除还有涉及的任务键)，读出当前版本号后在事务中分配新的版本号；
+读取之后这些键被并发修改时事务不执行，重新读取后再试。因此版本号按提交顺序递增，
+客户端同步到某个版本号之后，不会再出现更小的版本号。
+"""
+import bisect
+import json
+import os
+import threading
+
+try:
+    import redis
+    from redis.exceptions import WatchError
+except ImportError:  # 未安装时只能使用进程内替身
+    redis = None
+    
+    class WatchError(Exception):
+        """WATCH 的键在 EXEC 之前被修改，事务没有执行"""
+
+NEXT_ID_KEY = "todos_next_id"
+VERSION_KEY = "todos:version"
+CHANGES_KEY = "todos:changes"
+TOMBSTONES_KEY = "todos:tombstones"
+EPOCH_KEY = "todos:epoch"
+HEALTH_KEY = "todos:health"
+TODO_KEY_PREFIX = "todo:"
+INDEX_KEYS = {
+    'all': "todos:index:all",
+    'active': "todos:index:active",
+    'completed': "todos:index:completed",
+}
+
+# 读-改-写事务因 WATCH 的键被并发修改而失败时的最多尝试次数
+WATCH_RETRIES = 10
+
+class InMemoryKV:
+    """
+    进程内的 KV 替身，实现本模块用到的 Redis 命令子集
+    (与 redis-py 在 decode_responses=True 时的接口一致)，用于本地运行和测试
+    """
+    
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.data = {}
+        # 有序集合: 键 -> (成员 -> 分数, 按 (分数, 成员) 升序的列表)
+        self.zsets = {}
+        # 键 -> 修改次数，流水线据此实现 WATCH
+        self.versions = {}
+    
+    def touch(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+    
+    def get(self, key):
+        with self.lock:
+            return self.data.get(key)
+    
+    def set(self, key, value, nx=False):
+        with self.lock:
+            if nx and key in self.data:
+                return None
+            self.data[key] = str(value)
+            self.touch(key)
+            return True
+    
+    def mget(self, keys):
+        with self.lock:
+            return [self.data.get(key) for key in keys]
+    
+    def delete(self, *keys):
+        with self.lock:
+            count = 0
+            for key in keys:
+                if self.data.pop(key, None) is not None or self.zsets.pop(key, None) is not None:
+                    self.touch(key)
+                    count += 1
+            return count
+    
+    def incr(self, key, amount=1):
+        with self.lock:
+            value = int(self.data.get(key, 0)) + amount
+            self.data[key] = str(value)
+            self.touch(key)
+            return value
+    
+    def zadd(self, key, mapping):
+        with self.lock:
+            members, ordered = self.zsets.setdefault(key, ({}, []))
+            added = 0
+            for member, score in mapping.items():
+                member = str(member)
+                if member in members:
+                    del ordered[bisect.bisect_left(ordered, (members[member], member))]
+                else:
+                    added += 1
+                members[member] = float(score)
+                bisect.insort(ordered, (float(score), member))
+            self.touch(key)
+            return added
+    
+    def zrem(self, key, *values):
+        with self.lock:
+            members, ordered = self.zsets.get(key, ({}, []))
+            removed = 0
+            for member in values:
+                member = str(member)
+                if member in members:
+                    del ordered[bisect.bisect_left(ordered, (members.pop(member), member))]
+                    removed += 1
+            if removed:
+                self.touch(key)
+            return removed
+    
+    def zcard(self, key):
+        with self.lock:
+            return len(self.zsets.get(key, ({}, []))[0])
+    
+    def zrangebyscore(self, key, min, max, start=None, num=None, withscores=False):
+        return self._range(key, min, max, start, num, withscores, reverse=False)
+    
+    def zrevrangebyscore(self, key, max, min, start=None, num=None, withscores=False):
+        return self._range(key, min, max, start, num, withscores, reverse=True)
+    
+    def _range(self, key, lower, upper, start, num, withscores, reverse):
+        def bound(value):
+            value = str(value)
+            if value.startswith('('):
+                return float(value[1:]), True
+            return float(value), False
+        
+        low, low_open = bound(lower)
+        high, high_open = bound(upper)
+        with self.lock:
+            ordered = self.zsets.get(key, ({}, []))[1]
+            first = (bisect.bisect_right(ordered, (low, '\U0010ffff')) if low_open
+                     else bisect.bisect_left(ordered, (low,)))
+            end = (bisect.bisect_left(ordered, (high,)) if high_open
+                   else bisect.bisect_right(ordered, (high, '\U0010ffff')))
+            # 只复制需要的一段：先跳过 start 条，再取 num 条
+            skip = start or 0
+            take = end - first - skip if num is None or num < 0 else min(num, end - first - skip)
+            if take <= 0:
+                matched = []
+            elif reverse:
+                matched = ordered[end - skip - take:end - skip][::-1]
+            else:
+                matched = ordered[first + skip:first + skip + take]
+        return [(member, score) for score, member in matched] if withscores else [member for _, member in matched]
+    
+    def pipeline(self, transaction=True):
+        return InMemoryPipeline(self)
+
+class InMemoryPipeline:
+    """
+    InMemoryKV 的流水线，命令先排队，execute 时在同一把锁内依次执行
+    
+    与 redis-py 一样支持 WATCH：watch() 之后、multi() 之前的命令立即执行，
+    execute 时若 WATCH 的键已被修改则不执行任何命令并抛出 WatchError。
+    """
+    
+    def __init__(self, kv):
+        self.kv = kv
+        self.commands = []
+        self.watching = None
+        self.explicit_multi = False
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.reset()
+    
+    def __getattr__(self, name):
+        command = getattr(self.kv, name)
+        if self.watching is not None and not self.explicit_multi:
+            return command
+        
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+    
+    def watch(self, *keys):
+        with self.kv.lock:
+            self.watching = {key: self.kv.versions.get(key, 0) for key in keys}
+        return True
+    
+    def multi(self):
+        self.explicit_multi = True
+    
+    def reset(self):
+        self.commands = []
+        self.watching = None
+        self.explicit_multi = False
+    
+    def execute(self):
+        with self.kv.lock:
+            watching = self.watching or {}
+            if any(self.kv.versions.get(key, 0) != version for key, version in watching.items()):
+                self.reset()
+                raise WatchError("Watched variable changed.")
+            results = [getattr(self.kv, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+        self.reset()
+        return results
+
+def create_kv_client():
+    """连接 Vercel KV (Redis)，未配置 KV_URL 时使用进程内替身"""
+    url = os.environ.get('KV_URL') or os.environ.get('REDIS_URL')
+    if url and redis is not None:
+        return redis.from_url(url, decode_responses=True)
+    print("KV_URL not set, using in-process KV stand-in")
+    return InMemoryKV()
+
+def todo_key(todo_id):
+    """单个任务的键名"""
+    return f"{TODO_KEY_PREFIX}{todo_id}"
+
+def state_index(completed):
+    """任务状态对应的索引键"""
+    return INDEX_KEYS['completed' if completed else 'active']
+
+def load_todos(client, ids):
+    """用一次 MGET 批量取回任务，已不存在的任务被跳过"""
+    if not ids:
+        return []
+    values = client.mget([todo_key(todo_id) for todo_id in ids])
+    return [json.loads(value) for value in values if value is not None]
+
+def get_todo(client, todo_id):
+    """按ID获取任务"""
+    value = client.get(todo_key(todo_id))
+    return json.loads(value) if value is not None else None
+
+def list_ids(client, status=None, limit=None, before=None):
+    """
+    按ID倒序 (即创建顺序倒序) 返回索引中的任务ID
+    
+    status 为 active/completed 时只取对应状态，before 是上一页最后一个任务的ID。
+    """
+    index = INDEX_KEYS.get(status, INDEX_KEYS['all'])
+    high = '+inf' if before is None else f"({int(before)}"
+    if limit is None:
+        return client.zrevrangebyscore(index, high, '-inf')
+    return client.zrevrangebyscore(index, high, '-inf', start=0, num=limit)
+
+def list_todos(client, status=None, limit=None, before=None):
+    """先在索引上取一页ID，再用一次 MGET 取回任务"""
+    return load_todos(client, list_ids(client, status, limit, before))
+
+def write_transaction(client, keys, func):
+    """
+    WATCH 版本号和 keys 后调用 func(pipe, version)，返回 func 的结果
+    
+    func 先在 pipe 上读取 (立即执行)，需要写入时调用 pipe.multi() 再排队写入命令，
+    返回 (结果, 是否写入)。WATCH 的键在 EXEC 之前被修改时重新执行 func。
+    """
+    with client.pipeline(transaction=True) as pipe:
+        for _ in range(WATCH_RETRIES):
+            try:
+                pipe.watch(VERSION_KEY, *keys)
+                result, write = func(pipe, int(pipe.get(VERSION_KEY) or 0))
+                if write:
+                    pipe.execute()
+                return result
+            except WatchError:
+                continue
+    raise WatchError(f"keys kept changing during the transaction, gave up after {WATCH_RETRIES} attempts")
+
+def create_todos(client, todos, now):
+    """
+    批量创建任务，todos 为 [(title, completed)]，now 是写入 created_at/updated_at 的时间
+    
+    INCR 一次分配一段连续的ID，任务、索引和版本号在一个事务中写入。
+    """
+    if not todos:
+        return []
+    first_id = client.incr(NEXT_ID_KEY, len(todos)) - len(todos) + 1
+    created = [
+        {"id": first_id + offset, "title": title, "completed": bool(completed),
+         "created_at": now, "updated_at": now}
+        for offset, (title, completed) in enumerate(todos)
+    ]
+    
+    def write(pipe, version):
+        pipe.multi()
+        for todo in created:
+            pipe.set(todo_key(todo['id']), json.dumps(todo, ensure_ascii=False))
+        pipe.zadd(INDEX_KEYS['all'], {todo['id']: todo['id'] for todo in created})
+        for completed in (False, True):
+            members = {todo['id']: todo['id'] for todo in created if todo['completed'] == completed}
+            if members:
+                pipe.zadd(state_index(completed), members)
+        pipe.zadd(CHANGES_KEY, {todo['id']: version + offset + 1 for offset, todo in enumerate(created)})
+        pipe.set(VERSION_KEY, version + len(created))
+        return created, True
+    
+    return write_transaction(client, [], write)
+
+def update_todos(client, changes, now):
+    """
+    批量更新任务，changes 为 [(id, title, completed)]，None 表示不修改该字段
+    
+    返回 (更新后的任务, 不存在的ID)；有任务不存在时不做任何修改。
+    先 WATCH 任务键再读取，状态变化的任务在状态索引间移动，所有写入在一个事务中完成；
+    读取之后任务被并发更新或删除时事务不执行，重新读取后再试，
+    因此不会覆盖别人的修改，也不会把刚删除的任务写回来。
+    """
+    ids = [change[0] for change in changes]
+    unique_ids = list(dict.fromkeys(ids))
+    
+    def write(pipe, version):
+        todos = {todo['id']: todo for todo in load_todos(pipe, unique_ids)}
+        missing = [todo_id for todo_id in ids if todo_id not in todos]
+        if missing:
+            return ([], missing), False
+        
+        pipe.multi()
+        for todo_id, title, completed in changes:
+            todo = todos[todo_id]
+            if title is not None:
+                todo['title'] = title
+            if completed is not None and bool(completed) != bool(todo['completed']):
+                pipe.zrem(state_index(todo['completed']), todo_id)
+                pipe.zadd(state_index(completed), {todo_id: todo_id})
+            if completed is not None:
+                todo['completed'] = bool(completed)
+            todo['updated_at'] = now
+        for todo in todos.values():
+            pipe.set(todo_key(todo['id']), json.dumps(todo, ensure_ascii=False))
+        pipe.zadd(CHANGES_KEY, {todo_id: version + offset + 1 for offset, todo_id in enumerate(unique_ids)})
+        pipe.set(VERSION_KEY, version + len(unique_ids))
+        return ([dict(todos[todo_id]) for todo_id in ids], []), True
+    
+    return write_transaction(client, [todo_key(todo_id) for todo_id in unique_ids], write)
+
+def delete_todos(client, ids):
+    """删除一组任务及其索引项，留下墓碑，返回实际删除的ID (不存在的任务不包含在内，也不增加版本号)"""
+    ids = list(dict.fromkeys(int(todo_id) for todo_id in ids))
+    if not ids:
+        return []
+    keys = [todo_key(todo_id) for todo_id in ids]
+    
+    def write(pipe, version):
+        existing = [todo_id for todo_id, value in zip(ids, pipe.mget(keys)) if value is not None]
+        if not existing:
+            return [], False
+        
+        pipe.multi()
+        pipe.delete(*[todo_key(todo_id) for todo_id in existing])
+        for index in (*INDEX_KEYS.values(), CHANGES_KEY):
+            pipe.zrem(index, *existing)
+        pipe.zadd(TOMBSTONES_KEY, {todo_id: version + offset + 1 for offset, todo_id in enumerate(existing)})
+        pipe.set(VERSION_KEY, version + len(existing))
+        return existing, True
+    
+    return write_transaction(client, keys, write)
+
+def list_changes(client, since, limit=None):
+    """
+    返回 (当前同步版本号, [(版本号, 任务)], [(版本号, 已删除的ID)])，只含版本号大于 since 的记录
+    
+    两类记录各按版本号升序最多取 limit 条。版本号和两个有序集合在一个 MULTI 中读取，
+    彼此一致；任务内容随后用 MGET 取回，期间被删除的任务跳过 (它的墓碑版本号更大，下次同步会拿到)。
+    """
+    pipe = client.pipeline(transaction=True)
+    pipe.get(VERSION_KEY)
+    for key in (CHANGES_KEY, TOMBSTONES_KEY):
+        if limit is None:
+            pipe.zrangebyscore(key, f"({int(since)}", '+inf', withscores=True)
+        else:
+            pipe.zrangebyscore(key, f"({int(since)}", '+inf', start=0, num=limit, withscores=True)
+    version, changed, deleted = pipe.execute()
+    
+    values = client.mget([todo_key(todo_id) for todo_id, _ in changed]) if changed else []
+    upserts = [(int(score), json.loads(value)) for (_, score), value in zip(changed, values) if value is not None]
+    return int(version or 0), upserts, [(int(score), int(todo_id)) for todo_id, score in deleted]
@@ -1,14 +1,189 @@
 """
 测试版本的 API - 使用内存数据库
 """
+import bisect
 import json
+import os
+import threading
+import time
 from http.server import BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 from datetime import datetime
 
+class TodoStore:
+    """
+    带索引的内存存储
+    
+    任务按 ID 存在字典中，get/update/delete 按 ID 直接定位；
+    全部/未完成/已完成三个视图各维护一个按 (created_at, id) 升序的键列表，
+    插入和删除用二分查找定位，列表查询直接倒序读取，不需要过滤或重新排序。
+    
+    version 在每次写操作后加一，用于生成列表的 ETag；数据只存在当前进程中，
+    所以 ETag 里还要带上进程启动时随机生成的 epoch。
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.todos = {}
+        self.views = {'all': [], 'active': [], 'completed': []}
+        self.next_id = 1
+        self.version = 0
+        self.epoch = os.urandom(4).hex()
+    
+    @staticmethod
+    def state_view(completed):
+        return 'completed' if completed else 'active'
+    
+    @staticmethod
+    def remove_key(keys, key):
+        index = bisect.bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            del keys[index]
+    
+    def list(self, status='all'):
+        """按创建时间倒序返回 (任务列表, 列表的 ETag)"""
+        view = status if status in ('active', 'completed') else 'all'
+        with self.lock:
+            return [self.todos[todo_id] for _, todo_id in reversed(self.views[view])], self.etag(view)
+    
+    def etag(self, status='all'):
+        """当前版本下列表的强 ETag"""
+        view = status if status in ('active', 'completed') else 'all'
+        return f'"{self.epoch}-{self.version}-{view}"'
+    
+    def create(self, title, completed=False):
+        """创建任务"""
+        with self.lock:
+            now = datetime.now().isoformat()
+            todo = {
+                'id': self.next_id,
+                'title': title,
+                'completed': completed,
+                'created_at': now,
+                'updated_at': now
+            }
+            self.next_id += 1
+            self.version += 1
+            self.todos[todo['id']] = todo
+            key = (todo['created_at'], todo['id'])
+            bisect.insort(self.views['all'], key)
+            bisect.insort(self.views[self.state_view(completed)], key)
+            return todo
+    
+    def update(self, todo_id, update_data):
+        """更新任务，任务不存在时返回 None"""
+        with self.lock:
+            todo = self.todos.get(todo_id)
+            if todo is None:
+                return None
+            if 'title' in update_data:
+                todo['title'] = update_data['title']
+            if 'completed' in update_data:
+                if bool(update_data['completed']) != bool(todo['completed']):
+                    # 在未完成/已完成视图之间移动
+                    key = (todo['created_at'], todo['id'])
+                    self.remove_key(self.views[self.state_view(todo['completed'])], key)
+                    bisect.insort(self.views[self.state_view(update_data['completed'])], key)
+                todo['completed'] = update_data['completed']
+            todo['updated_at'] = datetime.now().isoformat()
+            self.version += 1
+            return todo
+    
+    def delete(self, todo_id):
+        """删除任务，返回是否删除成功"""
+        with self.lock:
+            todo = self.todos.pop(todo_id, None)
+            if todo is None:
+                return False
+            key = (todo['created_at'], todo['id'])
+            self.remove_key(self.views['all'], key)
+            self.remove_key(self.views[self.state_view(todo['completed'])], key)
+            self.version += 1
+            return True
+    
+    def delete_completed(self):
+        """删除所有已完成任务，返回删除数量"""
+        with self.lock:
+            removed = {todo_id for _, todo_id in self.views['completed']}
+            for todo_id in removed:
+                del self.todos[todo_id]
+            self.views['all'] = [key for key in self.views['all'] if key[1] not in removed]
+            self.views['completed'] = []
+            if removed:
+                self.version += 1
+            return len(removed)
+    
+    def delete_all(self):
+        """清空所有任务，返回删除数量"""
+        with self.lock:
+            count = len(self.todos)
+            self.todos = {}
+            self.views = {'all': [], 'active': [], 'completed': []}
+            if count:
+                self.version += 1
+            return count
+
 # 内存数据库
-TODOS_DB = []
-NEXT_ID = 1
+STORE = TodoStore()
+
+# 就绪检查 (/api/health/ready): 结果缓存时间 (秒)、延迟阈值 (毫秒)和取存储锁的最长等待时间 (秒)
+READINESS_CACHE_TTL = float(os.environ.get('READINESS_CACHE_TTL', '2'))
+READINESS_MAX_LATENCY_MS = float(os.environ.get('READINESS_MAX_LATENCY_MS', '250'))
+READINESS_TIMEOUT = float(os.environ.get('READINESS_TIMEOUT', '2'))
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 3)
+
+def finish_probe(result, started, timings):
+    """补上总耗时，超过阈值时标记为未就绪"""
+    result['latency_ms'] = elapsed_ms(started)
+    if timings is not None:
+        result['storage'] = timings
+    if result['status'] == 'ready' and result['latency_ms'] > READINESS_MAX_LATENCY_MS:
+        result['status'] = 'not_ready'
+        result['reason'] = f"存储延迟 {result['latency_ms']}ms 超过阈值 {READINESS_MAX_LATENCY_MS}ms"
+    return result
+
+_readiness = {'result': None, 'checked_at': float('-inf')}
+_readiness_lock = threading.Lock()
+
+def check_readiness():
+    """
+    返回 (是否就绪, 检查结果)，结果缓存 READINESS_CACHE_TTL 秒
+
+    同时到达的探测在锁上排队，缓存过期后只有第一个实际访问存储。
+    """
+    with _readiness_lock:
+        result = _readiness['result']
+        age = time.monotonic() - _readiness['checked_at']
+        if result is not None and age < READINESS_CACHE_TTL:
+            return result['status'] == 'ready', {**result, 'cached': True, 'age': round(age, 3)}
+        result = probe_store()
+        _readiness.update(result=result, checked_at=time.monotonic())
+        return result['status'] == 'ready', {**result, 'cached': False, 'age': 0.0}
+
+def probe_store():
+    """取一次存储锁 (锁被长时间占用时写操作都会排队)，返回检查结果"""
+    result = {'status': 'ready', 'max_latency_ms': READINESS_MAX_LATENCY_MS, 'checked_at': time.time()}
+    started = time.perf_counter()
+    if not STORE.lock.acquire(timeout=READINESS_TIMEOUT):
+        result['status'] = 'not_ready'
+        result['reason'] = f"存储锁在 {READINESS_TIMEOUT} 秒内没有释放"
+        return finish_probe(result, started, None)
+    try:
+        result['total'] = len(STORE.todos)
+    finally:
+        STORE.lock.release()
+    return finish_probe(result, started, {'lock_ms': elapsed_ms(started)})
+
+def etag_matches(if_none_match, etag):
+    """判断 If-None-Match 是否命中 (弱比较，支持 * 和逗号分隔的多个值)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
 
 class handler(BaseHTTPRequestHandler):
     def do_GET(self):
@@ -18,6 +193,8 @@ class handler(BaseHTTPRequestHandler):
         
         if path == '/api/todos' or path == '/api/todos/':
             self.get_todos()
+        elif path == '/api/health/ready' or path == '/api/health/ready/':
+            self.readiness_check()
         elif path == '/api/health' or path == '/api/health/':
             self.health_check()
         else:
@@ -64,7 +241,7 @@ class handler(BaseHTTPRequestHandler):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, If-None-Match')
         self.end_headers()
     
     def get_todos(self):
@@ -75,20 +252,21 @@ class handler(BaseHTTPRequestHandler):
             query_params = parse_qs(parsed_path.query)
             status = query_params.get('status', ['all'])[0]
             
-            todos = TODOS_DB.copy()
-            
-            # 根据状态筛选
-            if status == 'active':
-                todos = [todo for todo in todos if not todo['completed']]
-            elif status == 'completed':
-                todos = [todo for todo in todos if todo['completed']]
+            # 版本号未变化时不需要读取和序列化列表
+            etag = STORE.etag(status)
+            if etag_matches(self.headers.get('If-None-Match'), etag):
+                self.send_not_modified(etag)
+                return
             
-            # 按创建时间倒序排列
-            todos.sort(key=lambda x: x['created_at'], reverse=True)
+            # 按状态取对应视图，已按创建时间倒序排列
+            todos, etag = STORE.list(status)
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
             self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Access-Control-Expose-Headers', 'ETag')
             self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
             self.send_header('Access-Control-Allow-Headers', 'Content-Type')
             self.end_headers()
@@ -97,6 +275,15 @@ class handler(BaseHTTPRequestHandler):
         except Exception as e:
             self.send_error(500, str(e))
     
+    def send_not_modified(self, etag):
+        """发送 304 响应"""
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', 'ETag')
+        self.end_headers()
+    
     def create_todo(self):
         """创建任务"""
         try:
@@ -104,16 +291,7 @@ class handler(BaseHTTPRequestHandler):
             post_data = self.rfile.read(content_length)
             todo_data = json.loads(post_data.decode('utf-8'))
             
-            global NEXT_ID
-            todo = {
-                'id': NEXT_ID,
-                'title': todo_data['title'],
-                'completed': todo_data.get('completed', False),
-                'created_at': datetime.now().isoformat(),
-                'updated_at': datetime.now().isoformat()
-            }
-            NEXT_ID += 1
-            TODOS_DB.append(todo)
+            todo = STORE.create(todo_data['title'], todo_data.get('completed', False))
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -131,25 +309,13 @@ class handler(BaseHTTPRequestHandler):
             post_data = self.rfile.read(content_length)
             update_data = json.loads(post_data.decode('utf-8'))
             
-            # 查找任务
-            todo = None
-            for i, t in enumerate(TODOS_DB):
-                if t['id'] == int(todo_id):
-                    todo = t
-                    break
+            # 更新任务
+            todo = STORE.update(int(todo_id), update_data)
             
             if not todo:
                 self.send_error(404, "任务不存在")
                 return
             
-            # 更新任务
-            if 'title' in update_data:
-                todo['title'] = update_data['title']
-            if 'completed' in update_data:
-                todo['completed'] = update_data['completed']
-            
-            todo['updated_at'] = datetime.now().isoformat()
-            
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
@@ -162,11 +328,7 @@ class handler(BaseHTTPRequestHandler):
     def delete_todo(self, todo_id):
         """删除任务"""
         try:
-            global TODOS_DB
-            original_length = len(TODOS_DB)
-            TODOS_DB = [todo for todo in TODOS_DB if todo['id'] != int(todo_id)]
-            
-            if len(TODOS_DB) == original_length:
+            if not STORE.delete(int(todo_id)):
                 self.send_error(404, "任务不存在")
                 return
             
@@ -182,10 +344,7 @@ class handler(BaseHTTPRequestHandler):
     def delete_completed_todos(self):
         """批量删除已完成任务"""
         try:
-            global TODOS_DB
-            original_length = len(TODOS_DB)
-            TODOS_DB = [todo for todo in TODOS_DB if not todo['completed']]
-            deleted_count = original_length - len(TODOS_DB)
+            deleted_count = STORE.delete_completed()
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -199,9 +358,7 @@ class handler(BaseHTTPRequestHandler):
     def delete_all_todos(self):
         """清空所有任务"""
         try:
-            global TODOS_DB
-            count = len(TODOS_DB)
-            TODOS_DB = []
+            count = STORE.delete_all()
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -219,3 +376,14 @@ class handler(BaseHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.end_headers()
         self.wfile.write(json.dumps({"status": "healthy", "message": "服务运行正常"}).encode())
+    
+    def readiness_check(self):
+        """就绪检查：取一次存储锁，未就绪时返回 503"""
+        ready, result = check_readiness()
+        
+        self.send_response(200 if ready else 503)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(json.dumps(result).encode())
@@ -20,6 +20,8 @@ class handler(BaseHTTPRequestHandler):
         
         if path == '/api/todos' or path == '/api/todos/':
             self.get_todos()
+        elif path == '/api/health/ready' or path == '/api/health/ready/':
+            self.readiness_check()
         elif path == '/api/health' or path == '/api/health/':
             self.health_check()
         else:
@@ -227,6 +229,15 @@ class handler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(json.dumps({"status": "healthy", "message": "服务运行正常"}).encode())
     
+    def readiness_check(self):
+        """就绪检查：数据只在进程内存中，没有外部存储需要访问，进程能响应即就绪"""
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(json.dumps({"status": "ready", "total": len(TODOS_DB)}).encode())
+    
     def do_OPTIONS(self):
         """处理 CORS 预检请求"""
         self.send_response(200)
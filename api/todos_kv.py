@@ -4,13 +4,106 @@ Vercel API 函数 - Todo 管理 (使用 KV 存储)
 """
 import json
 import os
+import sys
+import threading
+import time
 from http.server import BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 from datetime import datetime
 
-# KV 存储的键名
-TODOS_KEY = "todos_data"
-NEXT_ID_KEY = "todos_next_id"
+# 键布局、读写操作和进程内替身与 backend 的 KVTodoRepository 共用 (见 _kvstore.py)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _kvstore import (
+    EPOCH_KEY, HEALTH_KEY, NEXT_ID_KEY, VERSION_KEY,
+    create_kv_client, create_todos, delete_todos, list_ids, list_todos, update_todos,
+)
+
+# 模块级客户端，热启动的请求之间复用
+kv = create_kv_client()
+
+# 就绪检查 (/api/health/ready): 结果缓存时间 (秒)、延迟阈值 (毫秒)，以及是否验证 KV 可写 (写入 HEALTH_KEY)
+READINESS_CACHE_TTL = float(os.environ.get('READINESS_CACHE_TTL', '2'))
+READINESS_MAX_LATENCY_MS = float(os.environ.get('READINESS_MAX_LATENCY_MS', '250'))
+READINESS_WRITE_PROBE = os.environ.get('READINESS_WRITE_PROBE', '0').lower() in ('1', 'true', 'yes')
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 3)
+
+def finish_probe(result, started, timings):
+    """补上总耗时，超过阈值时标记为未就绪"""
+    result['latency_ms'] = elapsed_ms(started)
+    if timings is not None:
+        result['storage'] = timings
+    if result['status'] == 'ready' and result['latency_ms'] > READINESS_MAX_LATENCY_MS:
+        result['status'] = 'not_ready'
+        result['reason'] = f"存储延迟 {result['latency_ms']}ms 超过阈值 {READINESS_MAX_LATENCY_MS}ms"
+    return result
+
+_readiness = {'result': None, 'checked_at': float('-inf')}
+_readiness_lock = threading.Lock()
+
+def check_readiness():
+    """
+    返回 (是否就绪, 检查结果)，结果缓存 READINESS_CACHE_TTL 秒
+
+    同时到达的探测在锁上排队，缓存过期后只有第一个实际访问存储。
+    """
+    with _readiness_lock:
+        result = _readiness['result']
+        age = time.monotonic() - _readiness['checked_at']
+        if result is not None and age < READINESS_CACHE_TTL:
+            return result['status'] == 'ready', {**result, 'cached': True, 'age': round(age, 3)}
+        result = probe_kv()
+        _readiness.update(result=result, checked_at=time.monotonic())
+        return result['status'] == 'ready', {**result, 'cached': False, 'age': 0.0}
+
+def probe_kv():
+    """读一次自增ID键，READINESS_WRITE_PROBE 时再写探测键，返回检查结果"""
+    result = {'status': 'ready', 'max_latency_ms': READINESS_MAX_LATENCY_MS, 'checked_at': time.time()}
+    started = time.perf_counter()
+    timings = None
+    try:
+        kv.get(NEXT_ID_KEY)
+        timings = {'query_ms': elapsed_ms(started)}
+        if READINESS_WRITE_PROBE:
+            step = time.perf_counter()
+            kv.set(HEALTH_KEY, str(time.time()))
+            timings['write_ms'] = elapsed_ms(step)
+    except Exception as e:
+        result['status'] = 'not_ready'
+        result['reason'] = f"访问 KV 失败: {e}"
+    return finish_probe(result, started, timings)
+
+def list_etag(status):
+    """
+    当前版本下列表的强 ETag，只读两个小键，不访问任务数据
+    """
+    version, epoch = kv.mget([VERSION_KEY, EPOCH_KEY])
+    if epoch is None:
+        kv.set(EPOCH_KEY, os.urandom(4).hex(), nx=True)
+        version, epoch = kv.mget([VERSION_KEY, EPOCH_KEY])
+    view = status if status in ('active', 'completed') else 'all'
+    return f'"{epoch}-{version or 0}-{view}"'
+
+def etag_matches(if_none_match, etag):
+    """判断 If-None-Match 是否命中 (弱比较，支持 * 和逗号分隔的多个值)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+def create_todo(title, completed=False):
+    """创建任务：INCR 分配ID，任务和索引在一个事务中写入"""
+    return create_todos(kv, [(title, completed)], datetime.now().isoformat())[0]
+
+def update_todo(todo_id, update_data):
+    """更新单个任务，只读写这个任务的键，状态变化时在索引间移动"""
+    todos, missing = update_todos(
+        kv, [(todo_id, update_data.get('title'), update_data.get('completed'))], datetime.now().isoformat()
+    )
+    return None if missing else todos[0]
 
 class handler(BaseHTTPRequestHandler):
     def do_GET(self):
@@ -20,6 +113,8 @@ class handler(BaseHTTPRequestHandler):
         
         if path == '/api/todos' or path == '/api/todos/':
             self.get_todos()
+        elif path == '/api/health/ready' or path == '/api/health/ready/':
+            self.readiness_check()
         elif path == '/api/health' or path == '/api/health/':
             self.health_check()
         else:
@@ -66,64 +161,9 @@ class handler(BaseHTTPRequestHandler):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, If-None-Match')
         self.end_headers()
     
-    async def get_todos_from_kv(self):
-        """从 KV 存储获取任务列表"""
-        try:
-            data = await kv.get(TODOS_KEY)
-            if data:
-                return json.loads(data)
-            return []
-        except Exception as e:
-            print(f"Error getting todos from KV: {e}")
-            return []
-    
-    async def save_todos_to_kv(self, todos):
-        """保存任务列表到 KV 存储"""
-        try:
-            await kv.set(TODOS_KEY, json.dumps(todos))
-            return True
-        except Exception as e:
-            print(f"Error saving todos to KV: {e}")
-            return False
-    
-    async def get_next_id(self):
-        """获取下一个ID"""
-        try:
-            next_id = await kv.get(NEXT_ID_KEY)
-            if next_id is None:
-                next_id = 1
-            else:
-                next_id = int(next_id) + 1
-            await kv.set(NEXT_ID_KEY, str(next_id))
-            return next_id
-        except Exception as e:
-            print(f"Error getting next ID: {e}")
-            return 1
-    
-    async def add_todo_to_kv(self, title, completed=False):
-        """添加任务到 KV 存储"""
-        try:
-            todos = await self.get_todos_from_kv()
-            next_id = await self.get_next_id()
-            
-            todo = {
-                "id": next_id,
-                "title": title,
-                "completed": completed,
-                "created_at": datetime.now().isoformat(),
-                "updated_at": datetime.now().isoformat()
-            }
-            
-            todos.append(todo)
-            await self.save_todos_to_kv(todos)
-            return todo
-        except Exception as e:
-            print(f"Error adding todo to KV: {e}")
-            return None
-    
     def get_todos(self):
         """获取任务列表"""
         try:
@@ -132,21 +172,21 @@ class handler(BaseHTTPRequestHandler):
             query_params = parse_qs(parsed_path.query)
             status = query_params.get('status', ['all'])[0]
             
-            # 从 KV 获取数据
-            todos = await self.get_todos_from_kv()
-            
-            # 根据状态筛选
-            if status == 'active':
-                todos = [todo for todo in todos if not todo['completed']]
-            elif status == 'completed':
-                todos = [todo for todo in todos if todo['completed']]
+            # 先读版本号再读数据：版本号未变化时直接返回 304
+            etag = list_etag(status)
+            if etag_matches(self.headers.get('If-None-Match'), etag):
+                self.send_not_modified(etag)
+                return
             
-            # 按创建时间倒序排列
-            todos.sort(key=lambda x: x['created_at'], reverse=True)
+            # 从对应状态的索引取ID，再批量取回任务
+            todos = list_todos(kv, status)
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
             self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Access-Control-Expose-Headers', 'ETag')
             self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
             self.send_header('Access-Control-Allow-Headers', 'Content-Type')
             self.end_headers()
@@ -155,6 +195,15 @@ class handler(BaseHTTPRequestHandler):
         except Exception as e:
             self.send_error(500, str(e))
     
+    def send_not_modified(self, etag):
+        """发送 304 响应"""
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', 'ETag')
+        self.end_headers()
+    
     def create_todo(self):
         """创建任务"""
         try:
@@ -162,7 +211,7 @@ class handler(BaseHTTPRequestHandler):
             post_data = self.rfile.read(content_length)
             todo_data = json.loads(post_data.decode('utf-8'))
             
-            todo = await self.add_todo_to_kv(
+            todo = create_todo(
                 title=todo_data['title'],
                 completed=todo_data.get('completed', False)
             )
@@ -186,30 +235,13 @@ class handler(BaseHTTPRequestHandler):
             post_data = self.rfile.read(content_length)
             update_data = json.loads(post_data.decode('utf-8'))
             
-            todos = await self.get_todos_from_kv()
-            
-            # 查找任务
-            todo = None
-            for i, t in enumerate(todos):
-                if t['id'] == int(todo_id):
-                    todo = t
-                    break
+            # 更新任务
+            todo = update_todo(int(todo_id), update_data)
             
             if not todo:
                 self.send_error(404, "任务不存在")
                 return
             
-            # 更新任务
-            if 'title' in update_data:
-                todo['title'] = update_data['title']
-            if 'completed' in update_data:
-                todo['completed'] = update_data['completed']
-            
-            todo['updated_at'] = datetime.now().isoformat()
-            
-            # 保存到 KV
-            await self.save_todos_to_kv(todos)
-            
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
@@ -222,16 +254,10 @@ class handler(BaseHTTPRequestHandler):
     def delete_todo(self, todo_id):
         """删除任务"""
         try:
-            todos = await self.get_todos_from_kv()
-            original_length = len(todos)
-            todos = [todo for todo in todos if todo['id'] != int(todo_id)]
-            
-            if len(todos) == original_length:
+            if not delete_todos(kv, [int(todo_id)]):
                 self.send_error(404, "任务不存在")
                 return
             
-            await self.save_todos_to_kv(todos)
-            
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
@@ -244,12 +270,7 @@ class handler(BaseHTTPRequestHandler):
     def delete_completed_todos(self):
         """批量删除已完成任务"""
         try:
-            todos = await self.get_todos_from_kv()
-            original_length = len(todos)
-            todos = [todo for todo in todos if not todo['completed']]
-            deleted_count = original_length - len(todos)
-            
-            await self.save_todos_to_kv(todos)
+            deleted_count = len(delete_todos(kv, list_ids(kv, 'completed')))
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -263,9 +284,7 @@ class handler(BaseHTTPRequestHandler):
     def delete_all_todos(self):
         """清空所有任务"""
         try:
-            todos = await self.get_todos_from_kv()
-            count = len(todos)
-            await self.save_todos_to_kv([])
+            count = len(delete_todos(kv, list_ids(kv)))
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -283,3 +302,14 @@ class handler(BaseHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.end_headers()
         self.wfile.write(json.dumps({"status": "healthy", "message": "服务运行正常"}).encode())
+    
+    def readiness_check(self):
+        """就绪检查：实际访问一次 KV，未就绪时返回 503(结果短时缓存)"""
+        ready, result = check_readiness()
+        
+        self.send_response(200 if ready else 503)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(json.dumps(result).encode())
@@ -3,70 +3,808 @@ Vercel API 函数 - Todo 管理 (使用 Postgres 数据库)
 实现数据持久化存储
 """
 import json
+import math
 import os
+import re
+import threading
+import time
 from http.server import BaseHTTPRequestHandler
-from urllib.parse import urlparse, parse_qs
+from queue import LifoQueue, Empty
+from urllib.parse import urlparse, parse_qs, parse_qsl, urlencode
 from datetime import datetime
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, connection as PgConnection
+from psycopg2.extras import RealDictCursor, execute_values
 
 # 从环境变量获取数据库连接信息
 DATABASE_URL = os.environ.get('POSTGRES_URL')
 
+# 连接池配置，连接池在模块级别创建，函数实例热启动时继续复用
+POSTGRES_POOL_SIZE = int(os.environ.get('POSTGRES_POOL_SIZE', '5'))
+POSTGRES_POOL_TIMEOUT = float(os.environ.get('POSTGRES_POOL_TIMEOUT', '10'))
+POSTGRES_HEALTH_CHECK_INTERVAL = float(os.environ.get('POSTGRES_HEALTH_CHECK_INTERVAL', '30'))
+
+# 就绪检查 (/api/health/ready): 结果缓存时间 (秒)、延迟阈值 (毫秒)、
+# 取连接和执行语句的最长等待时间 (秒)，以及是否验证数据库可写
+READINESS_CACHE_TTL = float(os.environ.get('READINESS_CACHE_TTL', '2'))
+READINESS_MAX_LATENCY_MS = float(os.environ.get('READINESS_MAX_LATENCY_MS', '250'))
+READINESS_TIMEOUT = float(os.environ.get('READINESS_TIMEOUT', '2'))
+READINESS_WRITE_PROBE = os.environ.get('READINESS_WRITE_PROBE', '0').lower() in ('1', 'true', 'yes')
+
+# 流式输出时服务端游标每次拉取的行数
+STREAM_BATCH_SIZE = 500
+
+# 支持的流式输出格式及其媒体类型
+STREAM_MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json',
+}
+
+# 批量接口单次请求允许的最大条数
+MAX_BATCH_SIZE = 1000
+
+# 与表结构 title VARCHAR(255) 和 id INTEGER 一致
+TITLE_MAX_LENGTH = 255
+ID_MAX = 2 ** 31 - 1
+
+def is_todo_id(value):
+    """是否为有效的任务ID (JSON 整数，不接受 true/false)"""
+    return type(value) is int and 1 <= value <= ID_MAX
+
+def batch_item_error(index, item, update):
+    """
+    校验批量创建 (update=False) 或批量更新 (update=True) 请求中的一项
+    
+    在打开事务之前检查类型，避免 Postgres 类型转换或 int() 失败变成 500。
+    返回错误说明，没有问题时返回 None。说明用英文：send_error 的原因短语只能是 latin-1。
+    """
+    if not isinstance(item, dict):
+        return f"item {index}: must be an object"
+    title = item.get('title')
+    completed = item.get('completed')
+    if update:
+        if not is_todo_id(item.get('id')):
+            return f"item {index}: id must be a positive integer"
+        if title is None and completed is None:
+            return f"item {index}: nothing to update"
+    if (title is not None or not update) and not (isinstance(title, str) and 0 < len(title) <= TITLE_MAX_LENGTH):
+        return f"item {index}: title must be a string of 1-{TITLE_MAX_LENGTH} characters"
+    if completed is not None and not isinstance(completed, bool):
+        return f"item {index}: completed must be a boolean"
+    return None
+
+def etag_matches(if_none_match, etag):
+    """判断 If-None-Match 是否命中 (弱比较，支持 * 和逗号分隔的多个值)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+def todo_to_dict(todo):
+    """把数据库行转换为响应字典"""
+    return {
+        'id': todo['id'],
+        'title': todo['title'],
+        'completed': todo['completed'],
+        'created_at': todo['created_at'].isoformat(),
+        'updated_at': todo['updated_at'].isoformat()
+    }
+
+# 表结构迁移，按版本号顺序执行；修改表结构时在末尾追加新版本，不要改动已发布的版本
+MIGRATIONS = [
+    (1, [
+        """
+        CREATE TABLE IF NOT EXISTS todos (
+            id SERIAL PRIMARY KEY,
+            title VARCHAR(255) NOT NULL,
+            completed BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_todos_completed 
+        ON todos(completed)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_todos_created_at 
+        ON todos(created_at)
+        """,
+    ]),
+    # 表版本号：语句级触发器在写 todos 的同一事务中加一，用于生成列表的 ETag
+    (2, [
+        """
+        CREATE TABLE IF NOT EXISTS todos_version (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            version BIGINT NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        INSERT INTO todos_version (id, version) VALUES (TRUE, 0)
+        ON CONFLICT (id) DO NOTHING
+        """,
+        """
+        CREATE OR REPLACE FUNCTION bump_todos_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE todos_version SET version = version + 1;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        DROP TRIGGER IF EXISTS todos_version_bump ON todos
+        """,
+        """
+        CREATE TRIGGER todos_version_bump
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON todos
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_todos_version()
+        """,
+    ]),
+    # 标题全文索引：默认的 simple 分词会把一整段中文当成一个词，这里把每段连续的
+    # 汉字拆成单字和相邻两字 (与 search_tsquery 的拆法一致)，其余部分仍按 simple 分词
+    (3, [
+        r"""
+        CREATE OR REPLACE FUNCTION todo_search_vector(title TEXT) RETURNS tsvector AS $$
+        DECLARE
+            lexemes TEXT[] := '{}';
+            run TEXT;
+        BEGIN
+            FOR run IN SELECT m[1] FROM regexp_matches(lower(title), '([\u3400-\u4dbf\u4e00-\u9fff]+)', 'g') AS m LOOP
+                FOR i IN 1..char_length(run) LOOP
+                    lexemes := lexemes || substr(run, i, 1);
+                    IF i < char_length(run) THEN
+                        lexemes := lexemes || substr(run, i, 2);
+                    END IF;
+                END LOOP;
+            END LOOP;
+            RETURN to_tsvector('simple', regexp_replace(lower(title), '[\u3400-\u4dbf\u4e00-\u9fff]+', ' ', 'g'))
+                || array_to_tsvector(lexemes);
+        END
+        $$ LANGUAGE plpgsql IMMUTABLE
+        """,
+        """
+        ALTER TABLE todos ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (todo_search_vector(title)) STORED
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_todos_search ON todos USING GIN (search_vector)
+        """,
+    ]),
+    # 任务计数：语句级触发器通过转换表 (new_rows/old_rows) 一次性增减，批量写入也只更新一次
+    (4, [
+        """
+        CREATE TABLE IF NOT EXISTS todo_stats (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            total BIGINT NOT NULL,
+            completed BIGINT NOT NULL
+        )
+        """,
+        """
+        CREATE OR REPLACE FUNCTION update_todo_stats() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE todo_stats SET
+                    total = total + (SELECT COUNT(*) FROM new_rows),
+                    completed = completed + (SELECT COUNT(*) FROM new_rows WHERE completed);
+            ELSIF TG_OP = 'UPDATE' THEN
+                UPDATE todo_stats SET
+                    completed = completed + (SELECT COUNT(*) FROM new_rows WHERE completed)
+                                          - (SELECT COUNT(*) FROM old_rows WHERE completed);
+            ELSIF TG_OP = 'DELETE' THEN
+                UPDATE todo_stats SET
+                    total = total - (SELECT COUNT(*) FROM old_rows),
+                    completed = completed - (SELECT COUNT(*) FROM old_rows WHERE completed);
+            ELSE
+                UPDATE todo_stats SET total = 0, completed = 0;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        DROP TRIGGER IF EXISTS todo_stats_insert ON todos
+        """,
+        """
+        DROP TRIGGER IF EXISTS todo_stats_update ON todos
+        """,
+        """
+        DROP TRIGGER IF EXISTS todo_stats_delete ON todos
+        """,
+        """
+        DROP TRIGGER IF EXISTS todo_stats_truncate ON todos
+        """,
+        """
+        CREATE TRIGGER todo_stats_insert AFTER INSERT ON todos
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION update_todo_stats()
+        """,
+        """
+        CREATE TRIGGER todo_stats_update AFTER UPDATE ON todos
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION update_todo_stats()
+        """,
+        """
+        CREATE TRIGGER todo_stats_delete AFTER DELETE ON todos
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION update_todo_stats()
+        """,
+        """
+        CREATE TRIGGER todo_stats_truncate AFTER TRUNCATE ON todos
+        FOR EACH STATEMENT EXECUTE FUNCTION update_todo_stats()
+        """,
+        # 创建触发器时已锁住 todos 的写入，此时按现有数据初始化不会漏掉并发写入
+        """
+        INSERT INTO todo_stats (id, total, completed)
+        SELECT TRUE, COUNT(*), COUNT(*) FILTER (WHERE completed) FROM todos
+        ON CONFLICT (id) DO NOTHING
+        """,
+    ]),
+    # 增量同步 (backend 的 /api/v1/todos/changes)：与 SQLite 相同，sync_state 中的同步版本号每写入或删除
+    # 一行加一，写入的行记在 version 列，删除的行记进 todo_tombstones。所有写事务都要更新 sync_state
+    # 这一行，行锁使版本号按提交顺序递增，读到某个版本号之后不会再提交更小的版本号
+    (5, [
+        # 补版本号到创建触发器之间不能有新的写入
+        """
+        LOCK TABLE todos IN SHARE ROW EXCLUSIVE MODE
+        """,
+        """
+        ALTER TABLE todos ADD COLUMN IF NOT EXISTS version BIGINT
+        """,
+        """
+        UPDATE todos SET version = numbered.version
+        FROM (SELECT id, row_number() OVER (ORDER BY id) AS version FROM todos) AS numbered
+        WHERE todos.id = numbered.id
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_todos_version ON todos(version)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS sync_state (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            version BIGINT NOT NULL,
+            pruned_version BIGINT NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        INSERT INTO sync_state (id, version) SELECT TRUE, COUNT(*) FROM todos
+        ON CONFLICT (id) DO NOTHING
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS todo_tombstones (
+            id INTEGER PRIMARY KEY,
+            version BIGINT NOT NULL,
+            deleted_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_todo_tombstones_version ON todo_tombstones(version)
+        """,
+        """
+        CREATE OR REPLACE FUNCTION todos_sync_write() RETURNS trigger AS $$
+        BEGIN
+            UPDATE sync_state SET version = version + 1 RETURNING version INTO NEW.version;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE OR REPLACE FUNCTION todos_sync_delete() RETURNS trigger AS $$
+        DECLARE
+            next_version BIGINT;
+        BEGIN
+            UPDATE sync_state SET version = version + 1 RETURNING version INTO next_version;
+            INSERT INTO todo_tombstones (id, version) VALUES (OLD.id, next_version)
+            ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version, deleted_at = NOW();
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        # TRUNCATE 不触发行级触发器、没有墓碑，之前的同步位置都只能重新全量同步
+        """
+        CREATE OR REPLACE FUNCTION todos_sync_truncate() RETURNS trigger AS $$
+        BEGIN
+            UPDATE sync_state SET version = version + 1, pruned_version = version + 1;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        DROP TRIGGER IF EXISTS todos_sync_insert ON todos
+        """,
+        """
+        DROP TRIGGER IF EXISTS todos_sync_update ON todos
+        """,
+        """
+        DROP TRIGGER IF EXISTS todos_sync_delete ON todos
+        """,
+        """
+        DROP TRIGGER IF EXISTS todos_sync_truncate ON todos
+        """,
+        """
+        CREATE TRIGGER todos_sync_insert BEFORE INSERT ON todos
+        FOR EACH ROW EXECUTE FUNCTION todos_sync_write()
+        """,
+        """
+        CREATE TRIGGER todos_sync_update BEFORE UPDATE OF title, completed, updated_at ON todos
+        FOR EACH ROW EXECUTE FUNCTION todos_sync_write()
+        """,
+        """
+        CREATE TRIGGER todos_sync_delete AFTER DELETE ON todos
+        FOR EACH ROW EXECUTE FUNCTION todos_sync_delete()
+        """,
+        """
+        CREATE TRIGGER todos_sync_truncate AFTER TRUNCATE ON todos
+        FOR EACH STATEMENT EXECUTE FUNCTION todos_sync_truncate()
+        """,
+    ]),
+    # 列表 ETag 的版本号改用 sync_state 的同步版本号：行级触发器只在确实写入或删除了行时加一，
+    # 没有影响任何行的语句 (如没有已完成任务时清理已完成) 不再让客户端缓存失效。
+    # epoch 在建表时随机生成，数据库重建后版本号从头计数，也不会与之前发出的 ETag 相同。
+    # todos_version 保留为视图，滚动部署期间旧版本的实例仍可读取
+    (6, [
+        """
+        DROP TRIGGER IF EXISTS todos_version_bump ON todos
+        """,
+        """
+        DROP FUNCTION IF EXISTS bump_todos_version()
+        """,
+        """
+        ALTER TABLE sync_state ADD COLUMN IF NOT EXISTS epoch TEXT NOT NULL
+        DEFAULT substr(md5(random()::text || clock_timestamp()::text), 1, 8)
+        """,
+        """
+        DROP TABLE IF EXISTS todos_version
+        """,
+        """
+        CREATE VIEW todos_version AS SELECT version, epoch FROM sync_state
+        """,
+    ]),
+]
+
+# 多个实例同时冷启动时用于串行执行迁移的 advisory lock 键
+SCHEMA_LOCK_KEY = 720_301
+
+# 当前进程是否已完成表结构检查；函数实例热启动时直接跳过
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+def ensure_schema(conn):
+    """
+    确保表结构是最新版本，每个进程只在第一次请求时执行一次
+
+    复用请求自己的连接：先查 schema_migrations 中的版本号，
+    只有落后时才在 advisory lock 保护下执行缺失的迁移。
+    """
+    global _schema_ready
+    if _schema_ready:
+        return
+    
+    with _schema_lock:
+        if _schema_ready:
+            return
+        
+        started = time.perf_counter()
+        latest = MIGRATIONS[-1][0]
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+            if cursor.fetchone()[0]:
+                cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+                current = cursor.fetchone()[0]
+            else:
+                current = 0
+            
+            if current < latest:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_KEY,))
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INTEGER PRIMARY KEY,
+                        applied_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                    )
+                """)
+                # 拿到锁后重新读取，其他实例可能已经执行过
+                cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+                current = cursor.fetchone()[0]
+                for version, statements in MIGRATIONS:
+                    if version <= current:
+                        continue
+                    for statement in statements:
+                        cursor.execute(statement)
+                    cursor.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (version,))
+            
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        
+        _schema_ready = True
+        print(f"Schema bootstrap finished in {(time.perf_counter() - started) * 1000:.1f}ms (version {latest})")
+
+def parse_database_url(url):
+    """
+    解析连接串，返回 (libpq 可用的连接串, 是否经过 PgBouncer)
+
+    PgBouncer 模式可以通过 POSTGRES_PGBOUNCER=1 开启，也可以沿用 Prisma/Supabase
+    的写法在连接串里带上 pgbouncer=true；libpq 不认识这个参数，需要先去掉。
+    """
+    pgbouncer = os.environ.get('POSTGRES_PGBOUNCER', '').lower() in ('1', 'true', 'yes')
+    parsed = urlparse(url)
+    params = parse_qsl(parsed.query, keep_blank_values=True)
+    if any(key == 'pgbouncer' for key, _ in params):
+        pgbouncer = pgbouncer or any(key == 'pgbouncer' and value.lower() in ('1', 'true') for key, value in params)
+        url = parsed._replace(query=urlencode([(key, value) for key, value in params if key != 'pgbouncer'])).geturl()
+    return url, pgbouncer
+
+class PreparedConnection(PgConnection):
+    """记录本连接上已经 PREPARE 过的语句名 (服务端预编译语句是会话级的)"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+class PostgresConnectionPool:
+    """
+    Postgres 连接池
+
+    连接在首次需要时创建，数量不超过 size，归还后留在池中供后续请求复用。
+    空闲超过 health_check_interval 的连接在取出时先执行 SELECT 1，
+    失败则丢弃并重新连接 (函数实例被冻结后，服务端可能早已断开空闲连接)。
+
+    pgbouncer=True 时假设前面是事务模式的 PgBouncer：同一个客户端连接的
+    不同事务可能落在不同的服务端连接上，因此不能依赖任何会话级状态
+    (SET、会话级 advisory lock、服务端 PREPARE)，连接归还前保证没有未结束的事务。
+    """
+    
+    def __init__(self, dsn, size=5, timeout=10.0, health_check_interval=30.0, pgbouncer=False):
+        self.dsn = dsn
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.pgbouncer = pgbouncer
+        self._idle = LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._created = 0
+        self._reconnects = 0
+    
+    def _connect(self, connect_timeout=None):
+        """新建一个连接，失败时释放名额"""
+        # libpq 的 connect_timeout 是整数秒 (最小 2 秒)，向上取整
+        options = {} if connect_timeout is None else {'connect_timeout': max(1, math.ceil(connect_timeout))}
+        try:
+            # PgBouncer 模式下不能使用服务端 PREPARE，连接不记录预编译语句
+            return psycopg2.connect(self.dsn, connection_factory=None if self.pgbouncer else PreparedConnection,
+                                    **options)
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+    
+    def _is_alive(self, conn):
+        """检查连接是否可用"""
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+    
+    def _discard(self, conn):
+        """关闭并丢弃一个连接，释放其名额"""
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+    
+    def getconn(self, timeout=None, connect_timeout=None):
+        """
+        从池中取出一个连接
+
+        Args:
+            timeout: 池满时的最长等待时间 (秒)，默认为连接池的 timeout
+            connect_timeout: 需要新建连接时建立连接的最长时间 (秒)，默认不限制
+
+        Raises:
+            TimeoutError: 在 timeout 秒内没有可用连接
+        """
+        try:
+            conn, last_used = self._idle.get_nowait()
+        except Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                return self._connect(connect_timeout)
+            try:
+                conn, last_used = self._idle.get(timeout=self.timeout if timeout is None else timeout)
+            except Empty:
+                raise TimeoutError("数据库连接池已耗尽，获取连接超时")
+        
+        stale = time.monotonic() - last_used > self.health_check_interval
+        if conn.closed or (stale and not self._is_alive(conn)):
+            self._discard(conn)
+            with self._lock:
+                self._created += 1
+                self._reconnects += 1
+            return self._connect(connect_timeout)
+        return conn
+    
+    def putconn(self, conn):
+        """归还连接，未结束的事务会被回滚，已断开的连接直接丢弃"""
+        if conn.closed:
+            self._discard(conn)
+            return
+        try:
+            if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            self._discard(conn)
+            return
+        self._idle.put((conn, time.monotonic()))
+    
+    def stats(self):
+        """返回连接池当前状态"""
+        with self._lock:
+            created = self._created
+            reconnects = self._reconnects
+        idle = self._idle.qsize()
+        return {
+            'size': self.size,
+            'created': created,
+            'idle': idle,
+            'in_use': created - idle,
+            'reconnects': reconnects,
+            'pgbouncer': self.pgbouncer,
+        }
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """获取模块级连接池，首次调用时创建"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                dsn, pgbouncer = parse_database_url(DATABASE_URL)
+                print(f"Creating connection pool for: {DATABASE_URL[:20]}... (pgbouncer={pgbouncer})")
+                _pool = PostgresConnectionPool(
+                    dsn,
+                    size=POSTGRES_POOL_SIZE,
+                    timeout=POSTGRES_POOL_TIMEOUT,
+                    health_check_interval=POSTGRES_HEALTH_CHECK_INTERVAL,
+                    pgbouncer=pgbouncer,
+                )
+    return _pool
+
 def get_db_connection():
-    """获取数据库连接"""
+    """从连接池借出连接 (进程内第一次借出时顺带完成表结构初始化)，用完后调用 release_db_connection 归还"""
     try:
         if not DATABASE_URL:
             print("ERROR: POSTGRES_URL environment variable not set")
             return None
-        print(f"Connecting to database: {DATABASE_URL[:20]}...")
-        conn = psycopg2.connect(DATABASE_URL)
-        print("Database connection successful")
-        return conn
+        conn = get_pool().getconn()
     except Exception as e:
         print(f"Database connection error: {e}")
         return None
-
-def init_database():
-    """初始化数据库表"""
-    conn = get_db_connection()
-    if not conn:
-        return False
     
     try:
-        cursor = conn.cursor()
-        
-        # 创建todos表
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS todos (
-                id SERIAL PRIMARY KEY,
-                title VARCHAR(255) NOT NULL,
-                completed BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
-                updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
-            )
-        """)
-        
-        # 创建索引
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_todos_completed 
-            ON todos(completed)
-        """)
-        
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_todos_created_at 
-            ON todos(created_at)
-        """)
-        
-        conn.commit()
-        return True
+        ensure_schema(conn)
     except Exception as e:
         print(f"Database initialization error: {e}")
-        return False
-    finally:
-        conn.close()
+        release_db_connection(conn)
+        return None
+    return conn
+
+def release_db_connection(conn):
+    """把连接归还到连接池"""
+    get_pool().putconn(conn)
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 3)
+
+def probe_database():
+    """
+    访问一次数据库: 取连接、SELECT 1，READINESS_WRITE_PROBE 时再分配一个事务号
+    (只有可写的主库能分配，随后回滚，不写任何数据)，返回检查结果
+    """
+    result = {'status': 'ready', 'max_latency_ms': READINESS_MAX_LATENCY_MS, 'checked_at': time.time()}
+    started = time.perf_counter()
+    try:
+        if not DATABASE_URL:
+            raise RuntimeError("POSTGRES_URL 未设置")
+        pool = get_pool()
+        # 池中没有空闲连接时会新建连接，同样限制在 READINESS_TIMEOUT 内，
+        # 否则数据库不可达时探测会持有 _readiness_lock 一直挂起，其他探测全部排队
+        conn = pool.getconn(timeout=READINESS_TIMEOUT, connect_timeout=READINESS_TIMEOUT)
+        try:
+            timings = {'checkout_ms': elapsed_ms(started)}
+            with conn.cursor() as cursor:
+                # 只在本事务内生效，PgBouncer 事务模式下也不会影响其他客户端
+                cursor.execute("SET LOCAL statement_timeout = %s", (int(READINESS_TIMEOUT * 1000),))
+                step = time.perf_counter()
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+                timings['query_ms'] = elapsed_ms(step)
+                if READINESS_WRITE_PROBE:
+                    step = time.perf_counter()
+                    cursor.execute("SELECT txid_current()")
+                    timings['write_ms'] = elapsed_ms(step)
+            conn.rollback()
+        finally:
+            pool.putconn(conn)
+        result['storage'] = timings
+    except Exception as e:
+        result['status'] = 'not_ready'
+        result['reason'] = f"访问数据库失败: {e}"
+    
+    result['latency_ms'] = elapsed_ms(started)
+    if result['status'] == 'ready' and result['latency_ms'] > READINESS_MAX_LATENCY_MS:
+        result['status'] = 'not_ready'
+        result['reason'] = f"数据库延迟 {result['latency_ms']}ms 超过阈值 {READINESS_MAX_LATENCY_MS}ms"
+    if _pool is not None:
+        pool_stats = _pool.stats()
+        pool_stats['saturation'] = round(pool_stats['in_use'] / pool_stats['size'], 3) if pool_stats['size'] else 0.0
+        result['pool'] = pool_stats
+    return result
+
+_readiness = {'result': None, 'checked_at': float('-inf')}
+_readiness_lock = threading.Lock()
+
+def check_readiness():
+    """
+    返回 (是否就绪, 检查结果)，结果缓存 READINESS_CACHE_TTL 秒
+
+    同时到达的探测在锁上排队，缓存过期后只有第一个实际访问数据库。
+    """
+    with _readiness_lock:
+        result = _readiness['result']
+        age = time.monotonic() - _readiness['checked_at']
+        if result is not None and age < READINESS_CACHE_TTL:
+            return result['status'] == 'ready', {**result, 'cached': True, 'age': round(age, 3)}
+        result = probe_database()
+        _readiness.update(result=result, checked_at=time.monotonic())
+        return result['status'] == 'ready', {**result, 'cached': False, 'age': 0.0}
+
+# 请求路径上的固定语句: 名称 -> (参数类型, SQL)，参数按 $1、$2... 的顺序各出现一次。
+# 只查询明确的列，表增加列之后已 PREPARE 的语句仍然可用
+TODO_COLUMNS = "id, title, completed, created_at, updated_at"
+STATEMENTS = {
+    'todos_version': ((), "SELECT version, epoch FROM todos_version"),
+    'todo_stats': ((), "SELECT v.version, v.epoch, s.total, s.completed FROM todos_version v, todo_stats s"),
+    'list_all': ((), f"SELECT {TODO_COLUMNS} FROM todos ORDER BY created_at DESC"),
+    'list_active': ((), f"SELECT {TODO_COLUMNS} FROM todos WHERE completed = FALSE ORDER BY created_at DESC"),
+    'list_completed': ((), f"SELECT {TODO_COLUMNS} FROM todos WHERE completed = TRUE ORDER BY created_at DESC"),
+    'create_todo': (('varchar', 'boolean'), f"""
+        INSERT INTO todos (title, completed) VALUES ($1, $2)
+        RETURNING {TODO_COLUMNS}
+    """),
+    # 未提供的字段通过 COALESCE 保留原值，只改标题、只改状态和都改共用这一种形状
+    'update_todo': (('varchar', 'boolean', 'integer'), f"""
+        UPDATE todos
+        SET title = COALESCE($1, title),
+            completed = COALESCE($2, completed),
+            updated_at = NOW()
+        WHERE id = $3
+        RETURNING {TODO_COLUMNS}
+    """),
+    'delete_todo': (('integer',), "DELETE FROM todos WHERE id = $1"),
+    # 全文索引只保证包含同样的字和两字组合，再用 strpos 确认每个词都按原样出现在标题中
+    'search_todos': (('tsquery', 'boolean', 'boolean', 'text[]', 'integer', 'integer'), f"""
+        SELECT {TODO_COLUMNS} FROM todos, (SELECT $1::tsquery AS query) AS q
+        WHERE search_vector @@ q.query
+          AND ($2::boolean IS NULL OR completed = $3)
+          AND NOT EXISTS (SELECT 1 FROM unnest($4::text[]) AS term WHERE strpos(lower(title), term) = 0)
+        ORDER BY ts_rank(search_vector, q.query) DESC, created_at DESC, id DESC
+        LIMIT $5 OFFSET $6
+    """),
+}
+
+# 与迁移中 todo_search_vector 使用的汉字范围一致
+CJK_RUN = re.compile('[\u3400-\u4dbf\u4e00-\u9fff]+')
+SEARCH_WORD = re.compile(r'[^\W_]+')
+
+def search_tsquery(terms):
+    """
+    把搜索词转换为 tsquery 文本，拆分方式与 todo_search_vector 一致
+    
+    汉字拆成相邻两字 (只有一个字时用单字)，其他单词按前缀匹配，所有部分之间是 AND。
+    直接作为 tsquery 字面量传入，不经过分词，词素与索引中的完全相同。
+    """
+    lexemes = []
+    for term in terms:
+        for run in CJK_RUN.findall(term):
+            if len(run) == 1:
+                lexemes.append(f"'{run}'")
+            else:
+                lexemes.extend(f"'{run[i:i + 2]}'" for i in range(len(run) - 1))
+        for word in SEARCH_WORD.findall(CJK_RUN.sub(' ', term)):
+            lexemes.append(f"'{word}':*")
+    return ' & '.join(dict.fromkeys(lexemes))
+
+class StatementRegistry:
+    """
+    服务端预编译语句
+    
+    每个连接第一次用到某条语句时先 PREPARE，之后只发送 EXECUTE 和参数，
+    Postgres 不再重复解析和规划。PgBouncer 事务模式下同一客户端连接的不同事务
+    可能落在不同的服务端连接上，PREPARE 过的语句不一定存在，此时直接执行 SQL 文本。
+    """
+    
+    def __init__(self, statements):
+        self.statements = statements
+        self._plain = {name: re.sub(r'\$\d+', '%s', sql) for name, (_, sql) in statements.items()}
+        self._lock = threading.Lock()
+        self.prepares = 0
+        self.hits = 0
+        self.unprepared = 0
+    
+    def sql(self, name):
+        """返回语句的 SQL 文本 (psycopg2 参数格式)"""
+        return self._plain[name]
+    
+    def execute(self, cursor, name, params=()):
+        """在游标上执行注册的语句"""
+        prepared = getattr(cursor.connection, 'prepared', None)
+        if prepared is None:
+            with self._lock:
+                self.unprepared += 1
+            cursor.execute(self._plain[name], params)
+            return
+        
+        if name in prepared:
+            with self._lock:
+                self.hits += 1
+        else:
+            # PREPARE 不受事务回滚影响，成功后本连接上一直可用
+            types, sql = self.statements[name]
+            type_list = f" ({', '.join(types)})" if types else ''
+            cursor.execute(f"PREPARE {name}{type_list} AS {sql}")
+            prepared.add(name)
+            with self._lock:
+                self.prepares += 1
+        args = f" ({', '.join(['%s'] * len(params))})" if params else ''
+        cursor.execute(f"EXECUTE {name}{args}", params)
+    
+    def stats(self):
+        """返回预编译语句的使用情况"""
+        with self._lock:
+            total = self.prepares + self.hits
+            return {
+                'registered': len(self.statements),
+                'prepares': self.prepares,
+                'hits': self.hits,
+                'hit_rate': round(self.hits / total, 4) if total else 0.0,
+                'unprepared': self.unprepared,
+            }
+
+statements = StatementRegistry(STATEMENTS)
 
 class handler(BaseHTTPRequestHandler):
+    def handle_one_request(self):
+        """处理单个请求，结束后 (包括提前返回和异常) 归还本次请求借出的连接"""
+        self.conn = None
+        try:
+            super().handle_one_request()
+        finally:
+            if self.conn is not None:
+                release_db_connection(self.conn)
+                self.conn = None
+    
+    def get_connection(self):
+        """为当前请求借出数据库连接，请求结束时自动归还"""
+        self.conn = get_db_connection()
+        return self.conn
+    
     def do_GET(self):
         """处理 GET 请求"""
         parsed_path = urlparse(self.path)
@@ -74,6 +812,12 @@ class handler(BaseHTTPRequestHandler):
         
         if path == '/api/todos' or path == '/api/todos/':
             self.get_todos()
+        elif path == '/api/todos/search' or path == '/api/todos/search/':
+            self.search_todos()
+        elif path == '/api/todos/stats' or path == '/api/todos/stats/':
+            self.get_stats()
+        elif path == '/api/health/ready' or path == '/api/health/ready/':
+            self.readiness_check()
         elif path == '/api/health' or path == '/api/health/':
             self.health_check()
         else:
@@ -86,6 +830,18 @@ class handler(BaseHTTPRequestHandler):
         
         if path == '/api/todos' or path == '/api/todos/':
             self.create_todo()
+        elif path == '/api/todos/batch' or path == '/api/todos/batch/':
+            self.create_todos_batch()
+        else:
+            self.send_error(404, "Not Found")
+    
+    def do_PATCH(self):
+        """处理 PATCH 请求"""
+        parsed_path = urlparse(self.path)
+        path = parsed_path.path
+        
+        if path == '/api/todos/batch' or path == '/api/todos/batch/':
+            self.update_todos_batch()
         else:
             self.send_error(404, "Not Found")
     
@@ -105,7 +861,9 @@ class handler(BaseHTTPRequestHandler):
         parsed_path = urlparse(self.path)
         path = parsed_path.path
         
-        if path.startswith('/api/todos/') and path != '/api/todos/completed' and path != '/api/todos/all':
+        if path == '/api/todos/batch' or path == '/api/todos/batch/':
+            self.delete_todos_batch()
+        elif path.startswith('/api/todos/') and path != '/api/todos/completed' and path != '/api/todos/all':
             todo_id = path.split('/')[-1]
             self.delete_todo(todo_id)
         elif path == '/api/todos/completed' or path == '/api/todos/completed/':
@@ -119,74 +877,211 @@ class handler(BaseHTTPRequestHandler):
         """处理 CORS 预检请求"""
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, PATCH, DELETE, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, If-None-Match')
         self.end_headers()
     
     def get_todos(self):
         """获取任务列表"""
         try:
-            # 初始化数据库
-            init_database()
-            
             # 获取查询参数
             parsed_path = urlparse(self.path)
             query_params = parse_qs(parsed_path.query)
             status = query_params.get('status', ['all'])[0]
+            stream = query_params.get('stream', [None])[0]
+            
+            if stream is not None and stream not in STREAM_MEDIA_TYPES:
+                self.send_error(400, "不支持的流式输出格式")
+                return
             
-            conn = get_db_connection()
+            conn = self.get_connection()
             if not conn:
                 self.send_error(500, "Database connection failed")
                 return
             
-            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            # 先读版本号再读数据：版本号未变化时直接返回 304，不查询 todos 表
+            cursor = conn.cursor()
+            statements.execute(cursor, 'todos_version')
+            version, epoch = cursor.fetchone()
+            cursor.close()
+            view = status if status in ('active', 'completed') else 'all'
+            etag = f'"{epoch}-{version}-{view}-{stream or "list"}"'
+            if etag_matches(self.headers.get('If-None-Match'), etag):
+                conn.commit()
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.send_header('Access-Control-Expose-Headers', 'ETag')
+                self.end_headers()
+                return
             
-            # 构建查询SQL
-            if status == 'active':
-                cursor.execute("SELECT * FROM todos WHERE completed = FALSE ORDER BY created_at DESC")
-            elif status == 'completed':
-                cursor.execute("SELECT * FROM todos WHERE completed = TRUE ORDER BY created_at DESC")
-            else:
-                cursor.execute("SELECT * FROM todos ORDER BY created_at DESC")
+            # 命名游标 (DECLARE) 不能引用预编译语句，流式输出直接使用 SQL 文本
+            if stream:
+                self.stream_todos(conn, statements.sql(f'list_{view}'), stream, etag)
+                return
             
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            statements.execute(cursor, f'list_{view}')
             todos = cursor.fetchall()
             
             # 转换为字典列表
-            todos_list = []
-            for todo in todos:
-                todos_list.append({
-                    'id': todo['id'],
-                    'title': todo['title'],
-                    'completed': todo['completed'],
-                    'created_at': todo['created_at'].isoformat(),
-                    'updated_at': todo['updated_at'].isoformat()
-                })
+            todos_list = [todo_to_dict(todo) for todo in todos]
             
             cursor.close()
-            conn.close()
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
             self.send_header('Access-Control-Allow-Origin', '*')
-            self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
-            self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+            self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, PATCH, DELETE, OPTIONS')
+            self.send_header('Access-Control-Allow-Headers', 'Content-Type, If-None-Match')
+            self.send_header('Access-Control-Expose-Headers', 'ETag')
             self.end_headers()
             self.wfile.write(json.dumps(todos_list).encode())
             
         except Exception as e:
             self.send_error(500, str(e))
     
+    def get_stats(self):
+        """获取任务数量统计，读取触发器维护的 todo_stats，带与列表相同的版本号 ETag"""
+        try:
+            conn = self.get_connection()
+            if not conn:
+                self.send_error(500, "Database connection failed")
+                return
+            
+            cursor = conn.cursor()
+            statements.execute(cursor, 'todo_stats')
+            version, epoch, total, completed = cursor.fetchone()
+            cursor.close()
+            conn.commit()
+            
+            etag = f'"{epoch}-{version}-stats"'
+            if etag_matches(self.headers.get('If-None-Match'), etag):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.send_header('Access-Control-Expose-Headers', 'ETag')
+                self.end_headers()
+                return
+            
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Access-Control-Expose-Headers', 'ETag')
+            self.end_headers()
+            self.wfile.write(json.dumps({
+                "total": total, "active": total - completed, "completed": completed
+            }).encode())
+            
+        except Exception as e:
+            self.send_error(500, str(e))
+    
+    def search_todos(self):
+        """按标题搜索任务，按相关度排序，还有下一页时通过 X-Next-Offset 返回下一页的 offset"""
+        try:
+            query_params = parse_qs(urlparse(self.path).query)
+            q = query_params.get('q', [''])[0]
+            status = query_params.get('status', ['all'])[0]
+            try:
+                limit = int(query_params.get('limit', ['20'])[0])
+                offset = int(query_params.get('offset', ['0'])[0])
+            except ValueError:
+                self.send_error(400, "limit and offset must be integers")
+                return
+            
+            terms = list(dict.fromkeys(term.lower() for term in q.split()))
+            if not terms or len(q) > 255:
+                self.send_error(400, "q must be 1-255 characters")
+                return
+            if not 1 <= limit <= 100 or not 0 <= offset <= 10000:
+                self.send_error(400, "limit must be 1-100 and offset 0-10000")
+                return
+            
+            # 只有标点等无法索引的字符时不会匹配任何任务
+            todos_list = []
+            tsquery = search_tsquery(terms)
+            if tsquery:
+                conn = self.get_connection()
+                if not conn:
+                    self.send_error(500, "Database connection failed")
+                    return
+                completed = {'active': False, 'completed': True}.get(status)
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                # 多取一条用于判断是否还有下一页
+                statements.execute(cursor, 'search_todos',
+                                   (tsquery, completed, completed, terms, limit + 1, offset))
+                todos_list = [todo_to_dict(todo) for todo in cursor.fetchall()]
+                cursor.close()
+            
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            if len(todos_list) > limit:
+                todos_list = todos_list[:limit]
+                self.send_header('X-Next-Offset', str(offset + limit))
+                self.send_header('Access-Control-Expose-Headers', 'X-Next-Offset')
+            self.end_headers()
+            self.wfile.write(json.dumps(todos_list).encode())
+            
+        except Exception as e:
+            self.send_error(500, str(e))
+    
+    def stream_todos(self, conn, query, fmt, etag):
+        """
+        通过服务端命名游标逐批读取并写出任务列表
+        
+        命名游标让 Postgres 只在每次 fetchmany 时传输一批数据，
+        内存占用和首字节时间都与结果集大小无关。
+        """
+        cursor = conn.cursor(name='todos_stream', cursor_factory=RealDictCursor)
+        cursor.itersize = STREAM_BATCH_SIZE
+        cursor.execute(query)
+        
+        self.send_response(200)
+        self.send_header('Content-type', STREAM_MEDIA_TYPES[fmt])
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, PATCH, DELETE, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, If-None-Match')
+        self.send_header('Access-Control-Expose-Headers', 'ETag')
+        self.end_headers()
+        
+        first = True
+        if fmt == 'json':
+            self.wfile.write(b'[')
+        while True:
+            rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+            if not rows:
+                break
+            items = [json.dumps(todo_to_dict(row)) for row in rows]
+            if fmt == 'ndjson':
+                chunk = '\n'.join(items) + '\n'
+            else:
+                chunk = ('' if first else ',') + ','.join(items)
+            self.wfile.write(chunk.encode())
+            self.wfile.flush()
+            first = False
+        if fmt == 'json':
+            self.wfile.write(b']')
+        
+        cursor.close()
+        conn.commit()
+    
     def create_todo(self):
         """创建任务"""
         try:
-            # 初始化数据库
-            init_database()
-            
             content_length = int(self.headers['Content-Length'])
             post_data = self.rfile.read(content_length)
             todo_data = json.loads(post_data.decode('utf-8'))
             
-            conn = get_db_connection()
+            conn = self.get_connection()
             if not conn:
                 self.send_error(500, "Database connection failed")
                 return
@@ -194,11 +1089,7 @@ class handler(BaseHTTPRequestHandler):
             cursor = conn.cursor()
             
             # 插入新任务
-            cursor.execute("""
-                INSERT INTO todos (title, completed) 
-                VALUES (%s, %s) 
-                RETURNING id, title, completed, created_at, updated_at
-            """, (todo_data['title'], todo_data.get('completed', False)))
+            statements.execute(cursor, 'create_todo', (todo_data['title'], todo_data.get('completed', False)))
             
             result = cursor.fetchone()
             todo = {
@@ -211,7 +1102,6 @@ class handler(BaseHTTPRequestHandler):
             
             conn.commit()
             cursor.close()
-            conn.close()
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -222,44 +1112,159 @@ class handler(BaseHTTPRequestHandler):
         except Exception as e:
             self.send_error(500, str(e))
     
-    def update_todo(self, todo_id):
-        """更新任务"""
+    def read_batch(self, update):
+        """读取并校验批量创建/更新的请求体，校验失败时返回 None (已发送 400)"""
+        content_length = int(self.headers['Content-Length'])
+        post_data = self.rfile.read(content_length)
         try:
-            # 初始化数据库
-            init_database()
+            items = json.loads(post_data.decode('utf-8'))
+        except ValueError:
+            self.send_error(400, "request body must be valid JSON")
+            return None
+        
+        if not isinstance(items, list) or not items:
+            self.send_error(400, "batch must be a non-empty array")
+            return None
+        if len(items) > MAX_BATCH_SIZE:
+            self.send_error(400, f"batch is limited to {MAX_BATCH_SIZE} items")
+            return None
+        for index, item in enumerate(items):
+            error = batch_item_error(index, item, update)
+            if error:
+                self.send_error(400, error)
+                return None
+        return items
+    
+    def send_json(self, data):
+        """发送 JSON 响应"""
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(json.dumps(data).encode())
+    
+    def create_todos_batch(self):
+        """批量创建任务 (单个事务)"""
+        try:
+            todos = self.read_batch(update=False)
+            if todos is None:
+                return
             
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            update_data = json.loads(post_data.decode('utf-8'))
+            conn = self.get_connection()
+            if not conn:
+                self.send_error(500, "Database connection failed")
+                return
             
-            conn = get_db_connection()
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            rows = execute_values(cursor, """
+                INSERT INTO todos (title, completed)
+                VALUES %s
+                RETURNING id, title, completed, created_at, updated_at
+            """, [(todo['title'], bool(todo.get('completed'))) for todo in todos],
+                page_size=MAX_BATCH_SIZE, fetch=True)
+            conn.commit()
+            cursor.close()
+            
+            self.send_json([todo_to_dict(row) for row in sorted(rows, key=lambda row: row['id'])])
+            
+        except Exception as e:
+            self.send_error(500, str(e))
+    
+    def update_todos_batch(self):
+        """批量更新任务 (单个事务)，任一任务不存在时整体回滚"""
+        try:
+            updates = self.read_batch(update=True)
+            if updates is None:
+                return
+            
+            conn = self.get_connection()
             if not conn:
                 self.send_error(500, "Database connection failed")
                 return
             
             cursor = conn.cursor(cursor_factory=RealDictCursor)
+            # 未提供的字段通过 COALESCE 保留原值，整批只执行一条 UPDATE ... FROM (VALUES ...)
+            rows = execute_values(cursor, """
+                UPDATE todos AS t
+                SET title = COALESCE(v.title, t.title),
+                    completed = COALESCE(v.completed, t.completed),
+                    updated_at = NOW()
+                FROM (VALUES %s) AS v(id, title, completed)
+                WHERE t.id = v.id
+                RETURNING t.id, t.title, t.completed, t.created_at, t.updated_at
+            """, [(u['id'], u.get('title'), u.get('completed')) for u in updates],
+                template='(%s::integer, %s::varchar, %s::boolean)',
+                page_size=MAX_BATCH_SIZE, fetch=True)
             
-            # 构建更新SQL
-            set_clauses = []
-            params = []
+            by_id = {row['id']: row for row in rows}
+            missing = [u['id'] for u in updates if u['id'] not in by_id]
+            if missing:
+                conn.rollback()
+                self.send_error(404, f"todos not found: {missing}")
+                return
             
-            if 'title' in update_data:
-                set_clauses.append("title = %s")
-                params.append(update_data['title'])
+            conn.commit()
+            cursor.close()
             
-            if 'completed' in update_data:
-                set_clauses.append("completed = %s")
-                params.append(update_data['completed'])
+            self.send_json([todo_to_dict(by_id[u['id']]) for u in updates])
             
-            set_clauses.append("updated_at = NOW()")
-            params.append(todo_id)
+        except Exception as e:
+            self.send_error(500, str(e))
+    
+    def delete_todos_batch(self):
+        """批量删除指定ID的任务 (单个事务)，不存在的ID会被忽略"""
+        try:
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            try:
+                body = json.loads(post_data.decode('utf-8'))
+            except ValueError:
+                self.send_error(400, "request body must be valid JSON")
+                return
+            ids = body.get('ids') if isinstance(body, dict) else None
             
-            cursor.execute(f"""
-                UPDATE todos 
-                SET {', '.join(set_clauses)}
-                WHERE id = %s
-                RETURNING id, title, completed, created_at, updated_at
-            """, params)
+            if not isinstance(ids, list) or not ids:
+                self.send_error(400, "ids must be a non-empty array")
+                return
+            if len(ids) > MAX_BATCH_SIZE:
+                self.send_error(400, f"batch is limited to {MAX_BATCH_SIZE} items")
+                return
+            invalid = next((index for index, todo_id in enumerate(ids) if not is_todo_id(todo_id)), None)
+            if invalid is not None:
+                self.send_error(400, f"ids[{invalid}]: id must be a positive integer")
+                return
+            
+            conn = self.get_connection()
+            if not conn:
+                self.send_error(500, "Database connection failed")
+                return
+            
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM todos WHERE id = ANY(%s)", (ids,))
+            deleted_count = cursor.rowcount
+            conn.commit()
+            cursor.close()
+            
+            self.send_json({"message": f"已删除{deleted_count}个任务"})
+            
+        except Exception as e:
+            self.send_error(500, str(e))
+    
+    def update_todo(self, todo_id):
+        """更新任务"""
+        try:
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            update_data = json.loads(post_data.decode('utf-8'))
+            
+            conn = self.get_connection()
+            if not conn:
+                self.send_error(500, "Database connection failed")
+                return
+            
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            statements.execute(cursor, 'update_todo',
+                               (update_data.get('title'), update_data.get('completed'), todo_id))
             
             result = cursor.fetchone()
             if not result:
@@ -276,7 +1281,6 @@ class handler(BaseHTTPRequestHandler):
             
             conn.commit()
             cursor.close()
-            conn.close()
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -290,10 +1294,7 @@ class handler(BaseHTTPRequestHandler):
     def delete_todo(self, todo_id):
         """删除任务"""
         try:
-            # 初始化数据库
-            init_database()
-            
-            conn = get_db_connection()
+            conn = self.get_connection()
             if not conn:
                 self.send_error(500, "Database connection failed")
                 return
@@ -301,7 +1302,7 @@ class handler(BaseHTTPRequestHandler):
             cursor = conn.cursor()
             
             # 删除任务
-            cursor.execute("DELETE FROM todos WHERE id = %s", (todo_id,))
+            statements.execute(cursor, 'delete_todo', (todo_id,))
             
             if cursor.rowcount == 0:
                 self.send_error(404, "任务不存在")
@@ -309,7 +1310,6 @@ class handler(BaseHTTPRequestHandler):
             
             conn.commit()
             cursor.close()
-            conn.close()
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -323,10 +1323,7 @@ class handler(BaseHTTPRequestHandler):
     def delete_completed_todos(self):
         """批量删除已完成任务"""
         try:
-            # 初始化数据库
-            init_database()
-            
-            conn = get_db_connection()
+            conn = self.get_connection()
             if not conn:
                 self.send_error(500, "Database connection failed")
                 return
@@ -339,7 +1336,6 @@ class handler(BaseHTTPRequestHandler):
             
             conn.commit()
             cursor.close()
-            conn.close()
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -353,26 +1349,19 @@ class handler(BaseHTTPRequestHandler):
     def delete_all_todos(self):
         """清空所有任务"""
         try:
-            # 初始化数据库
-            init_database()
-            
-            conn = get_db_connection()
+            conn = self.get_connection()
             if not conn:
                 self.send_error(500, "Database connection failed")
                 return
             
             cursor = conn.cursor()
             
-            # 获取任务数量
-            cursor.execute("SELECT COUNT(*) FROM todos")
-            count = cursor.fetchone()[0]
-            
-            # 清空所有任务
+            # 清空所有任务，删除数量直接取影响行数
             cursor.execute("DELETE FROM todos")
+            count = cursor.rowcount
             
             conn.commit()
             cursor.close()
-            conn.close()
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -389,4 +1378,19 @@ class handler(BaseHTTPRequestHandler):
         self.send_header('Content-type', 'application/json')
         self.send_header('Access-Control-Allow-Origin', '*')
         self.end_headers()
-        self.wfile.write(json.dumps({"status": "healthy", "message": "服务运行正常"}).encode())
+        self.wfile.write(json.dumps({
+            "status": "healthy",
+            "message": "服务运行正常",
+            "statements": statements.stats(),
+        }).encode())
+    
+    def readiness_check(self):
+        """就绪检查：实际访问一次数据库，未就绪时返回 503 (结果短时缓存)"""
+        ready, result = check_readiness()
+        
+        self.send_response(200 if ready else 503)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(json.dumps(result).encode())
\ No newline at end of file
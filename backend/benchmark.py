@@ -0,0 +1,1235 @@
+"""
+Todo API 性能测试脚本
+
+在进程内通过 httpx.ASGITransport 直接驱动 main.app，不需要启动服务器，
+每次运行都使用临时数据库文件，不会影响 todos.db。
+
+用法:
+    pip install httpx
+    python benchmark.py load                 # 固定速率混合读写，输出各类请求的 p50/p95/p99
+    python benchmark.py load --compare       # 对比: 事件循环线程内直接查询 vs 数据库线程池
+    python benchmark.py engines              # 各存储引擎跑相同的一致性检查和基准负载
+    POSTGRES_URL=... python benchmark.py engines   # 同时包含 Postgres 引擎
+    python benchmark.py memory-store         # api/todos.py 的索引内存存储 vs 原来的列表实现
+    python benchmark.py poll                 # 轮询: 每次都拉全量 vs If-None-Match 条件请求
+    python benchmark.py events               # 事件总线向大量空闲订阅者扇出的延迟
+    POSTGRES_URL=... python benchmark.py pg-cold-start   # api/todos_postgres.py 冷启动 vs 热启动请求延迟
+    python benchmark.py serialize            # 整表列表: Pydantic 校验+编码 vs FAST_JSON 快速路径
+    python benchmark.py mutations            # SQLite 单条写入: 先查后写 vs RETURNING 的语句数和延迟
+    python benchmark.py search               # 标题搜索: FTS5 trigram 全文索引 vs LIKE '%q%' (默认一百万行)
+    python benchmark.py metrics              # 请求指标中间件的开销: 单次调用耗时和端到端延迟/吞吐 (开/关对比)
+    python benchmark.py suite --output a.json          # 1k/10k/100k 行 x 读多/混合/写多负载 + 存储层微基准，结果存为 JSON
+    python benchmark.py suite --rows 1000000 --output b.json   # 一百万行
+    python benchmark.py compare a.json b.json          # 对比两次结果，有退化时退出码为 1
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+def percentile(values, pct):
+    """计算百分位数 (最近秩法)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+def summarize(latencies):
+    """汇总延迟数据 (毫秒)"""
+    return {
+        "count": len(latencies),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 3) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3) if latencies else 0.0,
+    }
+
+def setup_app(db_path):
+    """指向临时数据库并导入应用"""
+    os.environ["DB_PATH"] = db_path
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from database import init_database
+    from main import app
+    init_database()
+    return app
+
+def hold_write_lock(db_path, hold_ms, interval_ms, stop):
+    """
+    模拟慢写入: 周期性地在独立连接上持有写锁 hold_ms 毫秒
+
+    期间其他写请求会在 SQLite 的忙等待中阻塞；如果查询在事件循环线程中执行，
+    这段阻塞会拖住所有并发请求。
+    """
+    import sqlite3
+
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    while not stop.is_set():
+        conn.execute("BEGIN IMMEDIATE")
+        time.sleep(hold_ms / 1000)
+        conn.execute("COMMIT")
+        stop.wait(interval_ms / 1000)
+    conn.close()
+
+async def run_load(args):
+    """按固定速率发出混合读写请求 (开环模型，延迟从计划发出时间算起)"""
+    import threading
+    import httpx
+
+    db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    app = setup_app(db_path)
+    transport = httpx.ASGITransport(app=app)
+    latencies = {"read": [], "write": []}
+    rng = random.Random(args.seed)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        # 预置数据
+        for start in range(0, args.seed_rows, 1000):
+            size = min(1000, args.seed_rows - start)
+            await client.post("/api/v1/todos/batch", json=[
+                {"title": f"任务{start + i}", "completed": (start + i) % 3 == 0} for i in range(size)
+            ])
+
+        kinds = ["write" if rng.random() < args.write_ratio else "read" for _ in range(args.requests)]
+
+        async def fire(kind, scheduled):
+            if kind == "read":
+                status = rng.choice(["all", "active", "completed"])
+                await client.get("/api/v1/todos/", params={"status": status, "limit": 50})
+            else:
+                todo_id = rng.randint(1, max(1, args.seed_rows))
+                await client.put(f"/api/v1/todos/{todo_id}", json={"completed": rng.random() < 0.5})
+            latencies[kind].append(time.perf_counter() - scheduled)
+
+        stop = threading.Event()
+        if args.slow_write_ms > 0:
+            threading.Thread(
+                target=hold_write_lock,
+                args=(db_path, args.slow_write_ms, args.slow_write_interval_ms, stop),
+                daemon=True,
+            ).start()
+
+        tasks = []
+        started = time.perf_counter()
+        for i, kind in enumerate(kinds):
+            scheduled = started + i / args.rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(fire(kind, scheduled)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+        stop.set()
+
+    return {
+        "mode": "inline" if os.environ.get("DB_EXECUTOR_WORKERS") == "0" else "executor",
+        "rate": args.rate,
+        "requests": args.requests,
+        "slow_write_ms": args.slow_write_ms,
+        "throughput_rps": round(args.requests / elapsed, 1),
+        "read": summarize(latencies["read"]),
+        "write": summarize(latencies["write"]),
+        "all": summarize(latencies["read"] + latencies["write"]),
+    }
+
+def print_report(result):
+    """打印单次测试结果"""
+    print(f"\n[{result['mode']}] 目标 {result['rate']} req/s，共 {result['requests']} 个请求，"
+          f"慢写入 {result['slow_write_ms']}ms，实际吞吐 {result['throughput_rps']} req/s")
+    for kind in ("read", "write", "all"):
+        stats = result[kind]
+        print(f"  {kind:<5} n={stats['count']:<6} p50={stats['p50_ms']:>8.2f}ms "
+              f"p95={stats['p95_ms']:>8.2f}ms p99={stats['p99_ms']:>8.2f}ms max={stats['max_ms']:>8.2f}ms")
+
+def cmd_load(args):
+    """load 子命令"""
+    if not args.compare:
+        result = asyncio.run(run_load(args))
+        if args.json:
+            print(json.dumps(result, ensure_ascii=False))
+        else:
+            print_report(result)
+        return
+
+    # 每种模式在独立进程中运行，避免模块级配置互相影响
+    argv = [sys.executable, os.path.abspath(__file__), "load", "--json",
+            "--rate", str(args.rate), "--requests", str(args.requests),
+            "--write-ratio", str(args.write_ratio), "--seed-rows", str(args.seed_rows),
+            "--seed", str(args.seed), "--slow-write-ms", str(args.slow_write_ms),
+            "--slow-write-interval-ms", str(args.slow_write_interval_ms)]
+    for workers in ("0", None):
+        env = dict(os.environ)
+        env.pop("DB_EXECUTOR_WORKERS", None)
+        if workers is not None:
+            env["DB_EXECUTOR_WORKERS"] = workers
+        output = subprocess.check_output(argv, env=env, text=True)
+        print_report(json.loads(output.strip().splitlines()[-1]))
+
+async def run_poll(args):
+    """模拟客户端轮询列表，统计传输字节数、数据库查询次数和延迟"""
+    import httpx
+    from repository import get_repository
+
+    app = setup_app(os.path.join(tempfile.mkdtemp(), "poll.db"))
+    repo = get_repository()
+    queries = {"count": 0}
+    original_list = repo.list
+
+    def counting_list(*list_args, **list_kwargs):
+        queries["count"] += 1
+        return original_list(*list_args, **list_kwargs)
+
+    repo.list = counting_list
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for start in range(0, args.rows, 1000):
+            size = min(1000, args.rows - start)
+            await client.post("/api/v1/todos/batch", json=[
+                {"title": f"任务{start + i}", "completed": (start + i) % 3 == 0} for i in range(size)
+            ])
+
+        for mode in ("full", "etag"):
+            rng = random.Random(args.seed)
+            etags = {}
+            transferred = 0
+            not_modified = 0
+            latencies = []
+            queries["count"] = 0
+            for i in range(args.polls):
+                if i % args.write_every == 0:
+                    await client.put(f"/api/v1/todos/{rng.randint(1, args.rows)}",
+                                     json={"title": f"修改{i}"})
+                client_id = rng.randrange(args.clients)
+                # full 模式关闭列表缓存，模拟原来每次轮询都查库并重新序列化
+                headers = {"Cache-Control": "no-cache"}
+                if mode == "etag" and client_id in etags:
+                    headers = {"If-None-Match": etags[client_id]}
+                started = time.perf_counter()
+                response = await client.get("/api/v1/todos/", headers=headers)
+                latencies.append(time.perf_counter() - started)
+                transferred += len(response.content)
+                not_modified += response.status_code == 304
+                etags[client_id] = response.headers["etag"]
+            results[mode] = {
+                "bytes": transferred,
+                "db_queries": queries["count"],
+                "not_modified": not_modified,
+                "latency": summarize(latencies),
+            }
+    return results
+
+def cmd_poll(args):
+    """poll 子命令"""
+    results = asyncio.run(run_poll(args))
+    print(f"\n{args.rows} 个任务，{args.clients} 个客户端共轮询 {args.polls} 次，每 {args.write_every} 次轮询有一次写入")
+    for mode, result in results.items():
+        stats = result["latency"]
+        print(f"  {mode:<5} 传输 {result['bytes'] / 1024 / 1024:>8.2f} MiB  查库 {result['db_queries']:>5} 次  "
+              f"304 {result['not_modified']:>5} 次  p50={stats['p50_ms']:>8.2f}ms p99={stats['p99_ms']:>8.2f}ms")
+
+async def run_fanout(subscribers, events, stalled_ratio, queue_size, interval_ms):
+    """向 subscribers 个订阅者发布 events 条事件，其中一部分订阅者从不读取"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from events import EventBus
+
+    bus = EventBus(history_size=1000, max_pending=queue_size)
+    received = []
+    remaining = {"count": 0}
+    done = asyncio.Event()
+
+    async def consume(subscription):
+        # 与 SSE 连接相同的读取方式，只是不写 socket
+        while True:
+            batch = await subscription.next_batch(60)
+            now = time.perf_counter()
+            for event in batch:
+                received.append(now - published_at[event.seq])
+                remaining["count"] -= 1
+            "".join(event.text for event in batch)
+            if remaining["count"] <= 0:
+                done.set()
+
+    stalled = int(subscribers * stalled_ratio)
+    tasks = []
+    for i in range(subscribers):
+        subscription = bus.subscribe()
+        if i >= stalled:
+            tasks.append(asyncio.create_task(consume(subscription)))
+    await asyncio.sleep(0)
+
+    published_at = {}
+    publish_costs = []
+    remaining["count"] = (subscribers - stalled) * events
+    for i in range(events):
+        started = time.perf_counter()
+        event = bus.publish("updated", {"id": i, "title": f"任务{i}", "completed": False,
+                                        "created_at": "2024-01-01 00:00:00", "updated_at": "2024-01-01 00:00:00"})
+        published_at[event.seq] = started
+        publish_costs.append(time.perf_counter() - started)
+        # 模拟写请求之间的间隔
+        await asyncio.sleep(interval_ms / 1000)
+    await asyncio.wait_for(done.wait(), 60)
+    for task in tasks:
+        task.cancel()
+    return {
+        "subscribers": subscribers,
+        "stalled": stalled,
+        "lagged": bus.lagged,
+        "publish": summarize(publish_costs),
+        "delivery": summarize(received),
+    }
+
+def cmd_events(args):
+    """events 子命令"""
+    for subscribers in args.subscribers:
+        result = asyncio.run(run_fanout(subscribers, args.events, args.stalled, args.queue_size,
+                                          args.interval_ms))
+        publish, delivery = result["publish"], result["delivery"]
+        print(f"\n{subscribers} 个订阅者 ({result['stalled']} 个不读取，{result['lagged']} 个因积压被断开)，"
+              f"发布 {args.events} 条事件")
+        print(f"  publish  p50={publish['p50_ms']:>8.3f}ms p99={publish['p99_ms']:>8.3f}ms")
+        print(f"  delivery p50={delivery['p50_ms']:>8.3f}ms p95={delivery['p95_ms']:>8.3f}ms "
+              f"p99={delivery['p99_ms']:>8.3f}ms max={delivery['max_ms']:>8.3f}ms")
+
+def make_engines(tmpdir):
+    """构造参与对比的存储引擎，Postgres 仅在设置了 POSTGRES_URL 时加入"""
+    os.environ["DB_PATH"] = os.path.join(tmpdir, "engines.db")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import repository
+    from database import init_database
+
+    engines = {}
+
+    init_database()
+    engines["sqlite"] = repository.SqliteTodoRepository()
+
+    engines["memory"] = repository.MemoryTodoRepository()
+    engines["kv"] = repository.KVTodoRepository()
+
+    if os.environ.get("POSTGRES_URL"):
+        engines["postgres"] = repository.PostgresTodoRepository(os.environ["POSTGRES_URL"])
+    return engines
+
+def conformance_workload(repo):
+    """
+    对一个引擎执行固定的操作序列，返回去掉时间戳后的可比较结果
+
+    所有引擎在同样的输入下必须得到完全相同的结果。
+    """
+    from repository import TodoNotFoundError
+
+    def strip(todo):
+        return None if todo is None else (todo["id"], todo["title"], todo["completed"])
+
+    def walk(status, page_size):
+        # 逐页翻完整个列表
+        ids, after = [], None
+        while True:
+            page = repo.list(status, page_size, after)
+            ids.extend(todo["id"] for todo in page)
+            if len(page) < page_size:
+                return ids
+            after = (page[-1]["created_at"], page[-1]["id"])
+
+    out = []
+    repo.delete_all()
+    # 同步版本号只比较相对于开始时的增量
+    base = repo.changes(0)["version"]
+    out.append(("create", strip(repo.create("第一个任务"))))
+    out.append(("create_many", [strip(t) for t in repo.create_many(
+        [(f"任务{i}", i % 3 == 0) for i in range(25)])]))
+    out.append(("get", strip(repo.get(2)), strip(repo.get(999))))
+    out.append(("update", strip(repo.update(3, completed=True)), strip(repo.update(999, title="x"))))
+    out.append(("update_many", [strip(t) for t in repo.update_many(
+        [(4, "改名", None), (5, None, True), (2, "再改", False)])]))
+    try:
+        repo.update_many([(6, "不应生效", True), (999, "x", None)])
+        out.append(("update_many_missing", "no error"))
+    except TodoNotFoundError as e:
+        out.append(("update_many_missing", e.ids, strip(repo.get(6))))
+    out.append(("stats", repo.stats()))
+    out.append(("search", sorted(t["id"] for t in repo.search("任务1", limit=100)),
+                sorted(t["id"] for t in repo.search("务2", "completed", limit=100))))
+    for status in (None, "active", "completed"):
+        out.append(("list", status, [strip(t) for t in repo.list(status)]))
+        out.append(("walk", status, walk(status, 4)))
+        out.append(("iter", status, [t["id"] for t in repo.iter(status, limit=7, batch_size=3)]))
+    out.append(("delete", repo.delete(7), repo.delete(7)))
+    out.append(("delete_many", repo.delete_many([8, 9, 999])))
+    out.append(("delete_completed", repo.delete_completed()))
+    # 同一批写入中各行的版本号先后由引擎决定，只比较两页合起来的内容
+    page = repo.changes(base + 20, 5)
+    rest = repo.changes(page["version"])
+    out.append(("changes", page["version"] - base, page["has_more"], rest["version"] - base, rest["has_more"],
+                len(page["upserts"]) + len(page["deleted"]),
+                sorted(strip(t) for t in page["upserts"] + rest["upserts"]),
+                sorted(page["deleted"] + rest["deleted"])))
+    stale = repo.changes(10 ** 9)
+    out.append(("changes_reset", stale["reset"], sorted(t["id"] for t in stale["upserts"]), stale["deleted"]))
+    out.append(("after_delete", [strip(t) for t in repo.list()], repo.stats()))
+    out.append(("delete_all", repo.delete_all(), repo.list(), repo.stats()))
+    return out
+
+def benchmark_workload(repo, rows, rng):
+    """对一个引擎执行相同的基准负载，返回各操作的耗时 (毫秒)"""
+    timings = {}
+
+    def timed(name, func):
+        started = time.perf_counter()
+        result = func()
+        timings[name] = round((time.perf_counter() - started) * 1000, 3)
+        return result
+
+    repo.delete_all()
+    created = timed("create_many", lambda: [todo for start in range(0, rows, 1000) for todo in repo.create_many(
+        [(f"任务{i}", i % 3 == 0) for i in range(start, min(rows, start + 1000))])])
+    ids = [todo["id"] for todo in created]
+    sample = [rng.choice(ids) for _ in range(200)]
+    timed("get x200", lambda: [repo.get(todo_id) for todo_id in sample])
+    timed("update x200", lambda: [repo.update(todo_id, completed=True) for todo_id in sample])
+    timed("update_many x200", lambda: repo.update_many([(todo_id, None, False) for todo_id in sample]))
+    timed("list page x50", lambda: [repo.list(rng.choice([None, "active", "completed"]), 50)
+                                    for _ in range(50)])
+    timed("list all", lambda: repo.list())
+    timed("delete x200", lambda: [repo.delete(todo_id) for todo_id in sample])
+    timed("delete_completed", repo.delete_completed)
+    timed("delete_all", repo.delete_all)
+    return timings
+
+def cmd_engines(args):
+    """engines 子命令"""
+    engines = make_engines(tempfile.mkdtemp())
+
+    results = {name: conformance_workload(repo) for name, repo in engines.items()}
+    reference_name = "memory"
+    failed = False
+    for name, result in results.items():
+        mismatches = [step for step, ref in zip(result, results[reference_name]) if step != ref]
+        if len(result) != len(results[reference_name]):
+            mismatches.append("步骤数量不同")
+        failed = failed or bool(mismatches)
+        print(f"一致性 {name:<9} {'通过' if not mismatches else '失败'}")
+        for step in mismatches[:5]:
+            print(f"    不一致: {step}")
+
+    timings = {name: benchmark_workload(repo, args.rows, random.Random(args.seed))
+               for name, repo in engines.items()}
+    names = list(timings)
+    print(f"\n基准 ({args.rows} 个任务，毫秒)")
+    print(f"  {'操作':<20}" + "".join(f"{name:>12}" for name in names))
+    for op in timings[names[0]]:
+        print(f"  {op:<20}" + "".join(f"{timings[name][op]:>12.2f}" for name in names))
+
+    if args.json:
+        print(json.dumps({"rows": args.rows, "timings": timings}, ensure_ascii=False))
+    if failed:
+        sys.exit(1)
+
+class ListStore:
+    """api/todos.py 原来的实现: 普通列表，线性查找、重建列表、每次查询重新排序"""
+
+    def __init__(self):
+        self.todos = []
+        self.next_id = 1
+
+    def list(self, status='all'):
+        todos = self.todos.copy()
+        if status == 'active':
+            todos = [todo for todo in todos if not todo['completed']]
+        elif status == 'completed':
+            todos = [todo for todo in todos if todo['completed']]
+        todos.sort(key=lambda x: x['created_at'], reverse=True)
+        return todos
+
+    def create(self, title, completed=False):
+        from datetime import datetime
+        now = datetime.now().isoformat()
+        todo = {'id': self.next_id, 'title': title, 'completed': completed,
+                'created_at': now, 'updated_at': now}
+        self.next_id += 1
+        self.todos.append(todo)
+        return todo
+
+    def update(self, todo_id, update_data):
+        for todo in self.todos:
+            if todo['id'] == todo_id:
+                todo.update(update_data)
+                return todo
+        return None
+
+    def delete(self, todo_id):
+        original_length = len(self.todos)
+        self.todos = [todo for todo in self.todos if todo['id'] != todo_id]
+        return len(self.todos) != original_length
+
+def load_api_module(name):
+    """按文件路径导入 api/ 下的模块"""
+    import importlib.util
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api", f"{name}.py")
+    spec = importlib.util.spec_from_file_location(f"api_{name}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def cmd_memory_store(args):
+    """memory-store 子命令"""
+    todos_api = load_api_module("todos")
+    rng = random.Random(args.seed)
+    stores = {"list (原实现)": ListStore, "TodoStore": todos_api.TodoStore}
+
+    for size in args.sizes:
+        print(f"\n{size} 个任务 (毫秒/次)")
+        ids = list(range(1, size + 1))
+        update_ids = [rng.choice(ids) for _ in range(args.ops)]
+        delete_ids = rng.sample(ids, args.ops)
+        for name, store_class in stores.items():
+            store = store_class()
+            for i in range(size):
+                store.create(f"任务{i}", i % 3 == 0)
+
+            def per_op(func, items):
+                started = time.perf_counter()
+                for item in items:
+                    func(item)
+                return (time.perf_counter() - started) * 1000 / len(items)
+
+            update = per_op(lambda todo_id: store.update(todo_id, {"completed": True}), update_ids)
+            listing = per_op(store.list, ["active", "completed", "all"])
+            delete = per_op(store.delete, delete_ids)
+            print(f"  {name:<14} update={update:>10.4f} list={listing:>10.2f} delete={delete:>10.4f}")
+
+def serve_api_handler(module):
+    """在后台线程中用 api/ 模块的 handler 启动 HTTP 服务，返回 server"""
+    import threading
+    from http.server import ThreadingHTTPServer
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), module.handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def timed_get(port, path):
+    """发出一个 GET 请求并返回耗时 (秒)"""
+    import http.client
+
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    start = time.perf_counter()
+    conn.request("GET", path)
+    response = conn.getresponse()
+    response.read()
+    elapsed = time.perf_counter() - start
+    conn.close()
+    if response.status != 200:
+        raise RuntimeError(f"GET {path} 返回 {response.status}")
+    return elapsed
+
+def cmd_pg_cold_start(args):
+    """pg-cold-start 子命令"""
+    import contextlib
+    import io
+
+    if not os.environ.get("POSTGRES_URL"):
+        sys.exit("需要设置 POSTGRES_URL")
+
+    latencies = {"cold": [], "warm": [], "schema check every request": []}
+    # handler 的连接日志和访问日志不计入输出
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        for _ in range(args.cold_starts):
+            # 每轮重新导入模块，相当于一个新的函数实例
+            module = load_api_module("todos_postgres")
+            server = serve_api_handler(module)
+            port = server.server_port
+            latencies["cold"].append(timed_get(port, "/api/todos?status=active"))
+            for _ in range(args.warm):
+                latencies["warm"].append(timed_get(port, "/api/todos?status=active"))
+            # 对照组: 每个请求都重新检查表结构 (接近旧实现的开销下限)
+            for _ in range(args.warm):
+                module._schema_ready = False
+                latencies["schema check every request"].append(timed_get(port, "/api/todos?status=active"))
+            server.shutdown()
+            server.server_close()
+
+    print(f"\n{args.cold_starts} 次冷启动，每次之后 {args.warm} 个热请求")
+    for name, values in latencies.items():
+        stats = summarize(values)
+        print(f"  {name:<28} p50={stats['p50_ms']:>8.2f}ms p95={stats['p95_ms']:>8.2f}ms "
+              f"p99={stats['p99_ms']:>8.2f}ms")
+
+async def run_serialize(args):
+    """同一份数据分别经 Pydantic 和快速路径输出整个列表，比较延迟和吞吐"""
+    import httpx
+
+    app = setup_app(os.path.join(tempfile.mkdtemp(), "serialize.db"))
+    import routers.todos
+    import serialization
+    from repository import get_repository
+
+    repo = get_repository()
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for rows in sorted(args.rows):
+            existing = len(repo.list())
+            for start in range(existing, rows, 1000):
+                repo.create_many([(f"任务{i}", i % 3 == 0) for i in range(start, min(rows, start + 1000))])
+            bodies = {}
+            for mode, fast in (("pydantic", False), ("fast", True)):
+                routers.todos.FAST_JSON = fast
+                latencies = []
+                for _ in range(args.requests):
+                    started = time.perf_counter()
+                    # 跳过列表缓存，每次都查库并序列化
+                    response = await client.get("/api/v1/todos/", headers={"Cache-Control": "no-cache"})
+                    latencies.append(time.perf_counter() - started)
+                bodies[mode] = response.content
+                stats = summarize(latencies)
+                results.append({
+                    "rows": rows,
+                    "mode": mode,
+                    "p50_ms": stats["p50_ms"],
+                    "p99_ms": stats["p99_ms"],
+                    "rows_per_sec": round(rows / percentile(latencies, 50)),
+                })
+            if bodies["pydantic"] != bodies["fast"]:
+                raise RuntimeError(f"{rows} 行时两种路径的输出不一致")
+    encoder = "orjson" if serialization.orjson is not None else "json"
+    return encoder, results
+
+def cmd_serialize(args):
+    """serialize 子命令"""
+    encoder, results = asyncio.run(run_serialize(args))
+    print(f"\n整表 GET /api/v1/todos/ (跳过缓存)，每组 {args.requests} 次，快速路径编码器: {encoder}，输出逐字节一致")
+    for result in results:
+        print(f"  {result['rows']:>7} 行 {result['mode']:<9} p50={result['p50_ms']:>9.2f}ms "
+              f"p99={result['p99_ms']:>9.2f}ms  {result['rows_per_sec']:>10} 行/秒")
+
+def original_sqlite_repository(base):
+    """SqliteTodoRepository 原来的单条写入: 写前检查存在、写后再查询一次"""
+
+    class ExistenceCheckRepository(base):
+        def create(self, title, completed=False):
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT INTO todos (title, completed, created_at, updated_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                """, (title, completed))
+                cursor.execute("SELECT * FROM todos WHERE id = ?", (cursor.lastrowid,))
+                row = cursor.fetchone()
+                conn.commit()
+                return self._to_dict(row)
+
+        def update(self, todo_id, title=None, completed=None):
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT * FROM todos WHERE id = ?", (todo_id,))
+                if not cursor.fetchone():
+                    return None
+                fields, values = [], []
+                if title is not None:
+                    fields.append("title = ?")
+                    values.append(title)
+                if completed is not None:
+                    fields.append("completed = ?")
+                    values.append(completed)
+                fields.append("updated_at = CURRENT_TIMESTAMP")
+                cursor.execute(f"UPDATE todos SET {', '.join(fields)} WHERE id = ?", values + [todo_id])
+                cursor.execute("SELECT * FROM todos WHERE id = ?", (todo_id,))
+                row = cursor.fetchone()
+                conn.commit()
+                return self._to_dict(row)
+
+        def delete(self, todo_id):
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT * FROM todos WHERE id = ?", (todo_id,))
+                if not cursor.fetchone():
+                    return False
+                cursor.execute("DELETE FROM todos WHERE id = ?", (todo_id,))
+                conn.commit()
+                return True
+
+    return ExistenceCheckRepository
+
+def cmd_mutations(args):
+    """mutations 子命令"""
+    from contextlib import contextmanager
+
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "mutations.db")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import repository
+    from database import get_db_connection, init_database
+
+    init_database()
+    statements = [0]
+
+    class CountingProxy:
+        """统计经由 execute 发出的 SQL 语句 (不含隐式 BEGIN/COMMIT 和触发器内部语句)"""
+
+        def __init__(self, target):
+            self._target = target
+
+        def execute(self, sql, params=()):
+            statements[0] += 1
+            return self._target.execute(sql, params)
+
+        def cursor(self):
+            return CountingProxy(self._target.cursor())
+
+        def __getattr__(self, name):
+            return getattr(self._target, name)
+
+    @contextmanager
+    def counted_connection():
+        with get_db_connection() as conn:
+            yield CountingProxy(conn)
+
+    variants = {
+        "原实现 (先查后写)": original_sqlite_repository(repository.SqliteTodoRepository)(counted_connection),
+        "RETURNING": repository.SqliteTodoRepository(counted_connection, returning=True),
+        "回退 (SQLite<3.35)": repository.SqliteTodoRepository(counted_connection, returning=False),
+    }
+    if not repository.SQLITE_RETURNING:
+        print(f"SQLite {repository.sqlite3.sqlite_version} 不支持 RETURNING，跳过该组")
+        del variants["RETURNING"]
+
+    print(f"\n每种操作 {args.ops} 次")
+    for name, repo in variants.items():
+        ids = [todo["id"] for todo in repository.SqliteTodoRepository().create_many(
+            [(f"任务{i}", False) for i in range(args.ops)])]
+        operations = [
+            ("create", lambda i: repo.create(f"新任务{i}")),
+            ("update", lambda i: repo.update(ids[i], completed=True)),
+            ("update (404)", lambda i: repo.update(-1 - i, title="x")),
+            ("delete", lambda i: repo.delete(ids[i])),
+            ("delete (404)", lambda i: repo.delete(-1 - i)),
+        ]
+        print(f"  {name}")
+        for op, func in operations:
+            latencies = []
+            statements[0] = 0
+            for i in range(args.ops):
+                started = time.perf_counter()
+                func(i)
+                latencies.append(time.perf_counter() - started)
+            stats = summarize(latencies)
+            print(f"    {op:<14} 语句数={statements[0] / args.ops:>4.1f} "
+                  f"p50={stats['p50_ms']:>7.3f}ms p99={stats['p99_ms']:>7.3f}ms")
+
+SEARCH_VERBS = ["学习", "完成", "整理", "准备", "购买", "阅读", "复习", "提交", "检查", "预约"]
+SEARCH_OBJECTS = ["英语单词", "数学作业", "项目文档", "会议纪要", "周报", "FastAPI教程",
+                  "体检报告", "机票", "生日礼物", "代码评审", "Python笔记", "房租"]
+SEARCH_WHEN = ["", "今天", "明天", "本周", "下周一", "周末前"]
+
+# (说明, 搜索词)
+SEARCH_QUERIES = [
+    ("常见词 (4字)", "数学作业"),
+    ("常见词 (2字)", "学习"),
+    ("英文", "fastapi"),
+    ("多个词", "学习 数学作业"),
+    ("罕见词", "年度总结"),
+    ("无结果", "不存在的任务"),
+]
+
+def search_titles(rows, rng):
+    """生成搜索基准用的标题，大约每十万行有一条含罕见词"""
+    for i in range(rows):
+        if i % 100000 == 99999:
+            yield f"撰写年度总结报告{i}"
+        else:
+            yield rng.choice(SEARCH_WHEN) + rng.choice(SEARCH_VERBS) + rng.choice(SEARCH_OBJECTS)
+
+def cmd_search(args):
+    """search 子命令"""
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "search.db")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from database import get_db_connection, init_database
+    from repository import SqliteTodoRepository
+
+    init_database()
+    repo = SqliteTodoRepository()
+    rng = random.Random(args.seed)
+
+    started = time.perf_counter()
+    batch = []
+    for title in search_titles(args.rows, rng):
+        batch.append((title, rng.random() < 0.3))
+        if len(batch) == 10000:
+            repo.create_many(batch)
+            batch = []
+    if batch:
+        repo.create_many(batch)
+    print(f"预置 {args.rows} 条任务 (含全文索引触发器): {time.perf_counter() - started:.1f}s")
+
+    def like_search(query):
+        # 对照组: 每个词一个 LIKE 条件，按创建时间倒序取第一页
+        terms = query.lower().split()
+        conditions = " AND ".join(["title LIKE ?"] * len(terms))
+        with get_db_connection() as conn:
+            return conn.execute(
+                f"SELECT id, title, completed, created_at, updated_at FROM todos WHERE {conditions} "
+                f"ORDER BY created_at DESC, id DESC LIMIT ?",
+                [f"%{term}%" for term in terms] + [args.limit]
+            ).fetchall()
+
+    variants = [
+        ("FTS5", lambda query: repo.search(query, limit=args.limit)),
+        ("LIKE", like_search),
+    ]
+    print(f"\n每个搜索词执行 {args.queries} 次，每次取 {args.limit} 条")
+    print(f"{'搜索词':<24}{'方式':<8}{'结果':>6}{'p50 (ms)':>12}{'p95 (ms)':>12}")
+    for label, query in SEARCH_QUERIES:
+        for name, func in variants:
+            latencies = []
+            for _ in range(args.queries):
+                started = time.perf_counter()
+                found = len(func(query))
+                latencies.append(time.perf_counter() - started)
+            stats = summarize(latencies)
+            print(f"{label + ' ' + query:<24}{name:<8}{found:>6}{stats['p50_ms']:>12.3f}{stats['p95_ms']:>12.3f}")
+
+async def run_metrics_overhead(args):
+    """闭环并发请求列表首页和单个任务更新，返回延迟和吞吐 (在子进程中按 METRICS_ENABLED 运行)"""
+    import httpx
+
+    app = setup_app(os.path.join(tempfile.mkdtemp(), "metrics.db"))
+    rng = random.Random(args.seed)
+    seed_dataset(args.rows, rng)
+    latencies = []
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def user(count, record):
+            for _ in range(count):
+                started = time.perf_counter()
+                if rng.random() < 0.2:
+                    await client.put(f"/api/v1/todos/{rng.randint(1, args.rows)}",
+                                     json={"completed": rng.random() < 0.5})
+                else:
+                    await client.get("/api/v1/todos/", params={"limit": 50})
+                if record:
+                    latencies.append(time.perf_counter() - started)
+
+        per_user = args.requests // args.concurrency
+        await asyncio.gather(*(user(per_user // 10, False) for _ in range(args.concurrency)))
+        started = time.perf_counter()
+        await asyncio.gather(*(user(per_user, True) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return dict(summarize(latencies), throughput_rps=round(len(latencies) / elapsed, 1))
+
+def measure_middleware_call(iterations):
+    """直接调用中间件包装的空 ASGI 应用，返回每次调用的额外耗时 (微秒)"""
+    from metrics import MetricsMiddleware, MetricsRegistry
+
+    async def endpoint(scope, receive, send):
+        scope["endpoint"] = endpoint
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    class FakeApp:
+        routes = []
+        state = type("State", (), {})()
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        pass
+
+    async def timed(app):
+        scope = {"type": "http", "method": "GET", "app": FakeApp}
+        started = time.perf_counter()
+        for _ in range(iterations):
+            await app(dict(scope), receive, send)
+        return time.perf_counter() - started
+
+    bare = asyncio.run(timed(endpoint))
+    wrapped = asyncio.run(timed(MetricsMiddleware(endpoint, MetricsRegistry())))
+    return (wrapped - bare) / iterations * 1e6
+
+def cmd_metrics(args):
+    """metrics 子命令"""
+    if args.json:
+        print(json.dumps(asyncio.run(run_metrics_overhead(args))))
+        return
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    print(f"中间件单次调用的额外耗时: {measure_middleware_call(args.iterations):.2f}µs "
+          f"(空应用，{args.iterations} 次平均)")
+
+    # 开关在导入时读取，两种配置各在独立进程中运行
+    argv = [sys.executable, os.path.abspath(__file__), "metrics", "--json", "--rows", str(args.rows),
+            "--requests", str(args.requests), "--concurrency", str(args.concurrency), "--seed", str(args.seed)]
+    print(f"\n{args.rows} 行，{args.requests} 个请求 (80% 列表首页 / 20% 更新)，并发 {args.concurrency}")
+    results = {}
+    for enabled in ("0", "1"):
+        env = dict(os.environ, METRICS_ENABLED=enabled)
+        output = subprocess.check_output(argv, env=env, text=True)
+        results[enabled] = json.loads(output.strip().splitlines()[-1])
+        result = results[enabled]
+        print(f"  指标{'开启' if enabled == '1' else '关闭'}: 吞吐 {result['throughput_rps']} req/s, "
+              f"p50={result['p50_ms']:.2f}ms p95={result['p95_ms']:.2f}ms p99={result['p99_ms']:.2f}ms")
+    change = results["1"]["p50_ms"] / results["0"]["p50_ms"] - 1
+    print(f"  p50 变化 {change:+.1%}")
+
+# 各负载的操作权重
+SUITE_PROFILES = {
+    "read-heavy": {"list": 70, "stats": 10, "search": 10, "changes": 5, "create": 2, "update": 2, "delete": 1},
+    "mixed": {"list": 40, "stats": 5, "search": 5, "changes": 10, "create": 15, "update": 20, "delete": 5},
+    "write-heavy": {"list": 15, "changes": 5, "create": 30, "update": 40, "delete": 10},
+}
+
+# compare 对比的指标: 名称 -> 数值越大越好
+SUITE_METRICS = {"p50_ms": False, "p95_ms": False, "p99_ms": False, "throughput_rps": True}
+
+def seed_dataset(rows, rng):
+    """按随机种子直接经存储层写入 rows 条任务，标题与 search 基准相同，约 30% 已完成"""
+    from repository import get_repository
+
+    repo = get_repository()
+    batch = []
+    for title in search_titles(rows, rng):
+        batch.append((title, rng.random() < 0.3))
+        if len(batch) == 10000:
+            repo.create_many(batch)
+            batch = []
+    if batch:
+        repo.create_many(batch)
+
+async def run_profile(client, profile, rows, args, rng):
+    """
+    闭环负载: concurrency 个虚拟用户不停地执行下一个操作，统计吞吐和每种操作的延迟
+
+    操作序列由随机种子预先生成，前 warmup 个操作只用于预热，不计入结果。
+    """
+    weights = SUITE_PROFILES[profile]
+    names = list(weights)
+    ops = rng.choices(names, weights=[weights[name] for name in names], k=args.warmup + args.requests)
+    state = {"since": 0, "created": [], "errors": 0}
+    latencies = {name: [] for name in names}
+
+    async def perform(op):
+        if op == "list":
+            status = rng.choice(["all", "active", "completed"])
+            response = await client.get("/api/v1/todos/", params={"status": status, "limit": 50})
+        elif op == "stats":
+            response = await client.get("/api/v1/todos/stats")
+        elif op == "search":
+            response = await client.get("/api/v1/todos/search", params={"q": rng.choice(SEARCH_QUERIES)[1]})
+        elif op == "changes":
+            # 模拟持续增量同步的客户端
+            response = await client.get("/api/v1/todos/changes", params={"since": state["since"], "limit": 100})
+            if response.status_code == 200:
+                state["since"] = response.json()["version"]
+        elif op == "create":
+            title = rng.choice(SEARCH_VERBS) + rng.choice(SEARCH_OBJECTS)
+            response = await client.post("/api/v1/todos/", json={"title": title})
+            if response.status_code == 200:
+                state["created"].append(response.json()["id"])
+        elif op == "update":
+            todo_id = rng.randint(1, max(1, rows))
+            response = await client.put(f"/api/v1/todos/{todo_id}", json={"completed": rng.random() < 0.5})
+        else:
+            # 优先删除本轮新建的任务，数据量保持稳定
+            todo_id = state["created"].pop() if state["created"] else rng.randint(1, max(1, rows))
+            response = await client.delete(f"/api/v1/todos/{todo_id}")
+        if response.status_code >= 500:
+            state["errors"] += 1
+
+    async def drive(batch, record):
+        pending = iter(batch)
+
+        async def user():
+            for op in pending:
+                started = time.perf_counter()
+                await perform(op)
+                if record:
+                    latencies[op].append(time.perf_counter() - started)
+
+        await asyncio.gather(*(user() for _ in range(args.concurrency)))
+
+    await drive(ops[:args.warmup], False)
+    state["errors"] = 0
+    started = time.perf_counter()
+    await drive(ops[args.warmup:], True)
+    elapsed = time.perf_counter() - started
+
+    return {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "errors": state["errors"],
+        "throughput_rps": round(args.requests / elapsed, 1),
+        "all": summarize([value for values in latencies.values() for value in values]),
+        "ops": {name: summarize(values) for name, values in latencies.items() if values},
+    }
+
+def run_micro(rows, iterations):
+    """存储层和序列化的微基准: 路由处理函数中的主要调用各重复 iterations 次"""
+    from repository import get_repository
+    from routers.todos import _dump_todo_list
+
+    repo = get_repository()
+    page = repo.list(None, 50)
+    after = (page[-1]["created_at"], page[-1]["id"])
+    created = []
+    benchmarks = {
+        "list_page": lambda i: repo.list(("active", "completed", None)[i % 3], 50),
+        "list_page_after": lambda i: repo.list(None, 50, after),
+        "stats": lambda i: repo.stats(),
+        "search_rare": lambda i: repo.search("年度总结", limit=20),
+        "changes": lambda i: repo.changes(max(0, rows - 100), 100),
+        "serialize_page": lambda i: _dump_todo_list(page),
+        "create": lambda i: created.append(repo.create(f"微基准任务{i}")["id"]),
+        "update": lambda i: repo.update(created[i], completed=True),
+        "delete": lambda i: repo.delete(created[i]),
+    }
+    results = {}
+    for name, func in benchmarks.items():
+        latencies = []
+        for i in range(iterations):
+            started = time.perf_counter()
+            func(i)
+            latencies.append(time.perf_counter() - started)
+        results[name] = summarize(latencies)
+    return results
+
+async def run_suite_size(args, rows):
+    """在全新的数据库上预置 rows 条任务，依次运行各负载和微基准"""
+    import httpx
+
+    app = setup_app(os.path.join(tempfile.mkdtemp(), "suite.db"))
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    seed_dataset(rows, rng)
+    result = {"seed_s": round(time.perf_counter() - started, 2), "profiles": {}}
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for profile in args.profiles:
+            result["profiles"][profile] = await run_profile(client, profile, rows, args, rng)
+    result["micro"] = run_micro(rows, args.micro_iterations)
+    return result
+
+def suite_meta(args):
+    """记录结果对应的代码版本和运行环境，便于对比时确认条件一致"""
+    import platform
+    import sqlite3
+
+    def git(*command):
+        try:
+            return subprocess.check_output(["git", *command], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                           text=True, stderr=subprocess.DEVNULL).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return {
+        "commit": git("rev-parse", "--short", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "fast_json": os.environ.get("FAST_JSON", ""),
+        "seed": args.seed,
+        "requests": args.requests,
+        "warmup": args.warmup,
+        "concurrency": args.concurrency,
+        "micro_iterations": args.micro_iterations,
+    }
+
+def print_suite_report(rows, result):
+    """打印一种数据量的测试结果"""
+    print(f"\n== {rows} 行 (预置 {result['seed_s']}s)")
+    for profile, stats in result["profiles"].items():
+        print(f"  [{profile}] 吞吐 {stats['throughput_rps']} req/s，并发 {stats['concurrency']}，5xx {stats['errors']}")
+        for name, op in [("all", stats["all"])] + list(stats["ops"].items()):
+            print(f"    {name:<8} n={op['count']:<6} p50={op['p50_ms']:>8.2f}ms "
+                  f"p95={op['p95_ms']:>8.2f}ms p99={op['p99_ms']:>8.2f}ms")
+    print("  [micro]")
+    for name, op in result["micro"].items():
+        print(f"    {name:<16} p50={op['p50_ms']:>8.3f}ms p95={op['p95_ms']:>8.3f}ms p99={op['p99_ms']:>8.3f}ms")
+
+def cmd_suite(args):
+    """suite 子命令"""
+    unknown = [profile for profile in args.profiles if profile not in SUITE_PROFILES]
+    if unknown:
+        sys.exit(f"未知的负载: {unknown}，可选: {list(SUITE_PROFILES)}")
+
+    if args.json:
+        result = asyncio.run(run_suite_size(args, args.rows[0]))
+        print(json.dumps(result, ensure_ascii=False))
+        return
+
+    # 每种数据量在独立进程中运行，数据库、连接池和缓存互不影响
+    results = {}
+    for rows in args.rows:
+        argv = [sys.executable, os.path.abspath(__file__), "suite", "--json", "--rows", str(rows),
+                "--profiles", *args.profiles, "--requests", str(args.requests),
+                "--warmup", str(args.warmup), "--concurrency", str(args.concurrency),
+                "--micro-iterations", str(args.micro_iterations), "--seed", str(args.seed)]
+        output = subprocess.check_output(argv, text=True)
+        results[str(rows)] = json.loads(output.strip().splitlines()[-1])
+        print_suite_report(rows, results[str(rows)])
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            # 键排序、缩进固定，两次结果可以直接 diff
+            json.dump({"meta": suite_meta(args), "results": results}, f,
+                      ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\n结果已写入 {args.output}")
+
+def flatten_suite(results):
+    """把 suite 结果展开为 {"行数/负载/操作": 指标}"""
+    flat = {}
+    for rows, result in results.items():
+        for profile, stats in result["profiles"].items():
+            flat[f"{rows}/{profile}/all"] = dict(stats["all"], throughput_rps=stats["throughput_rps"])
+            for name, op in stats["ops"].items():
+                flat[f"{rows}/{profile}/{name}"] = op
+        for name, op in result["micro"].items():
+            flat[f"{rows}/micro/{name}"] = op
+    return flat
+
+def cmd_compare(args):
+    """compare 子命令"""
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"基准 {base['meta'].get('commit')} -> 对比 {new['meta'].get('commit')}，"
+          f"阈值 {args.threshold:.0%} (延迟变化还需超过 {args.min_ms}ms)")
+    for key in ("python", "sqlite", "platform", "cpus", "seed", "requests", "concurrency"):
+        if base["meta"].get(key) != new["meta"].get(key):
+            print(f"  注意: 运行条件 {key} 不同 ({base['meta'].get(key)} vs {new['meta'].get(key)})")
+
+    base_flat, new_flat = flatten_suite(base["results"]), flatten_suite(new["results"])
+    regressions = 0
+    for name in sorted(base_flat.keys() & new_flat.keys()):
+        for metric, higher_is_better in SUITE_METRICS.items():
+            old, current = base_flat[name].get(metric), new_flat[name].get(metric)
+            if old is None or current is None or old == 0:
+                continue
+            change = (current - old) / old
+            worse = -change if higher_is_better else change
+            regressed = worse > args.threshold and (higher_is_better or current - old > args.min_ms)
+            improved = -worse > args.threshold and (higher_is_better or old - current > args.min_ms)
+            if regressed or improved or args.all:
+                mark = "退化" if regressed else ("提升" if improved else "")
+                print(f"  {name:<32} {metric:<15} {old:>10.3f} -> {current:>10.3f} ({change:+.1%}) {mark}")
+            regressions += regressed
+    print(f"\n共 {regressions} 项退化")
+    if regressions:
+        sys.exit(1)
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="Todo API 性能测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    load = subparsers.add_parser("load", help="并发混合读写负载测试")
+    load.add_argument("--rate", type=float, default=200, help="每秒发出的请求数")
+    load.add_argument("--requests", type=int, default=2000, help="请求总数")
+    load.add_argument("--write-ratio", type=float, default=0.2, help="写请求比例")
+    load.add_argument("--seed-rows", type=int, default=5000, help="预置任务数")
+    load.add_argument("--seed", type=int, default=42, help="随机种子")
+    load.add_argument("--slow-write-ms", type=int, default=50, help="模拟慢写入时持有写锁的毫秒数，0 表示关闭")
+    load.add_argument("--slow-write-interval-ms", type=int, default=200, help="两次慢写入之间的间隔毫秒数")
+    load.add_argument("--compare", action="store_true", help="对比事件循环内直接查询与数据库线程池")
+    load.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    load.set_defaults(func=cmd_load)
+
+    engines = subparsers.add_parser("engines", help="存储引擎一致性检查和基准对比")
+    engines.add_argument("--rows", type=int, default=10000, help="基准负载的任务数")
+    engines.add_argument("--seed", type=int, default=42, help="随机种子")
+    engines.add_argument("--json", action="store_true", help="额外以 JSON 输出基准结果")
+    engines.set_defaults(func=cmd_engines)
+
+    memory_store = subparsers.add_parser("memory-store", help="api/todos.py 内存存储微基准")
+    memory_store.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000],
+                              help="任务数量")
+    memory_store.add_argument("--ops", type=int, default=20, help="每种操作执行的次数")
+    memory_store.add_argument("--seed", type=int, default=42, help="随机种子")
+    memory_store.set_defaults(func=cmd_memory_store)
+
+    poll = subparsers.add_parser("poll", help="轮询场景下 ETag 条件请求的效果")
+    poll.add_argument("--rows", type=int, default=2000, help="预置任务数")
+    poll.add_argument("--clients", type=int, default=20, help="轮询的客户端数")
+    poll.add_argument("--polls", type=int, default=1000, help="轮询总次数")
+    poll.add_argument("--write-every", type=int, default=50, help="每隔多少次轮询发生一次写入")
+    poll.add_argument("--seed", type=int, default=42, help="随机种子")
+    poll.set_defaults(func=cmd_poll)
+
+    events = subparsers.add_parser("events", help="事件总线扇出基准")
+    events.add_argument("--subscribers", type=int, nargs="+", default=[1000, 5000, 10000], help="订阅者数量")
+    events.add_argument("--events", type=int, default=200, help="发布的事件数")
+    events.add_argument("--stalled", type=float, default=0.05, help="从不读取的订阅者比例")
+    events.add_argument("--interval-ms", type=float, default=20, help="两次发布之间的间隔毫秒数")
+    events.add_argument("--queue-size", type=int, default=64, help="每个订阅者允许积压的事件数")
+    events.set_defaults(func=cmd_events)
+
+    pg_cold_start = subparsers.add_parser("pg-cold-start", help="api/todos_postgres.py 冷启动与热启动延迟")
+    pg_cold_start.add_argument("--cold-starts", type=int, default=10, help="模拟冷启动的次数")
+    pg_cold_start.add_argument("--warm", type=int, default=50, help="每次冷启动后的热请求数")
+    pg_cold_start.set_defaults(func=cmd_pg_cold_start)
+
+    serialize = subparsers.add_parser("serialize", help="列表序列化: Pydantic vs 快速路径")
+    serialize.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000], help="任务数量")
+    serialize.add_argument("--requests", type=int, default=10, help="每组请求次数")
+    serialize.set_defaults(func=cmd_serialize)
+
+    mutations = subparsers.add_parser("mutations", help="SQLite 单条写入的语句数和延迟")
+    mutations.add_argument("--ops", type=int, default=2000, help="每种操作执行的次数")
+    mutations.set_defaults(func=cmd_mutations)
+
+    search = subparsers.add_parser("search", help="标题搜索: FTS5 全文索引 vs LIKE")
+    search.add_argument("--rows", type=int, default=1000000, help="预置任务数")
+    search.add_argument("--queries", type=int, default=20, help="每个搜索词执行的次数")
+    search.add_argument("--limit", type=int, default=20, help="每次搜索返回的条数")
+    search.add_argument("--seed", type=int, default=42, help="随机种子")
+    search.set_defaults(func=cmd_search)
+
+    metrics = subparsers.add_parser("metrics", help="请求指标中间件的开销")
+    metrics.add_argument("--rows", type=int, default=10000, help="预置任务数")
+    metrics.add_argument("--requests", type=int, default=4000, help="每种配置的请求数")
+    metrics.add_argument("--concurrency", type=int, default=8, help="并发虚拟用户数")
+    metrics.add_argument("--iterations", type=int, default=100000, help="中间件单独调用的次数")
+    metrics.add_argument("--seed", type=int, default=42, help="随机种子")
+    metrics.add_argument("--json", action="store_true", help=argparse.SUPPRESS)
+    metrics.set_defaults(func=cmd_metrics)
+
+    suite = subparsers.add_parser("suite", help="多数据量 x 多负载的基准套件，输出可对比的 JSON")
+    suite.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000],
+                       help="预置任务数，每种在独立进程中运行 (最大建议 1000000)")
+    suite.add_argument("--profiles", nargs="+", default=list(SUITE_PROFILES), help="负载类型")
+    suite.add_argument("--requests", type=int, default=2000, help="每种负载计入结果的请求数")
+    suite.add_argument("--warmup", type=int, default=200, help="每种负载开始前的预热请求数")
+    suite.add_argument("--concurrency", type=int, default=16, help="并发虚拟用户数")
+    suite.add_argument("--micro-iterations", type=int, default=200, help="每个微基准的重复次数")
+    suite.add_argument("--seed", type=int, default=42, help="随机种子")
+    suite.add_argument("--output", help="结果 JSON 文件路径")
+    suite.add_argument("--json", action="store_true", help=argparse.SUPPRESS)
+    suite.set_defaults(func=cmd_suite)
+
+    compare = subparsers.add_parser("compare", help="对比两次 suite 结果")
+    compare.add_argument("base", help="基准结果 JSON")
+    compare.add_argument("new", help="新结果 JSON")
+    compare.add_argument("--threshold", type=float, default=0.2, help="视为退化的相对变化 (单核机器上尾延迟波动较大)")
+    compare.add_argument("--min-ms", type=float, default=0.05, help="延迟至少变化多少毫秒才计入，过滤微秒级噪声")
+    compare.add_argument("--all", action="store_true", help="列出所有指标，而不只是变化超过阈值的")
+    compare.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+任务列表响应缓存模块
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable, Optional, Tuple
+
+# 缓存的最大条目数 (每个 状态+分页 组合占一条)，设为 0 时关闭缓存
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "256"))
+
+# 列表的三种视图，其他 status 取值都按 all 处理
+VIEWS = ("all", "active", "completed")
+
+def view_of(status: Optional[str]) -> str:
+    """把查询参数中的 status 归一化为视图名"""
+    return status if status in ("active", "completed") else "all"
+
+def views_for_states(*completed_states: bool) -> Tuple[str, ...]:
+    """
+    返回包含指定完成状态任务的视图
+
+    all 视图总是受影响；active/completed 只在对应状态的任务发生变化时才失效。
+    """
+    views = ["all"]
+    if False in completed_states:
+        views.append("active")
+    if True in completed_states:
+        views.append("completed")
+    return tuple(views)
+
+class ResponseCache:
+    """
+    进程内 LRU 读穿缓存
+
+    键的第一个元素是视图名，写操作按视图精确失效。每个视图带一个代数，
+    失效时加一：查询开始前记下代数，结果写回时代数已变化说明查询期间
+    发生过写入，这份结果可能是旧数据，直接丢弃而不放进缓存。
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple, Any]" = OrderedDict()
+        self._generations = {view: 0 for view in VIEWS}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: Tuple[Hashable, ...]) -> Tuple[Optional[Any], int]:
+        """
+        查找缓存
+
+        Returns:
+            (缓存值或 None, 当前视图代数)，未命中时把代数传给 put
+        """
+        if not self.enabled:
+            return None, 0
+        with self._lock:
+            generation = self._generations[key[0]]
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key], generation
+            self.misses += 1
+            return None, generation
+
+    def put(self, key: Tuple[Hashable, ...], value: Any, generation: int):
+        """写入缓存，查询期间视图已失效时放弃写入"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._generations[key[0]] != generation:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, views: Iterable[str] = VIEWS):
+        """使指定视图的所有分页缓存失效"""
+        views = set(views)
+        with self._lock:
+            for view in views:
+                self._generations[view] += 1
+            stale = [key for key in self._entries if key[0] in views]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        """清空缓存和计数器"""
+        with self._lock:
+            self._entries.clear()
+            for view in VIEWS:
+                self._generations[view] += 1
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def stats(self) -> dict:
+        """返回缓存当前状态"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+class TableVersion:
+    """
+    todos 表的单调版本号，每次写操作后加一
+
+    只在进程内计数，重启后从 0 开始，因此 ETag 中带上每次启动随机生成的 epoch，
+    避免旧进程发出的 ETag 与新进程的版本号碰撞。
+    """
+
+    def __init__(self):
+        self.epoch = os.urandom(4).hex()
+        self._value = 0
+        self._lock = threading.Lock()
+
+    @property
+    def value(self) -> int:
+        return self._value
+
+    def bump(self):
+        with self._lock:
+            self._value += 1
+
+    def etag(self, *variant: Hashable) -> str:
+        """
+        生成强 ETag：版本号相同且请求参数相同的响应字节完全一致
+
+        Args:
+            variant: 区分同一版本下不同表示的参数 (视图、分页、输出格式等)
+        """
+        digest = hashlib.blake2s(repr(variant).encode("utf-8"), digest_size=6).hexdigest()
+        return f'"{self.epoch}-{self._value}-{digest}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    判断 If-None-Match 是否命中 (按 RFC 9110 对 If-None-Match 使用弱比较)
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return etag in [tag[2:] if tag.startswith("W/") else tag for tag in candidates]
+
+# 全局列表缓存和表版本号
+list_cache = ResponseCache(CACHE_MAX_ENTRIES)
+table_version = TableVersion()
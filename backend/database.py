@@ -1,25 +1,348 @@
 """
 数据库连接和初始化模块
 """
+import asyncio
+import contextvars
+import functools
 import sqlite3
-from typing import Generator
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import LifoQueue, Empty
+from typing import Dict, Generator
 from contextlib import contextmanager
 import os
 
+from metrics import record_connection, record_query
+from profiling import profile_call
+from querylog import QUERY_LOG_ENABLED, TimedCursor
+from schema import ensure_indexes, optimize
+
 # 数据库文件路径
 DATABASE_URL = "sqlite:///./todos.db"
+DATABASE_PATH = os.environ.get("DB_PATH", "todos.db")
+
+# 连接池配置 (均可通过环境变量覆盖)
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+DB_HEALTH_CHECK_INTERVAL = float(os.environ.get("DB_HEALTH_CHECK_INTERVAL", "30"))
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_CACHE_SIZE = int(os.environ.get("DB_CACHE_SIZE", "-64000"))  # 负数表示 KiB
+# 每个连接缓存的已编译语句数 (sqlite3 的 cached_statements)，需大于注册的语句数
+DB_CACHED_STATEMENTS = int(os.environ.get("DB_CACHED_STATEMENTS", "128"))
+
+# 删除记录 (墓碑) 保留天数，用于增量同步；设为 0 时永久保留
+SYNC_TOMBSTONE_RETENTION_DAYS = int(os.environ.get("SYNC_TOMBSTONE_RETENTION_DAYS", "30"))
+
+# 数据库线程池大小，默认与连接池一致；设为 0 时直接在事件循环线程中执行 (仅用于对比测试)
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", str(DB_POOL_SIZE)))
+
+def _fold(value):
+    """
+    搜索用的大小写转换，注册为 SQL 函数 fold()
+
+    SQLite 内置的 lower() 只转换 ASCII 字母，搜索词在 Python 中转为小写，
+    标题也要用同样的 str.lower 转换，非 ASCII 字母 (如 Ä、П) 才能匹配。
+    """
+    return value.lower() if isinstance(value, str) else value
+
+class PooledConnection(sqlite3.Connection):
+    """
+    连接池创建的连接，记录在本连接上执行过的注册语句名
+
+    开启慢查询日志时游标默认为 TimedCursor；sqlite3 的 Connection.execute 不经过
+    cursor()，这里改为先创建游标再执行，使所有语句都被计时。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+    if QUERY_LOG_ENABLED:
+        def cursor(self, factory=TimedCursor):
+            return super().cursor(factory)
+
+        def execute(self, sql, parameters=()):
+            return self.cursor().execute(sql, parameters)
+
+        def executemany(self, sql, seq_of_parameters):
+            return self.cursor().executemany(sql, seq_of_parameters)
+
+class StatementRegistry:
+    """
+    固定 SQL 语句注册表
+
+    请求路径上的语句按名称注册为固定文本，执行时不再拼接 SQL。sqlite3 在每个连接上
+    按 SQL 文本缓存编译好的语句 (LRU，容量为 DB_CACHED_STATEMENTS)，注册的语句数
+    远小于容量，所以每条语句在每个连接上只在第一次执行时编译，之后都直接复用。
+    prepares/hits 分别统计首次执行 (需要编译) 和复用的次数。
+    """
+
+    def __init__(self):
+        self._sql: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self.prepares = 0
+        self.hits = 0
+
+    def register(self, name: str, sql: str):
+        """注册语句，同名语句重复注册时 SQL 必须相同"""
+        with self._lock:
+            if self._sql.setdefault(name, sql) != sql:
+                raise ValueError(f"语句 {name} 已注册为不同的 SQL")
+
+    def _track(self, target, name: str):
+        # target 可以是连接或游标；不是连接池创建的连接时不统计
+        conn = getattr(target, "connection", target)
+        prepared = getattr(conn, "prepared", None)
+        if prepared is None:
+            return
+        with self._lock:
+            if name in prepared:
+                self.hits += 1
+            else:
+                prepared.add(name)
+                self.prepares += 1
+
+    def execute(self, target, name: str, params=()):
+        """在连接或游标上执行注册的语句，返回游标"""
+        self._track(target, name)
+        record_query()
+        return target.execute(self._sql[name], params)
+
+    def executemany(self, target, name: str, seq_of_params):
+        """对每组参数执行注册的语句 (在请求指标中记为一条语句)"""
+        self._track(target, name)
+        record_query()
+        return target.executemany(self._sql[name], seq_of_params)
+
+    def registered(self) -> Dict[str, str]:
+        """返回所有已注册的语句 (名称 -> SQL)"""
+        with self._lock:
+            return dict(self._sql)
+
+    def stats(self) -> dict:
+        """返回注册表和命中情况"""
+        with self._lock:
+            total = self.prepares + self.hits
+            return {
+                "registered": len(self._sql),
+                "cache_size": DB_CACHED_STATEMENTS,
+                "prepares": self.prepares,
+                "hits": self.hits,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+# 全局语句注册表
+statements = StatementRegistry()
+
+class ConnectionPool:
+    """
+    SQLite 连接池
+
+    连接在首次需要时创建，数量不超过 size；归还后保留在池中复用，
+    每个连接只在创建时设置一次 PRAGMA。空闲时间超过 health_check_interval
+    的连接在取出时会先执行 SELECT 1 做健康检查，失败则丢弃并重建。
+    """
+
+    def __init__(self, database: str, size: int = 5, timeout: float = 30.0,
+                 health_check_interval: float = 30.0):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle = LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+
+    def _create_connection(self) -> sqlite3.Connection:
+        """创建新连接并应用 PRAGMA 设置"""
+        conn = sqlite3.connect(self.database, timeout=self.timeout, check_same_thread=False,
+                               factory=PooledConnection, cached_statements=DB_CACHED_STATEMENTS)
+        conn.row_factory = sqlite3.Row  # 使结果可以通过列名访问
+        conn.create_function("fold", 1, _fold, deterministic=True)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size={DB_CACHE_SIZE}")
+        return conn
+
+    def _is_healthy(self, conn: sqlite3.Connection) -> bool:
+        """检查连接是否可用"""
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, conn: sqlite3.Connection):
+        """关闭并丢弃一个连接，释放其名额"""
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    def acquire(self) -> sqlite3.Connection:
+        """
+        从池中取出一个连接
+
+        Raises:
+            TimeoutError: 在 timeout 秒内没有可用连接
+        """
+        if self._closed:
+            raise RuntimeError("连接池已关闭")
+
+        try:
+            conn, last_used = self._idle.get_nowait()
+        except Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    return self._create_connection()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            try:
+                conn, last_used = self._idle.get(timeout=self.timeout)
+            except Empty:
+                raise TimeoutError("数据库连接池已耗尽，获取连接超时")
+
+        if time.monotonic() - last_used > self.health_check_interval and not self._is_healthy(conn):
+            self._discard(conn)
+            with self._lock:
+                self._created += 1
+            try:
+                return self._create_connection()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return conn
+
+    def release(self, conn: sqlite3.Connection):
+        """把连接归还到池中，未提交的事务会被回滚"""
+        if self._closed:
+            self._discard(conn)
+            return
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        self._idle.put((conn, time.monotonic()))
+
+    @contextmanager
+    def connection(self) -> Generator[sqlite3.Connection, None, None]:
+        """取出连接并在使用结束后自动归还"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self) -> dict:
+        """返回连接池当前状态"""
+        with self._lock:
+            created = self._created
+        idle = self._idle.qsize()
+        return {"size": self.size, "created": created, "idle": idle, "in_use": created - idle}
+
+    def close(self):
+        """关闭池中所有空闲连接"""
+        self._closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except Empty:
+                break
+            self._discard(conn)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> ConnectionPool:
+    """
+    获取全局连接池，首次调用时创建
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    DATABASE_PATH,
+                    size=DB_POOL_SIZE,
+                    timeout=DB_POOL_TIMEOUT,
+                    health_check_interval=DB_HEALTH_CHECK_INTERVAL,
+                )
+    return _pool
+
+_executor = None
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    获取专用的数据库线程池，首次调用时创建
+    """
+    global _executor
+    if _executor is None:
+        with _pool_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=DB_EXECUTOR_WORKERS,
+                    thread_name_prefix="todo-db",
+                )
+    return _executor
+
+async def run_db(func, *args):
+    """
+    在数据库线程池中执行同步的数据库操作并等待结果
+
+    路由通过它访问 SQLite，查询期间事件循环可以继续处理其他请求。
+    线程数与连接池大小一致，超出的请求在线程池队列中排队。
+    在调用方的上下文副本中执行，请求指标能记到发起查询的请求上；
+    请求正在被剖析时 (profiling.py)，执行查询的线程也一并剖析。
+    """
+    if DB_EXECUTOR_WORKERS <= 0:
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_executor(), context.run, profile_call, functools.partial(func, *args))
+
+def close_pool():
+    """
+    关闭全局连接池和数据库线程池
+    """
+    global _pool, _executor
+    with _pool_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+        if _pool is not None:
+            _pool.close()
+            _pool = None
 
 @contextmanager
 def get_db_connection():
     """
-    获取数据库连接的上下文管理器
+    获取数据库连接的上下文管理器 (从连接池中取出，用完自动归还)
+
+    等待连接和占用连接的时间计入当前请求的指标。
     """
-    conn = sqlite3.connect("todos.db")
-    conn.row_factory = sqlite3.Row  # 使结果可以通过列名访问
+    pool = get_pool()
+    started = time.perf_counter()
+    conn = pool.acquire()
+    acquired = time.perf_counter()
     try:
         yield conn
     finally:
-        conn.close()
+        pool.release(conn)
+        record_connection(acquired - started, time.perf_counter() - acquired)
 
 def init_database():
     """
@@ -35,24 +358,190 @@ def init_database():
                 title VARCHAR(255) NOT NULL,
                 completed BOOLEAN DEFAULT FALSE,
                 created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                version INTEGER NOT NULL DEFAULT 0
             )
         """)
         
-        # 创建索引
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_todos_completed 
-            ON todos(completed)
-        """)
+        # 旧数据库补上同步版本号列，已有任务按ID顺序分配版本号
+        columns = [row["name"] for row in cursor.execute("PRAGMA table_info(todos)")]
+        if "version" not in columns:
+            cursor.execute("ALTER TABLE todos ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            cursor.execute("UPDATE todos SET version = id")
         
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_todos_created_at 
-            ON todos(created_at)
-        """)
+        init_sync_schema(cursor)
+        init_stats_schema(cursor)
+        init_search_schema(cursor)
+        
+        # 创建索引 (定义见 schema.py)
+        ensure_indexes(cursor)
         
         conn.commit()
+        
+        # 更新查询规划器的统计信息
+        optimize(conn)
         print("数据库初始化完成")
 
+def init_sync_schema(cursor: sqlite3.Cursor):
+    """
+    创建增量同步用的表和触发器
+
+    sync_state 中只有一行，version 是全表单调递增的变更序号。每次插入、更新、
+    删除一行任务都由触发器把序号加一：插入和更新写到该行的 version 列，
+    删除则写进 todo_tombstones (AUTOINCREMENT 保证 ID 不会复用)，客户端据此拿到
+    since 之后的所有变更。
+    updated_at 只精确到秒，同一秒内的多次修改无法区分先后，所以不用它做同步位置。
+
+    墓碑超过 SYNC_TOMBSTONE_RETENTION_DAYS 天后在启动时清理，清理到的最大版本号
+    记在 pruned_version 中，比它更早的同步位置只能重新全量同步。
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            pruned_version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO sync_state (id, version)
+        SELECT 1, COALESCE(MAX(version), 0) FROM todos
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS todo_tombstones (
+            id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL,
+            deleted_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # 触发器里的 UPDATE todos 只修改 version 列，不会再次触发更新触发器
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS todos_sync_insert AFTER INSERT ON todos
+        BEGIN
+            UPDATE sync_state SET version = version + 1 WHERE id = 1;
+            UPDATE todos SET version = (SELECT version FROM sync_state WHERE id = 1)
+            WHERE id = NEW.id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS todos_sync_update
+        AFTER UPDATE OF title, completed, updated_at ON todos
+        BEGIN
+            UPDATE sync_state SET version = version + 1 WHERE id = 1;
+            UPDATE todos SET version = (SELECT version FROM sync_state WHERE id = 1)
+            WHERE id = NEW.id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS todos_sync_delete AFTER DELETE ON todos
+        BEGIN
+            UPDATE sync_state SET version = version + 1 WHERE id = 1;
+            INSERT OR REPLACE INTO todo_tombstones (id, version)
+            VALUES (OLD.id, (SELECT version FROM sync_state WHERE id = 1));
+        END
+    """)
+
+    if SYNC_TOMBSTONE_RETENTION_DAYS > 0:
+        cutoff = f"-{SYNC_TOMBSTONE_RETENTION_DAYS} days"
+        cursor.execute("""
+            UPDATE sync_state SET pruned_version = MAX(pruned_version, (
+                SELECT COALESCE(MAX(version), 0) FROM todo_tombstones
+                WHERE deleted_at < datetime('now', ?)
+            )) WHERE id = 1
+        """, (cutoff,))
+        cursor.execute("DELETE FROM todo_tombstones WHERE deleted_at < datetime('now', ?)", (cutoff,))
+
+def init_stats_schema(cursor: sqlite3.Cursor):
+    """
+    创建任务计数表 todo_stats 及维护触发器
+
+    只有一行，记录任务总数和已完成数 (未完成数由两者相减)，每插入、删除一行
+    或完成状态变化时由触发器增减，统计接口只读这一行，不需要扫描 todos。
+    表第一次创建时按现有数据初始化。
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS todo_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total INTEGER NOT NULL,
+            completed INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO todo_stats (id, total, completed)
+        SELECT 1, COUNT(*), COALESCE(SUM(completed IS TRUE), 0) FROM todos
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS todos_stats_insert AFTER INSERT ON todos
+        BEGIN
+            UPDATE todo_stats SET total = total + 1, completed = completed + (NEW.completed IS TRUE)
+            WHERE id = 1;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS todos_stats_delete AFTER DELETE ON todos
+        BEGIN
+            UPDATE todo_stats SET total = total - 1, completed = completed - (OLD.completed IS TRUE)
+            WHERE id = 1;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS todos_stats_update AFTER UPDATE OF completed ON todos
+        WHEN (OLD.completed IS TRUE) != (NEW.completed IS TRUE)
+        BEGIN
+            UPDATE todo_stats SET completed = completed + (NEW.completed IS TRUE) - (OLD.completed IS TRUE)
+            WHERE id = 1;
+        END
+    """)
+
+def init_search_schema(cursor: sqlite3.Cursor) -> bool:
+    """
+    创建标题全文索引 todos_fts 及同步触发器，返回全文索引是否可用
+
+    FTS5 的 trigram 分词按每三个连续字符建索引，不依赖空格切词，中文标题也能
+    匹配任意位置的子串 (默认的 unicode61 分词会把一整段中文当成一个词)。
+    todos_fts 是外部内容表，只保存索引，标题仍从 todos 读取。
+    SQLite 未编译 FTS5 或低于 3.34 (没有 trigram) 时跳过，搜索退回全表扫描。
+    """
+    exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'todos_fts'").fetchone()
+    try:
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS todos_fts USING fts5(
+                title, content='todos', content_rowid='id', tokenize='trigram'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        print(f"全文索引不可用，搜索将使用全表扫描: {e}")
+        return False
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS todos_fts_insert AFTER INSERT ON todos
+        BEGIN
+            INSERT INTO todos_fts (rowid, title) VALUES (NEW.id, NEW.title);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS todos_fts_delete AFTER DELETE ON todos
+        BEGIN
+            INSERT INTO todos_fts (todos_fts, rowid, title) VALUES ('delete', OLD.id, OLD.title);
+        END
+    """)
+    # 更新语句总会写 title 列 (COALESCE 保留原值)，标题真正变化时才重建这一行的索引
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS todos_fts_update AFTER UPDATE OF title ON todos
+        WHEN OLD.title IS NOT NEW.title
+        BEGIN
+            INSERT INTO todos_fts (todos_fts, rowid, title) VALUES ('delete', OLD.id, OLD.title);
+            INSERT INTO todos_fts (rowid, title) VALUES (NEW.id, NEW.title);
+        END
+    """)
+
+    # 已有数据的库第一次创建索引时补建
+    if not exists:
+        cursor.execute("INSERT INTO todos_fts (todos_fts) VALUES ('rebuild')")
+    return True
+
 def get_db():
     """
     获取数据库连接的生成器函数
@@ -0,0 +1,172 @@
+"""
+任务变更事件模块 (进程内发布/订阅)
+"""
+import asyncio
+import json
+import os
+from collections import deque
+from typing import List, Optional
+
+# 保留最近多少条事件用于断线续传
+EVENTS_HISTORY_SIZE = int(os.environ.get("EVENTS_HISTORY_SIZE", "1000"))
+
+# 每个订阅者最多积压多少条未发送的事件，超过后视为跟不上
+EVENTS_QUEUE_SIZE = int(os.environ.get("EVENTS_QUEUE_SIZE", "256"))
+
+# 没有事件时发送心跳注释的间隔 (秒)，防止代理关闭空闲连接
+EVENTS_KEEPALIVE_SECONDS = float(os.environ.get("EVENTS_KEEPALIVE_SECONDS", "15"))
+
+class Event:
+    """一条变更事件，发布时就格式化为 SSE 文本，所有订阅者共用"""
+
+    __slots__ = ("seq", "id", "type", "text")
+
+    def __init__(self, seq: int, event_id: str, event_type: str, data):
+        self.seq = seq
+        self.id = event_id
+        self.type = event_type
+        payload = json.dumps(data, ensure_ascii=False)
+        self.text = f"id: {event_id}\nevent: {event_type}\ndata: {payload}\n\n"
+
+class Subscription:
+    """
+    单个订阅者的待发送队列
+
+    队列有上限：慢消费者积压超过 max_pending 条时不再继续缓存，
+    而是标记为 lagged，由 SSE 连接发送 reset 事件后关闭，客户端重新拉取全量列表。
+    这样一个卡住的连接不会让服务端内存无限增长，也不会拖慢发布方。
+    """
+
+    def __init__(self, max_pending: int):
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.lagged = False
+        self.closed = False
+        self._waiter = None
+
+    def offer(self, event: Event):
+        """投递事件 (只能在事件循环线程中调用)，不会阻塞"""
+        if self.lagged or self.closed:
+            return
+        if len(self.pending) >= self.max_pending:
+            self.lagged = True
+            self.pending.clear()
+        else:
+            self.pending.append(event)
+        self._wake()
+
+    def close(self):
+        self.closed = True
+        self._wake()
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def next_batch(self, timeout: float) -> List[Event]:
+        """
+        等待并取出所有待发送事件，超时返回空列表
+
+        直接等待一个 Future 并用 call_later 处理超时，而不是 asyncio.wait_for：
+        后者每次调用都要创建一个 Task，订阅者成千上万时扇出开销会成倍增加。
+        """
+        if not self.pending and not self.lagged and not self.closed:
+            loop = asyncio.get_running_loop()
+            self._waiter = loop.create_future()
+            timer = loop.call_later(timeout, self._wake)
+            try:
+                await self._waiter
+            finally:
+                timer.cancel()
+                self._waiter = None
+        batch = list(self.pending)
+        self.pending.clear()
+        return batch
+
+class EventBus:
+    """
+    进程内事件总线
+
+    事件 ID 形如 "{epoch}-{序号}"，epoch 每次启动随机生成：客户端带着上个进程的
+    Last-Event-ID 重连时无法续传，会收到 reset。最近 history_size 条事件保存在
+    环形缓冲区中，续传时从中补发；要求的位置已经滚出缓冲区时同样返回 reset。
+
+    publish 和 subscribe 都必须在事件循环线程中调用 (路由处理函数中即可)。
+    """
+
+    def __init__(self, history_size: int = 1000, max_pending: int = 256):
+        self.epoch = os.urandom(4).hex()
+        self.max_pending = max_pending
+        self._seq = 0
+        self._history = deque(maxlen=history_size)
+        self._subscribers = set()
+        self.published = 0
+        self.lagged = 0
+
+    @property
+    def last_event_id(self) -> str:
+        return f"{self.epoch}-{self._seq}"
+
+    def publish(self, event_type: str, data) -> Event:
+        """发布事件，推送给所有订阅者"""
+        self._seq += 1
+        event = Event(self._seq, f"{self.epoch}-{self._seq}", event_type, data)
+        self._history.append(event)
+        self.published += 1
+        for subscription in self._subscribers:
+            was_lagged = subscription.lagged
+            subscription.offer(event)
+            if subscription.lagged and not was_lagged:
+                self.lagged += 1
+        return event
+
+    def _resume_seq(self, last_event_id: str) -> Optional[int]:
+        """解析 Last-Event-ID，无法从缓冲区续传时返回 None"""
+        epoch, _, seq = last_event_id.rpartition("-")
+        if epoch != self.epoch or not seq.isdigit() or int(seq) > self._seq:
+            return None
+        oldest = self._history[0].seq if self._history else self._seq + 1
+        if int(seq) + 1 < oldest:
+            return None
+        return int(seq)
+
+    def subscribe(self, last_event_id: Optional[str] = None) -> Subscription:
+        """
+        新建订阅
+
+        Args:
+            last_event_id: 客户端收到的最后一个事件 ID，传入时先补发之后的事件
+        """
+        subscription = Subscription(self.max_pending)
+        if last_event_id:
+            seq = self._resume_seq(last_event_id)
+            if seq is None:
+                subscription.lagged = True
+            else:
+                for event in self._history:
+                    if event.seq > seq:
+                        subscription.offer(event)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscribers.discard(subscription)
+
+    def close(self):
+        """关闭所有订阅 (应用关闭时调用，让 SSE 连接尽快结束)"""
+        for subscription in list(self._subscribers):
+            subscription.close()
+        self._subscribers.clear()
+
+    def stats(self) -> dict:
+        """返回事件总线当前状态"""
+        return {
+            "subscribers": len(self._subscribers),
+            "last_event_id": self.last_event_id,
+            "published": self.published,
+            "history": len(self._history),
+            "lagged": self.lagged,
+        }
+
+# 全局事件总线
+event_bus = EventBus(EVENTS_HISTORY_SIZE, EVENTS_QUEUE_SIZE)
@@ -0,0 +1,100 @@
+"""
+就绪检查模块
+
+/health 只说明进程还在运行；/health/ready 经由数据库线程池实际访问一次存储
+(取连接、执行 SELECT 1，可选地验证可写)，报告各步耗时和连接池占用。
+访问失败、超时或总耗时超过 READINESS_MAX_LATENCY_MS 时返回 503，负载均衡器据此
+暂停向本实例转发请求。总耗时包含在线程池中排队和等待连接的时间，连接池用满时
+也会反映为延迟升高。
+
+结果缓存 READINESS_CACHE_TTL 秒，同时到达的探测共用同一次检查，探测频率再高
+也不会给数据库增加压力。
+"""
+import asyncio
+import os
+import time
+from typing import Optional, Tuple
+
+from database import get_pool, run_db
+from repository import SqliteTodoRepository, get_repository
+
+# 检查结果的缓存时间 (秒)，设为 0 时每次探测都访问存储
+READINESS_CACHE_TTL = float(os.environ.get("READINESS_CACHE_TTL", "2"))
+
+# 访问存储的总耗时超过该值 (毫秒) 时视为未就绪
+READINESS_MAX_LATENCY_MS = float(os.environ.get("READINESS_MAX_LATENCY_MS", "250"))
+
+# 访问存储的最长等待时间 (秒)，超时视为未就绪
+READINESS_TIMEOUT = float(os.environ.get("READINESS_TIMEOUT", "2"))
+
+# 设为 1 时同时验证存储可写 (SQLite 申请写锁后回滚，Postgres 分配事务号，KV 写探测键)
+READINESS_WRITE_PROBE = os.environ.get("READINESS_WRITE_PROBE", "0").lower() in ("1", "true", "yes")
+
+class ReadinessCheck:
+    """带短时缓存的存储就绪检查"""
+
+    def __init__(self, cache_ttl: float = 2, max_latency_ms: float = 250, timeout: float = 2,
+                 write_probe: bool = False):
+        self.cache_ttl = cache_ttl
+        self.max_latency_ms = max_latency_ms
+        self.timeout = timeout
+        self.write_probe = write_probe
+        self._result: Optional[dict] = None
+        self._checked_at = float("-inf")
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def check(self) -> Tuple[bool, dict]:
+        """返回 (是否就绪, 检查结果)，缓存未过期时直接返回上次的结果"""
+        result = self._cached()
+        if result is None:
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                # 等锁期间其他探测可能已经完成了检查
+                result = self._cached()
+                if result is None:
+                    result = await self._probe()
+                    self._result = result
+                    self._checked_at = time.monotonic()
+                    return result["status"] == "ready", {**result, "cached": False, "age": 0.0}
+        age = round(time.monotonic() - self._checked_at, 3)
+        return result["status"] == "ready", {**result, "cached": True, "age": age}
+
+    def _cached(self) -> Optional[dict]:
+        if self._result is not None and time.monotonic() - self._checked_at < self.cache_ttl:
+            return self._result
+        return None
+
+    async def _probe(self) -> dict:
+        repository = get_repository()
+        result = {
+            "status": "ready",
+            "engine": type(repository).__name__,
+            "max_latency_ms": self.max_latency_ms,
+            "checked_at": time.time(),
+        }
+        started = time.perf_counter()
+        try:
+            result["storage"] = await asyncio.wait_for(
+                run_db(repository.ping, self.write_probe), self.timeout)
+        except asyncio.TimeoutError:
+            result["status"] = "not_ready"
+            result["reason"] = f"存储在 {self.timeout} 秒内没有响应"
+        except Exception as e:
+            result["status"] = "not_ready"
+            result["reason"] = f"访问存储失败: {e}"
+        latency_ms = round((time.perf_counter() - started) * 1000, 3)
+        result["latency_ms"] = latency_ms
+        if result["status"] == "ready" and latency_ms > self.max_latency_ms:
+            result["status"] = "not_ready"
+            result["reason"] = f"存储延迟 {latency_ms}ms 超过阈值 {self.max_latency_ms}ms"
+
+        if isinstance(repository, SqliteTodoRepository):
+            pool = get_pool().stats()
+            pool["saturation"] = round(pool["in_use"] / pool["size"], 3) if pool["size"] else 0.0
+            result["pool"] = pool
+        return result
+
+# 全局就绪检查
+readiness = ReadinessCheck(READINESS_CACHE_TTL, READINESS_MAX_LATENCY_MS, READINESS_TIMEOUT,
+                           READINESS_WRITE_PROBE)
@@ -1,13 +1,21 @@
 """
 FastAPI主应用入口
 """
+import asyncio
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 import uvicorn
 
-from database import init_database
-from routers import todos
+from cache import list_cache
+from database import init_database, close_pool, statements
+from events import event_bus
+from health import readiness
+from metrics import METRICS_ENABLED, MetricsMiddleware, metrics
+from profiling import ProfilingMiddleware
+from routers import debug, todos
+from schema import DB_OPTIMIZE_INTERVAL, run_optimizer
 
 # 创建FastAPI应用实例
 app = FastAPI(
@@ -36,18 +44,39 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Next-Offset", "X-Cache", "ETag"],
 )
 
+# 按需剖析中间件，只在设置了管理员令牌 (用于签名和预约) 时安装
+if debug.ADMIN_TOKEN:
+    app.add_middleware(ProfilingMiddleware, secret=debug.ADMIN_TOKEN)
+
+# 请求指标中间件 (最后添加的中间件在最外层，耗时包含 CORS 和剖析的开销)
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
 # 注册路由
 app.include_router(todos.router, prefix="/api/v1")
+app.include_router(debug.router)
 
 @app.on_event("startup")
 async def startup_event():
-    """应用启动时初始化数据库"""
+    """应用启动时初始化数据库，并在后台定期更新查询规划器的统计信息"""
     init_database()
+    if DB_OPTIMIZE_INTERVAL > 0:
+        app.state.optimizer = asyncio.create_task(run_optimizer())
     print("🚀 Todo API 服务启动成功！")
     print("📖 API文档地址: http://localhost:8000/docs")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """应用关闭时结束事件流、停止后台任务并释放连接池"""
+    event_bus.close()
+    optimizer = getattr(app.state, "optimizer", None)
+    if optimizer is not None:
+        optimizer.cancel()
+    close_pool()
+
 @app.get("/")
 async def root():
     """根路径，返回API信息"""
@@ -60,8 +89,30 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    """健康检查接口"""
-    return {"status": "healthy", "message": "服务运行正常"}
+    """健康检查接口 (存活检查，不访问存储，见 /health/ready)"""
+    return {
+        "status": "healthy",
+        "message": "服务运行正常",
+        "cache": list_cache.stats(),
+        "events": event_bus.stats(),
+        "statements": statements.stats(),
+    }
+
+@app.get("/health/ready")
+async def readiness_check():
+    """就绪检查接口：实际访问一次存储，未就绪时返回 503 (结果短时缓存)"""
+    ready, result = await readiness.check()
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content=result,
+        headers={"Cache-Control": "no-store"}
+    )
+
+if METRICS_ENABLED:
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics_endpoint():
+        """Prometheus 指标"""
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 # 全局异常处理
 @app.exception_handler(Exception)
@@ -80,6 +131,8 @@ if __name__ == "__main__":
         host="0.0.0.0",
         port=port,
         reload=False,  # 生产环境关闭热重载
-        log_level="info"
+        log_level="info",
+        # SSE 事件流是长连接，关闭时最多等待这么多秒后强制结束
+        timeout_graceful_shutdown=int(os.environ.get("SHUTDOWN_TIMEOUT", "5"))
     )
 
@@ -0,0 +1,244 @@
+"""
+请求指标模块
+
+MetricsMiddleware 是纯 ASGI 中间件，每个请求记录:
+- 按路由模板 (如 /api/v1/todos/{todo_id}) 分组的延迟分布和状态码计数
+- 请求期间执行的 SQL 语句数 (StatementRegistry 和 Postgres 存储上报)
+- 等待和占用数据库连接的时间 (get_db_connection 上报)
+- 正在处理的请求数
+
+请求级的计数放在 contextvar 中，run_db 把上下文带进数据库线程池，
+存储层在哪个线程执行都能记到发起它的请求上。/metrics 以 Prometheus 文本格式输出。
+"""
+import bisect
+import contextvars
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# 设为 0 时不安装中间件，也不提供 /metrics
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1").lower() not in ("0", "false", "no")
+
+# 直方图的桶上界
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+# 没有匹配到路由的请求 (404 等) 统一记为这个标签，避免任意路径撑大标签集合
+UNMATCHED_ROUTE = "unmatched"
+
+class RequestMetrics:
+    """单个请求的数据库使用情况"""
+
+    __slots__ = ("queries", "db_wait", "db_held")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_wait = 0.0
+        self.db_held = 0.0
+
+_current: contextvars.ContextVar[Optional[RequestMetrics]] = contextvars.ContextVar("request_metrics", default=None)
+
+def record_query(count: int = 1):
+    """记录当前请求执行了 count 条 SQL 语句，不在请求中时忽略"""
+    current = _current.get()
+    if current is not None:
+        current.queries += count
+
+def record_connection(wait: float, held: float):
+    """记录当前请求等待连接和占用连接的时间 (秒)"""
+    current = _current.get()
+    if current is not None:
+        current.db_wait += wait
+        current.db_held += held
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return ",".join(pairs)
+
+class Counter:
+    """按标签分组的累计计数"""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str]):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Tuple[str, ...], amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{{{_format_labels(self.labels, labels)}}} {value}")
+        return lines
+
+class Histogram:
+    """
+    固定桶的直方图
+
+    每组标签只保存各桶的计数 (非累计)、总和与次数，observe 是一次二分查找加几次整数加法；
+    累计计数在输出时才计算。
+    """
+
+    def __init__(self, name: str, help: str, labels: Sequence[str], buckets: Sequence[float]):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Tuple[str, ...], value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # 各桶计数 + 超出最大上界的计数 + 总和
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((labels, list(values)) for labels, values in self._series.items())
+        for labels, values in series:
+            prefix = _format_labels(self.labels, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix},le="{bound}"}} {cumulative}')
+            cumulative += values[-2]
+            lines.append(f'{self.name}_bucket{{{prefix},le="+Inf"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{prefix}}} {values[-1]}")
+            lines.append(f"{self.name}_count{{{prefix}}} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """进程内的全部请求指标"""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.requests = Counter(
+            "todo_http_requests_total", "处理完成的请求数", ("method", "route", "status"))
+        self.latency = Histogram(
+            "todo_http_request_duration_seconds", "请求处理耗时", ("method", "route"), LATENCY_BUCKETS)
+        self.queries = Histogram(
+            "todo_db_queries_per_request", "每个请求执行的 SQL 语句数", ("method", "route"), QUERY_COUNT_BUCKETS)
+        self.db_wait = Histogram(
+            "todo_db_connection_wait_seconds", "每个请求等待数据库连接的时间", ("method", "route"), LATENCY_BUCKETS)
+        self.db_held = Histogram(
+            "todo_db_connection_held_seconds", "每个请求占用数据库连接的时间", ("method", "route"), LATENCY_BUCKETS)
+
+    def observe(self, method: str, route: str, status: int, elapsed: float, request: RequestMetrics):
+        """记录一个处理完成的请求"""
+        labels = (method, route)
+        self.requests.inc((method, route, str(status)))
+        self.latency.observe(labels, elapsed)
+        self.queries.observe(labels, request.queries)
+        # 没有访问数据库的请求 (缓存命中、304 等) 不计入连接时间分布
+        if request.queries:
+            self.db_wait.observe(labels, request.db_wait)
+            self.db_held.observe(labels, request.db_held)
+
+    def render(self) -> str:
+        """以 Prometheus 文本格式输出全部指标"""
+        lines = [
+            "# HELP todo_http_requests_in_flight 正在处理的请求数",
+            "# TYPE todo_http_requests_in_flight gauge",
+            f"todo_http_requests_in_flight {self.in_flight}",
+        ]
+        for metric in (self.requests, self.latency, self.queries, self.db_wait, self.db_held):
+            lines.extend(metric.render())
+        lines.extend(_runtime_lines())
+        return "\n".join(lines) + "\n"
+
+def _gauge(name: str, help: str, samples: Dict[str, float], label: Optional[str] = None,
+           kind: str = "gauge") -> List[str]:
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for value_label, value in samples.items():
+        suffix = f'{{{label}="{value_label}"}}' if label else ""
+        lines.append(f"{name}{suffix} {value}")
+    return lines
+
+def _runtime_lines() -> List[str]:
+    """连接池、列表缓存和语句注册表的当前状态 (与 /health 中的数据相同)"""
+    from cache import list_cache
+    from database import get_pool, statements
+
+    pool = get_pool().stats()
+    cache = list_cache.stats()
+    registry = statements.stats()
+    return (
+        _gauge("todo_db_pool_size", "连接池容量", {"": pool["size"]})
+        + _gauge("todo_db_pool_connections", "连接池中的连接数", {
+            "in_use": pool["in_use"], "idle": pool["idle"]}, label="state")
+        + _gauge("todo_list_cache_lookups_total", "列表缓存查找次数", {
+            "hit": cache["hits"], "miss": cache["misses"]}, label="result", kind="counter")
+        + _gauge("todo_db_statements_total", "注册语句的执行次数", {
+            "prepare": registry["prepares"], "hit": registry["hits"]}, label="result", kind="counter")
+    )
+
+def _route_of(scope: dict) -> str:
+    """返回请求匹配到的路由模板"""
+    endpoint = scope.get("endpoint")
+    app = scope.get("app")
+    if endpoint is None or app is None:
+        return UNMATCHED_ROUTE
+    routes = getattr(app.state, "metrics_routes", None)
+    if routes is None:
+        routes = {}
+        for route in app.routes:
+            routes.setdefault(getattr(route, "endpoint", None), getattr(route, "path", UNMATCHED_ROUTE))
+        app.state.metrics_routes = routes
+    return routes.get(endpoint, UNMATCHED_ROUTE)
+
+class MetricsMiddleware:
+    """
+    记录请求指标的 ASGI 中间件
+
+    不使用 BaseHTTPMiddleware：它为每个请求额外创建任务和内存流，开销远大于这里的计数本身。
+    路由匹配后 Starlette 把 endpoint 写回 scope，请求结束时据此得到路由模板。
+    """
+
+    def __init__(self, app, registry: Optional[MetricsRegistry] = None):
+        self.app = app
+        self.registry = registry or metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request = RequestMetrics()
+        token = _current.set(request)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        registry = self.registry
+        registry.in_flight += 1
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            registry.in_flight -= 1
+            _current.reset(token)
+            registry.observe(scope["method"], _route_of(scope), status, elapsed, request)
+
+# 全局指标
+metrics = MetricsRegistry()
@@ -2,7 +2,7 @@
 数据库模型定义
 """
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 from pydantic import BaseModel
 
 class TodoBase(BaseModel):
@@ -19,6 +19,14 @@ class TodoUpdate(BaseModel):
     title: Optional[str] = None
     completed: Optional[bool] = None
 
+class TodoBatchUpdate(TodoUpdate):
+    """批量更新中的单个Todo"""
+    id: int
+
+class TodoBatchDelete(BaseModel):
+    """批量删除的请求模型"""
+    ids: List[int]
+
 class Todo(TodoBase):
     """Todo完整模型"""
     id: int
@@ -36,6 +44,20 @@ class TodoResponse(BaseModel):
     created_at: str
     updated_at: str
 
+class TodoChangesResponse(BaseModel):
+    """增量同步响应模型"""
+    version: int
+    reset: bool
+    has_more: bool
+    upserts: List[TodoResponse]
+    deleted: List[int]
+
+class TodoStatsResponse(BaseModel):
+    """任务数量统计响应模型"""
+    total: int
+    active: int
+    completed: int
+
 class MessageResponse(BaseModel):
     """消息响应模型"""
     message: str
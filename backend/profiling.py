@@ -0,0 +1,377 @@
+"""
+按需性能剖析模块
+
+带有效签名请求头 X-Profile 的请求，或经管理接口预约的请求，在剖析器下执行:
+- sample (默认): 采样线程每 PROFILE_SAMPLE_INTERVAL 秒记录一次事件循环线程和正在为该请求
+  执行查询的数据库线程的调用栈，结果为 folded stacks 格式 (flamegraph.pl、speedscope 可直接读取)
+- cprofile: 在同样的线程中启用 cProfile，结果为 pstats 数据 (snakeviz、flameprof 可读取)
+
+请求期间事件循环线程也在处理其他请求，结果会混入它们的调用栈，应在负载较低时使用。
+同一时间最多剖析一个请求，每分钟最多 PROFILE_MAX_PER_MINUTE 个；超出时请求照常处理，
+响应头 X-Profile-Skipped 说明原因。结果保留最近 PROFILE_STORE_SIZE 份，响应头 X-Profile-Id 给出编号。
+"""
+import asyncio
+import contextvars
+import cProfile
+import hashlib
+import hmac
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Dict, List, Optional, Tuple
+
+# 采样间隔 (秒)；很短的请求可能一个样本都没有，改用 cprofile 模式
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0.001"))
+
+# 每分钟最多剖析的请求数
+PROFILE_MAX_PER_MINUTE = int(os.environ.get("PROFILE_MAX_PER_MINUTE", "6"))
+
+# 单次剖析的最长时间 (秒)，超过后结束剖析并释放名额 (事件流等长连接)
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "30"))
+
+# 保留的剖析结果份数
+PROFILE_STORE_SIZE = int(os.environ.get("PROFILE_STORE_SIZE", "20"))
+
+# 签名请求头允许的最长有效期 (秒)
+PROFILE_TOKEN_MAX_TTL = 3600
+
+MODES = ("sample", "cprofile")
+
+def sign(secret: str, path: str = "*", ttl: int = 300) -> str:
+    """
+    生成 X-Profile 请求头的值: "<过期时间戳>.<签名>"
+
+    Args:
+        secret: 签名密钥 (ADMIN_TOKEN)
+        path: 允许剖析的请求路径，"*" 表示任意路径
+        ttl: 有效期 (秒)
+    """
+    expires = int(time.time()) + min(ttl, PROFILE_TOKEN_MAX_TTL)
+    return f"{expires}.{_signature(secret, expires, path)}"
+
+def _signature(secret: str, expires: int, path: str) -> str:
+    return hmac.new(secret.encode(), f"{expires}:{path}".encode(), hashlib.sha256).hexdigest()
+
+def verify(secret: str, value: str, path: str) -> bool:
+    """校验 X-Profile 请求头：未过期，且签名对应当前路径或 "*" """
+    expires, _, signature = value.partition(".")
+    try:
+        expires = int(expires)
+    except ValueError:
+        return False
+    if expires < time.time() or expires > time.time() + PROFILE_TOKEN_MAX_TTL:
+        return False
+    return any(hmac.compare_digest(signature, _signature(secret, expires, allowed))
+               for allowed in (path, "*"))
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    filename = "/".join(code.co_filename.replace("\\", "/").rsplit("/", 2)[-2:])
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+
+def _fold(frame, root: str) -> str:
+    """把调用栈转成 folded stacks 的一行 (根在前，以 ; 分隔)"""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.append(root)
+    return ";".join(reversed(names))
+
+class ProfileSession:
+    """一次请求的剖析"""
+
+    def __init__(self, profile_id: str, mode: str, method: str, path: str):
+        self.id = profile_id
+        self.mode = mode
+        self.method = method
+        self.path = path
+        self.status: Optional[int] = None
+        self.started_at = time.time()
+        self.duration = 0.0
+        self.samples = 0
+        self.stopped = False
+        self._threads: Dict[int, Tuple[str, int]] = {}
+        self._stacks: Counter = Counter()
+        self._stats: Optional[pstats.Stats] = None
+        self._profiler: Optional[cProfile.Profile] = None
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """在事件循环线程中开始剖析"""
+        self._started = time.perf_counter()
+        if self.mode == "sample":
+            self._track(threading.get_ident(), "event-loop")
+            self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+            self._sampler.start()
+        else:
+            self._profiler = self._enable_profiler()
+
+    def stop(self, status: Optional[int]):
+        """在事件循环线程中结束剖析"""
+        self.duration = time.perf_counter() - self._started
+        self.status = status
+        self.stopped = True
+        # 只通知采样线程退出，不在事件循环线程中等待；之后不会再有新的样本写入
+        self._stop.set()
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._merge(self._profiler)
+
+    def run(self, call):
+        """在数据库线程中执行 call，期间该线程也被剖析"""
+        if self.stopped:
+            return call()
+        if self.mode == "sample":
+            tid = threading.get_ident()
+            self._track(tid, "db-thread")
+            try:
+                return call()
+            finally:
+                self._untrack(tid)
+        profiler = self._enable_profiler()
+        try:
+            return call()
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._merge(profiler)
+
+    @staticmethod
+    def _enable_profiler() -> Optional[cProfile.Profile]:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12 起 cProfile 基于 sys.monitoring，对所有线程生效且同时只能启用一个；
+            # 事件循环线程上启用的那个已经覆盖了数据库线程
+            return None
+        return profiler
+
+    def _merge(self, profiler: cProfile.Profile):
+        with self._lock:
+            if self.stopped and self._profiler is not profiler:
+                return
+            if self._stats is None:
+                self._stats = pstats.Stats(profiler)
+            else:
+                self._stats.add(profiler)
+
+    def _track(self, tid: int, label: str):
+        with self._lock:
+            _, depth = self._threads.get(tid, (label, 0))
+            self._threads[tid] = (label, depth + 1)
+
+    def _untrack(self, tid: int):
+        with self._lock:
+            label, depth = self._threads[tid]
+            if depth > 1:
+                self._threads[tid] = (label, depth - 1)
+            else:
+                del self._threads[tid]
+
+    def _sample(self):
+        deadline = time.monotonic() + PROFILE_MAX_SECONDS
+        while not self._stop.wait(PROFILE_SAMPLE_INTERVAL) and time.monotonic() < deadline:
+            frames = sys._current_frames()
+            with self._lock:
+                threads = list(self._threads.items())
+            stacks = []
+            for tid, (label, _) in threads:
+                frame = frames.get(tid)
+                if frame is not None:
+                    stacks.append(_fold(frame, label))
+            with self._lock:
+                if self._stop.is_set():
+                    break
+                self._stacks.update(stacks)
+                self.samples += len(stacks)
+
+    def folded(self) -> str:
+        """folded stacks 文本，每行 "栈;帧 样本数" """
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def pstats_data(self) -> bytes:
+        """与 cProfile 的 .prof 文件相同格式的数据"""
+        return marshal.dumps(self._stats.stats if self._stats is not None else {})
+
+    def summary(self, limit: int = 40) -> str:
+        """按累计耗时排序的文本报告"""
+        if self._stats is None:
+            return ""
+        stream = io.StringIO()
+        stats = pstats.Stats(stream=stream)
+        stats.add(self._stats)
+        stats.sort_stats("cumulative").print_stats(limit)
+        return stream.getvalue()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "mode": self.mode,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 3),
+            "samples": self.samples,
+        }
+
+class Profiler:
+    """剖析的准入控制 (并发、频率) 和结果存储"""
+
+    def __init__(self, max_per_minute: int = 6, store_size: int = 20):
+        self.max_per_minute = max_per_minute
+        self.store_size = store_size
+        self.armed: Dict[str, Tuple[int, str]] = {}
+        self._recent = deque()
+        self._active: Optional[ProfileSession] = None
+        self._profiles: "OrderedDict[str, ProfileSession]" = OrderedDict()
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def arm(self, path: str, count: int, mode: str = "sample"):
+        """预约剖析接下来 count 个访问 path 的请求 (仍受频率限制)"""
+        with self._lock:
+            self.armed[path] = (count, mode)
+
+    def take_armed(self, path: str) -> Optional[str]:
+        """path 有预约时消耗一次并返回预约的剖析方式"""
+        with self._lock:
+            if path not in self.armed:
+                return None
+            remaining, mode = self.armed[path]
+            if remaining == 1:
+                del self.armed[path]
+            else:
+                self.armed[path] = (remaining - 1, mode)
+            return mode
+
+    def armed_paths(self) -> Dict[str, dict]:
+        """当前的预约"""
+        with self._lock:
+            return {path: {"remaining": remaining, "mode": mode}
+                    for path, (remaining, mode) in self.armed.items()}
+
+    def begin(self, mode: str, method: str, path: str) -> Tuple[Optional[ProfileSession], Optional[str]]:
+        """
+        申请剖析一个请求
+
+        Returns:
+            (会话, None)，或不能剖析时 (None, 原因)
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._active is not None:
+                return None, "busy"
+            while self._recent and now - self._recent[0] > 60:
+                self._recent.popleft()
+            if len(self._recent) >= self.max_per_minute:
+                return None, "rate-limited"
+            self._recent.append(now)
+            self._sequence += 1
+            session = ProfileSession(f"{int(time.time())}-{self._sequence}", mode, method, path)
+            self._active = session
+        session.start()
+        return session, None
+
+    def finish(self, session: ProfileSession, status: Optional[int]):
+        """结束剖析并保存结果 (超时提前结束的会话在请求完成时再次调用，直接忽略)"""
+        if session.stopped:
+            return
+        session.stop(status)
+        with self._lock:
+            self._active = None
+            self._profiles[session.id] = session
+            while len(self._profiles) > self.store_size:
+                self._profiles.popitem(last=False)
+
+    def get(self, profile_id: str) -> Optional[ProfileSession]:
+        with self._lock:
+            return self._profiles.get(profile_id)
+
+    def list(self) -> List[dict]:
+        """已保存的剖析结果 (新的在前)"""
+        with self._lock:
+            return [session.to_dict() for session in reversed(self._profiles.values())]
+
+_session: contextvars.ContextVar[Optional[ProfileSession]] = contextvars.ContextVar("profile_session", default=None)
+
+def profile_call(call):
+    """执行 call；当前请求正在被剖析时，执行所在的线程也被剖析 (由 run_db 在数据库线程中调用)"""
+    session = _session.get()
+    if session is None:
+        return call()
+    return session.run(call)
+
+class ProfilingMiddleware:
+    """
+    按需剖析的 ASGI 中间件
+
+    只在请求带 X-Profile 头或路径已被预约时才有额外工作，其余请求只多一次请求头遍历。
+    """
+
+    def __init__(self, app, secret: str, registry: Optional[Profiler] = None):
+        self.app = app
+        self.secret = secret
+        self.registry = registry or profiler
+
+    def _requested_mode(self, scope) -> Optional[str]:
+        token = mode = None
+        for name, value in scope["headers"]:
+            if name == b"x-profile":
+                token = value.decode("latin-1")
+            elif name == b"x-profile-mode":
+                mode = value.decode("latin-1")
+        mode = mode if mode in MODES else MODES[0]
+        if token is not None and verify(self.secret, token, scope["path"]):
+            return mode
+        if self.registry.armed:
+            return self.registry.take_armed(scope["path"])
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        mode = self._requested_mode(scope)
+        if mode is None:
+            await self.app(scope, receive, send)
+            return
+
+        session, skipped = self.registry.begin(mode, scope["method"], scope["path"])
+        header = (b"x-profile-id", session.id.encode()) if session else (b"x-profile-skipped", skipped.encode())
+        status = None
+
+        async def send_with_header(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = dict(message, headers=list(message.get("headers", [])) + [header])
+            await send(message)
+
+        if session is None:
+            await self.app(scope, receive, send_with_header)
+            return
+        token = _session.set(session)
+        # 事件流等长连接超过 PROFILE_MAX_SECONDS 时提前结束剖析，释放名额，响应照常继续
+        timer = asyncio.get_running_loop().call_later(
+            PROFILE_MAX_SECONDS, lambda: self.registry.finish(session, status))
+        try:
+            await self.app(scope, receive, send_with_header)
+        finally:
+            timer.cancel()
+            _session.reset(token)
+            self.registry.finish(session, status)
+
+# 全局剖析器
+profiler = Profiler(PROFILE_MAX_PER_MINUTE, PROFILE_STORE_SIZE)
@@ -0,0 +1,311 @@
+"""
+SQL 慢查询日志模块
+
+TimedCursor (sqlite3) 和 TimedRealDictCursor (psycopg2) 记录每条语句的耗时，
+按语句指纹 (压缩空白；值拼进 SQL 时再替换字面量) 汇总调用次数、总耗时和最大耗时。
+超过 SLOW_QUERY_MS 的语句打印一行日志，带参数形状 (只有类型和长度，不含参数值)
+和执行计划，并保存在最近慢查询列表中，/debug/queries 按总耗时排序输出。
+
+执行计划每条语句最多每 SLOW_QUERY_EXPLAIN_INTERVAL 秒获取一次：
+SQLite 用 EXPLAIN QUERY PLAN；Postgres 对 SELECT 用 EXPLAIN (ANALYZE, BUFFERS)
+(会再执行一次查询)，写语句只用 EXPLAIN，不会重复写入。
+"""
+import functools
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+try:
+    from psycopg2 import Error as PostgresError
+    from psycopg2.extras import RealDictCursor
+except ImportError:  # Postgres 引擎是可选的
+    RealDictCursor = None
+
+# 设为 0 时不记录语句耗时 (连接和游标恢复为 sqlite3/psycopg2 默认实现)
+QUERY_LOG_ENABLED = os.environ.get("QUERY_LOG_ENABLED", "1").lower() not in ("0", "false", "no")
+
+# 慢查询阈值 (毫秒)
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "50"))
+
+# 保留的最近慢查询条数
+SLOW_QUERY_LOG_SIZE = int(os.environ.get("SLOW_QUERY_LOG_SIZE", "100"))
+
+# 同一条语句两次获取执行计划的最短间隔 (秒)，设为负数时不获取执行计划
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.environ.get("SLOW_QUERY_EXPLAIN_INTERVAL", "60"))
+
+# 最多汇总的不同语句数，超出时淘汰总耗时最少的一条
+QUERY_LOG_MAX_STATEMENTS = int(os.environ.get("QUERY_LOG_MAX_STATEMENTS", "256"))
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![\w$.])-?\d+(?:\.\d+)?\b")
+_VALUES_LIST = re.compile(r"\bVALUES\s*(\([^()]*\))(?:\s*,\s*\([^()]*\))*", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(sql, inlined: bool = False) -> str:
+    """
+    返回语句指纹，用作汇总的键
+
+    参数绑定的语句只压缩空白。inlined 表示值已拼进 SQL (psycopg2 的 execute_values)，
+    此时把字面量替换为 ?，并把多行 VALUES 折叠成一行，不同批次大小的同一语句归为一类，
+    日志中也不会出现参数值。
+    """
+    if isinstance(sql, bytes):
+        sql = sql.decode("utf-8", "replace")
+    if inlined:
+        sql = _STRING_LITERAL.sub("?", sql)
+        sql = _NUMBER_LITERAL.sub("?", sql)
+        sql = _VALUES_LIST.sub(r"VALUES \1, ...", sql)
+    return _WHITESPACE.sub(" ", sql).strip()
+
+def _value_shape(value) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, (str, bytes, list, tuple)):
+        return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
+
+def param_shape(params):
+    """参数的类型和长度，慢查询日志不记录参数值"""
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {name: _value_shape(value) for name, value in params.items()}
+    return [_value_shape(value) for value in params]
+
+class StatementStats:
+    """一条语句 (按指纹) 的汇总数据"""
+
+    __slots__ = ("sql", "calls", "total", "max", "slow", "params", "plan", "plan_at")
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+        self.params = None
+        self.plan: Optional[List[str]] = None
+        self.plan_at = float("-inf")
+
+    def to_dict(self) -> dict:
+        return {
+            "sql": self.sql,
+            "calls": self.calls,
+            "total_ms": round(self.total * 1000, 3),
+            "mean_ms": round(self.total / self.calls * 1000, 3) if self.calls else 0.0,
+            "max_ms": round(self.max * 1000, 3),
+            "slow_calls": self.slow,
+            "params": self.params,
+            "plan": self.plan,
+        }
+
+class QueryLog:
+    """按语句汇总耗时，并保留最近的慢查询"""
+
+    ORDERS = {
+        "total": lambda stats: stats.total,
+        "mean": lambda stats: stats.total / stats.calls,
+        "max": lambda stats: stats.max,
+        "calls": lambda stats: stats.calls,
+    }
+
+    def __init__(self, slow_ms: float = 50, log_size: int = 100, max_statements: int = 256,
+                 explain_interval: float = 60):
+        self.slow_ms = slow_ms
+        self.max_statements = max_statements
+        self.explain_interval = explain_interval
+        self._statements: Dict[str, StatementStats] = {}
+        self._slow = deque(maxlen=log_size)
+        self._lock = threading.Lock()
+
+    def record(self, sql, params, elapsed: float, explain: Optional[Callable[[], List[str]]] = None):
+        """
+        记录一次执行
+
+        Args:
+            sql: 执行的语句
+            params: 绑定参数，只记录形状；None 表示值已拼进 SQL
+            elapsed: 耗时 (秒)
+            explain: 获取执行计划的函数，只在慢查询且距上次获取超过间隔时调用
+        """
+        key = fingerprint(sql, params is None)
+        slow = elapsed * 1000 >= self.slow_ms
+        now = time.monotonic()
+        with self._lock:
+            stats = self._statements.get(key)
+            if stats is None:
+                if len(self._statements) >= self.max_statements:
+                    coldest = min(self._statements.values(), key=lambda item: item.total)
+                    del self._statements[coldest.sql]
+                stats = self._statements[key] = StatementStats(key)
+            stats.calls += 1
+            stats.total += elapsed
+            stats.max = max(stats.max, elapsed)
+            if not slow:
+                return
+            stats.slow += 1
+            stats.params = param_shape(params)
+            refresh = (explain is not None and self.explain_interval >= 0
+                       and now - stats.plan_at >= self.explain_interval)
+            if refresh:
+                stats.plan_at = now
+
+        plan = explain() if refresh else stats.plan
+        entry = {
+            "sql": key,
+            "elapsed_ms": round(elapsed * 1000, 3),
+            "params": stats.params,
+            "plan": plan,
+            "at": time.time(),
+        }
+        with self._lock:
+            if refresh:
+                stats.plan = plan
+            self._slow.append(entry)
+        print(f"慢查询 {entry['elapsed_ms']}ms: {key} 参数 {entry['params']}"
+              + (f" 执行计划: {' | '.join(plan)}" if plan else ""))
+
+    def report(self, limit: int = 20, order: str = "total") -> dict:
+        """按 order 排序返回前 limit 条语句的汇总，以及最近的慢查询 (新的在前)"""
+        with self._lock:
+            ranked = sorted(self._statements.values(), key=self.ORDERS[order], reverse=True)
+            return {
+                "slow_query_ms": self.slow_ms,
+                "tracked": len(self._statements),
+                "statements": [stats.to_dict() for stats in ranked[:limit]],
+                "slow": list(reversed(self._slow)),
+            }
+
+    def clear(self):
+        """清空汇总和慢查询记录"""
+        with self._lock:
+            self._statements.clear()
+            self._slow.clear()
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    记录语句耗时的 sqlite3 游标
+
+    SQLite 的 execute 只算出第一行，其余的行在 fetch 时才逐步计算，所以 fetch 的耗时
+    也计入同一条语句；语句在结果取完、游标执行下一条语句或关闭时入账。
+    没有结果集的语句 (不带 RETURNING 的写入等) 执行完立即入账；fetchone 用于只取一行的
+    语句 (按ID查询、RETURNING 单行、计数)，取到一行后即入账，之后再取的耗时不再计入。
+    """
+
+    _pending = None
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        started = time.perf_counter()
+        super().execute(sql, parameters)
+        self._pending = [sql, parameters, time.perf_counter() - started]
+        if self.description is None:
+            self._finish()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        started = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        # 参数可能是生成器，已经消耗完，执行计划按全 NULL 参数获取
+        self._pending = [sql, (), time.perf_counter() - started]
+        self._finish()
+        return self
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._spend(time.perf_counter() - started, True)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._spend(time.perf_counter() - started, len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._spend(time.perf_counter() - started, True)
+        return rows
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # 只用 fetchmany 取了部分结果就丢弃的游标: 照常入账，但不在析构时再执行 EXPLAIN
+        # (析构可能发生在任意线程，连接此时可能已归还连接池)
+        self._finish(explain=False)
+
+    def _spend(self, elapsed: float, exhausted: bool):
+        if self._pending is not None:
+            self._pending[2] += elapsed
+            if exhausted:
+                self._finish()
+
+    def _finish(self, explain: bool = True):
+        pending, self._pending = self._pending, None
+        if pending is None:
+            return
+        sql, params, elapsed = pending
+        query_log.record(sql, params, elapsed,
+                         functools.partial(self._explain, sql, params) if explain else None)
+
+    def _explain(self, sql: str, params) -> List[str]:
+        from schema import _null_params
+
+        try:
+            cursor = sqlite3.Cursor(self.connection)
+            rows = cursor.execute("EXPLAIN QUERY PLAN " + sql, params or _null_params(sql)).fetchall()
+            return [row[3] for row in rows]
+        except sqlite3.Error as e:
+            return [f"EXPLAIN 失败: {e}"]
+
+if RealDictCursor is not None:
+    class TimedRealDictCursor(RealDictCursor):
+        """
+        记录语句耗时的 psycopg2 游标
+
+        psycopg2 的 execute 会把结果全部取回客户端，计时已包含取数。
+        execute_values 也经由 execute 执行，同样会被记录。
+        """
+
+        def execute(self, query, vars=None):
+            started = time.perf_counter()
+            result = super().execute(query, vars)
+            query_log.record(query, vars, time.perf_counter() - started, self._explain)
+            return result
+
+        def _explain(self) -> List[str]:
+            # self.query 是实际发送的语句 (参数已绑定)
+            sql = self.query
+            analyze = sql.lstrip().upper().startswith(b"SELECT")
+            prefix = b"EXPLAIN (ANALYZE, BUFFERS) " if analyze else b"EXPLAIN "
+            transactional = not self.connection.autocommit
+            # 在保存点中执行，EXPLAIN 出错时不影响外层事务
+            with self.connection.cursor() as cursor:
+                try:
+                    if transactional:
+                        cursor.execute("SAVEPOINT query_log_explain")
+                    cursor.execute(prefix + sql)
+                    plan = [row[0] for row in cursor.fetchall()]
+                    if transactional:
+                        cursor.execute("RELEASE SAVEPOINT query_log_explain")
+                    return plan
+                except PostgresError as e:
+                    if transactional:
+                        cursor.execute("ROLLBACK TO SAVEPOINT query_log_explain")
+                    return [f"EXPLAIN 失败: {e}"]
+else:
+    TimedRealDictCursor = None
+
+# 全局慢查询日志
+query_log = QueryLog(SLOW_QUERY_MS, SLOW_QUERY_LOG_SIZE, QUERY_LOG_MAX_STATEMENTS, SLOW_QUERY_EXPLAIN_INTERVAL)
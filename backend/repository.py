@@ -0,0 +1,1083 @@
+"""
+Todo 数据访问层
+
+TodoRepository 定义所有存储引擎共同实现的接口，路由只依赖这个接口：
+- SqliteTodoRepository: 连接池中的 SQLite (backend 默认)
+- PostgresTodoRepository: 连接池中的 Postgres (psycopg2)
+- MemoryTodoRepository: 进程内存，带 ID 索引和按状态分开的有序索引
+- KVTodoRepository: Redis 风格的 KV 存储，每个任务一个键，有序集合做索引
+
+所有引擎都返回相同结构的字典:
+    {"id", "title", "completed", "created_at", "updated_at"}
+列表按 (created_at, id) 倒序，分页位置 after 是上一页最后一条的 (created_at, id)。
+"""
+import bisect
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import psycopg2
+    from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+    from psycopg2.extras import RealDictCursor
+except ImportError:  # Postgres 引擎是可选的
+    psycopg2 = None
+
+from metrics import record_connection, record_query
+
+# KV 引擎的键布局、读写操作和进程内替身在 api/_kvstore.py 中，与 api/todos_kv.py 共用
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api"))
+try:
+    import _kvstore as kvstore
+except ImportError:  # 单独部署 backend 目录时没有 api/，KV 引擎不可用
+    kvstore = None
+try:
+    # Postgres 的搜索语句和搜索词的拆分方式与 api/todos_postgres.py 共用
+    import todos_postgres as pg_handler
+except ImportError:  # 没有 api/ 或 psycopg2
+    pg_handler = None
+from querylog import QUERY_LOG_ENABLED, TimedRealDictCursor
+
+# (title, completed)
+NewTodo = Tuple[str, bool]
+# (id, title, completed)，None 表示不修改该字段
+TodoChange = Tuple[int, Optional[str], Optional[bool]]
+# 分页位置 (created_at, id)
+Position = Tuple[str, int]
+
+# SQLite 3.35 起支持 RETURNING，写入语句可以直接返回写入后的行
+SQLITE_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+class TodoNotFoundError(LookupError):
+    """批量更新时有任务不存在"""
+
+    def __init__(self, ids: List[int]):
+        super().__init__(f"任务不存在: {ids}")
+        self.ids = ids
+
+def _merge_changes(upserts: List[Tuple[int, dict]], deleted: List[Tuple[int, int]],
+                   limit: Optional[int], version: int, reset: bool) -> dict:
+    """
+    按版本号合并更新和删除记录，截取前 limit 条
+
+    upserts 和 deleted 都按版本号升序，元素为 (版本号, 任务) 和 (版本号, ID)。
+    截断时返回的 version 是本页最后一条变更的版本号，客户端用它请求下一页。
+    """
+    merged = sorted(
+        [(v, "upsert", todo) for v, todo in upserts] + [(v, "delete", todo_id) for v, todo_id in deleted],
+        key=lambda change: change[0]
+    )
+    has_more = limit is not None and len(merged) > limit
+    if has_more:
+        merged = merged[:limit]
+        version = merged[-1][0]
+    return {
+        "version": version,
+        "reset": reset,
+        "has_more": has_more,
+        "upserts": [item for _, kind, item in merged if kind == "upsert"],
+        "deleted": [item for _, kind, item in merged if kind == "delete"],
+    }
+
+def _search_terms(query: str) -> List[str]:
+    """把搜索词按空白拆分并转为小写，去掉重复的词"""
+    return list(dict.fromkeys(term.lower() for term in query.split()))
+
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 3)
+
+def _now() -> str:
+    """当前 UTC 时间，格式与 SQLite 的 CURRENT_TIMESTAMP 一致"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+class TodoRepository(ABC):
+    """Todo 存储接口"""
+
+    @abstractmethod
+    def list(self, status: Optional[str] = None, limit: Optional[int] = None,
+             after: Optional[Position] = None) -> List[dict]:
+        """按 (created_at, id) 倒序列出任务，status 为 active/completed 时只返回对应状态"""
+
+    def iter(self, status: Optional[str] = None, limit: Optional[int] = None,
+             after: Optional[Position] = None, batch_size: int = 500) -> Iterator[dict]:
+        """逐条返回任务，默认实现按 batch_size 分页调用 list"""
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = batch_size if remaining is None else min(batch_size, remaining)
+            page = self.list(status, size, after)
+            yield from page
+            if len(page) < size:
+                return
+            after = (page[-1]["created_at"], page[-1]["id"])
+            if remaining is not None:
+                remaining -= len(page)
+
+    @abstractmethod
+    def get(self, todo_id: int) -> Optional[dict]:
+        """按 ID 获取任务"""
+
+    @abstractmethod
+    def create(self, title: str, completed: bool = False) -> dict:
+        """创建任务"""
+
+    @abstractmethod
+    def create_many(self, todos: Sequence[NewTodo]) -> List[dict]:
+        """在一个事务中批量创建任务，返回顺序与输入一致"""
+
+    @abstractmethod
+    def update(self, todo_id: int, title: Optional[str] = None,
+               completed: Optional[bool] = None) -> Optional[dict]:
+        """更新任务，任务不存在时返回 None"""
+
+    @abstractmethod
+    def update_many(self, changes: Sequence[TodoChange]) -> List[dict]:
+        """
+        在一个事务中批量更新任务，返回顺序与输入一致
+
+        Raises:
+            TodoNotFoundError: 有任务不存在，此时不做任何修改
+        """
+
+    @abstractmethod
+    def delete(self, todo_id: int) -> bool:
+        """删除任务，返回是否删除成功"""
+
+    @abstractmethod
+    def delete_many(self, ids: Sequence[int]) -> List[int]:
+        """批量删除任务，返回实际删除的任务ID (按输入顺序，不存在的ID不包含在内)"""
+
+    @abstractmethod
+    def delete_completed(self) -> int:
+        """删除所有已完成任务，返回删除数量"""
+
+    @abstractmethod
+    def delete_all(self) -> int:
+        """清空所有任务，返回删除数量"""
+
+    @abstractmethod
+    def changes(self, since: int, limit: Optional[int] = None) -> dict:
+        """
+        返回同步版本号 since 之后新增/修改和删除的任务，按版本号升序
+
+        Returns:
+            {"version", "reset", "has_more", "upserts", "deleted"}。
+            reset 为 True 时 since 已无法增量同步 (比服务端版本号还新，或所需的删除记录
+            已被清理)，此时忽略 limit 返回全部任务，客户端应替换而不是合并本地副本。
+        """
+
+    def stats(self) -> dict:
+        """
+        返回任务数量 {"total", "active", "completed"}
+
+        默认实现逐条扫描计数，引擎应尽量直接读取维护好的计数。
+        """
+        total = completed = 0
+        for todo in self.iter():
+            total += 1
+            completed += bool(todo["completed"])
+        return {"total": total, "active": total - completed, "completed": completed}
+
+    def ping(self, write: bool = False) -> Dict[str, float]:
+        """
+        访问一次存储，返回各步耗时 (毫秒)，存储不可用时抛出异常
+
+        默认实现读取一次计数；write 为 True 时引擎应再验证可以写入 (不修改任务数据)。
+        """
+        started = time.perf_counter()
+        self.stats()
+        return {"query_ms": _elapsed_ms(started)}
+
+    def search(self, query: str, status: Optional[str] = None,
+               limit: int = 20, offset: int = 0) -> List[dict]:
+        """
+        按标题搜索任务
+
+        query 按空白拆分为多个词，每个词都要作为子串出现在标题中 (不区分大小写)。
+        默认实现逐条扫描，结果按 (created_at, id) 倒序；有全文索引的引擎按相关度排序。
+        """
+        terms = _search_terms(query)
+        results = []
+        skipped = 0
+        for todo in self.iter(status):
+            title = todo["title"].lower()
+            if not all(term in title for term in terms):
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            results.append(todo)
+            if len(results) >= limit:
+                break
+        return results
+
+class SqliteTodoRepository(TodoRepository):
+    """
+    基于连接池的 SQLite 存储
+
+    单条写入各只执行一条语句：创建和更新用 RETURNING 取回写入后的行，
+    更新和删除按影响行数判断任务是否存在。SQLite 低于 3.35 时 (returning=False)
+    创建和更新退回为写入后再按ID查询一次。
+
+    请求路径上的语句都是 STATEMENTS 中的固定文本 (列表查询的各种组合也预先生成)，
+    通过 database.statements 执行，每条语句在每个连接上只编译一次。
+
+    搜索使用 todos_fts 全文索引 (trigram 分词，见 database.init_search_schema)，
+    按 bm25 相关度排序。trigram 只能索引至少三个字符的词，更短的词 (如两个字的
+    中文词) 在索引命中的行上用 instr 过滤；所有词都少于三个字符时退回全表扫描。
+    """
+
+    RETURNING = " RETURNING id, title, completed, created_at, updated_at"
+    INSERT = """
+        INSERT INTO todos (title, completed, created_at, updated_at)
+        VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+    """
+    # 未提供的字段通过 COALESCE 保留原值，单条和批量更新共用这一种形状
+    UPDATE = """
+        UPDATE todos
+        SET title = COALESCE(?, title),
+            completed = COALESCE(?, completed),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+    """
+    STATEMENTS = {
+        "get": "SELECT * FROM todos WHERE id = ?",
+        "insert": INSERT,
+        "insert_returning": INSERT + RETURNING,
+        "update": UPDATE,
+        "update_returning": UPDATE + RETURNING,
+        "delete": "DELETE FROM todos WHERE id = ?",
+        "delete_many_returning": "DELETE FROM todos WHERE id IN (SELECT value FROM json_each(?)) RETURNING id",
+        "existing_ids": "SELECT id FROM todos WHERE id IN (SELECT value FROM json_each(?))",
+        "delete_completed": "DELETE FROM todos WHERE completed = TRUE",
+        "delete_all": "DELETE FROM todos",
+        "created_after": "SELECT * FROM todos WHERE id > ? ORDER BY id",
+        # ID 列表作为一个 JSON 参数传入，任意数量的ID都是同一条语句
+        "fetch_by_ids": "SELECT * FROM todos WHERE id IN (SELECT value FROM json_each(?))",
+        "sync_version": "SELECT version, pruned_version FROM sync_state WHERE id = 1",
+        "stats": "SELECT total, completed FROM todo_stats WHERE id = 1",
+        "changed_since": "SELECT * FROM todos WHERE version > ? ORDER BY version",
+        "changed_since_limit": "SELECT * FROM todos WHERE version > ? ORDER BY version LIMIT ?",
+        "deleted_since": "SELECT version, id FROM todo_tombstones WHERE version > ? ORDER BY version",
+        "deleted_since_limit": "SELECT version, id FROM todo_tombstones WHERE version > ? ORDER BY version LIMIT ?",
+        # 短词列表同样作为 JSON 参数传入，每个词都要出现在标题中
+        "search_fts": """
+            SELECT t.id, t.title, t.completed, t.created_at, t.updated_at
+            FROM todos_fts JOIN todos t ON t.id = todos_fts.rowid
+            WHERE todos_fts MATCH :match
+              AND NOT EXISTS (SELECT 1 FROM json_each(:terms) WHERE instr(fold(t.title), value) = 0)
+              AND (:completed IS NULL OR t.completed = :completed)
+            ORDER BY todos_fts.rank, t.created_at DESC, t.id DESC
+            LIMIT :limit OFFSET :offset
+        """,
+        "search_scan": """
+            SELECT id, title, completed, created_at, updated_at FROM todos
+            WHERE NOT EXISTS (SELECT 1 FROM json_each(:terms) WHERE instr(fold(title), value) = 0)
+              AND (:completed IS NULL OR completed = :completed)
+            ORDER BY created_at DESC, id DESC
+            LIMIT :limit OFFSET :offset
+        """,
+    }
+
+    def __init__(self, connection_factory=None, returning: Optional[bool] = None):
+        from database import get_db_connection, statements
+        if connection_factory is None:
+            connection_factory = get_db_connection
+        self._connection = connection_factory
+        self.returning = SQLITE_RETURNING if returning is None else returning
+        self._sql = statements
+        self._fts = None
+        for name, query in self.STATEMENTS.items():
+            self._sql.register(name, query)
+        for view in ("all", "active", "completed"):
+            for paged in (False, True):
+                for limited in (False, True):
+                    self._sql.register(self._list_name(view, paged, limited),
+                                       self._list_sql(view, paged, limited))
+
+    @staticmethod
+    def _to_dict(row) -> dict:
+        return {
+            "id": row["id"],
+            "title": row["title"],
+            "completed": bool(row["completed"]),
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"]
+        }
+
+    @staticmethod
+    def _rows_to_dicts(rows) -> List[dict]:
+        # 列表查询按位置解包普通元组，比经由 sqlite3.Row 按列名取值快得多
+        return [
+            {"id": todo_id, "title": title, "completed": bool(completed),
+             "created_at": created_at, "updated_at": updated_at}
+            for todo_id, title, completed, created_at, updated_at in rows
+        ]
+
+    @staticmethod
+    def _list_name(view: str, paged: bool, limited: bool) -> str:
+        return f"list_{view}" + ("_after" if paged else "") + ("_limit" if limited else "")
+
+    @staticmethod
+    def _list_sql(view: str, paged: bool, limited: bool) -> str:
+        """生成列表查询的一种组合 (视图 x 是否有分页位置 x 是否限制条数)"""
+        conditions = []
+        if view == "active":
+            conditions.append("completed = FALSE")
+        elif view == "completed":
+            conditions.append("completed = TRUE")
+        if paged:
+            conditions.append("(created_at, id) < (?, ?)")
+
+        query = "SELECT id, title, completed, created_at, updated_at FROM todos"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY created_at DESC, id DESC"
+        if limited:
+            query += " LIMIT ?"
+        return query
+
+    @classmethod
+    def _list_query(cls, status, limit, after) -> Tuple[str, list]:
+        """返回列表查询的语句名和参数"""
+        view = status if status in ("active", "completed") else "all"
+        params = list(after) if after is not None else []
+        if limit is not None:
+            params.append(limit)
+        return cls._list_name(view, after is not None, limit is not None), params
+
+    def _fetch_by_ids(self, cursor, ids: Sequence[int]) -> List[dict]:
+        """按ID列表查询任务，结果顺序与ids一致，不存在的ID被跳过"""
+        rows = self._sql.execute(cursor, "fetch_by_ids", (json.dumps(list(ids)),)).fetchall()
+        by_id = {row["id"]: row for row in rows}
+        return [self._to_dict(by_id[todo_id]) for todo_id in ids if todo_id in by_id]
+
+    def list(self, status=None, limit=None, after=None):
+        name, params = self._list_query(status, limit, after)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            return self._rows_to_dicts(self._sql.execute(cursor, name, params).fetchall())
+
+    def iter(self, status=None, limit=None, after=None, batch_size=500):
+        # 单条查询 + fetchmany，连接在迭代结束后才归还
+        name, params = self._list_query(status, limit, after)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            self._sql.execute(cursor, name, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from self._rows_to_dicts(rows)
+
+    def get(self, todo_id):
+        with self._connection() as conn:
+            row = self._sql.execute(conn, "get", (todo_id,)).fetchone()
+            return self._to_dict(row) if row else None
+
+    def create(self, title, completed=False):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            if self.returning:
+                row = self._sql.execute(cursor, "insert_returning", (title, completed)).fetchone()
+            else:
+                self._sql.execute(cursor, "insert", (title, completed))
+                row = self._sql.execute(cursor, "get", (cursor.lastrowid,)).fetchone()
+            conn.commit()
+            return self._to_dict(row)
+
+    def create_many(self, todos):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+
+            # 先拿到写锁，保证本事务插入的ID是连续的
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM todos")
+            last_id = cursor.fetchone()[0]
+
+            self._sql.executemany(cursor, "insert", todos)
+            rows = self._sql.execute(cursor, "created_after", (last_id,)).fetchall()
+
+            conn.commit()
+            return [self._to_dict(row) for row in rows]
+
+    def update(self, todo_id, title=None, completed=None):
+        # 任务不存在时不影响任何行
+        params = (title, completed, todo_id)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            if self.returning:
+                row = self._sql.execute(cursor, "update_returning", params).fetchone()
+            else:
+                self._sql.execute(cursor, "update", params)
+                row = None
+                if cursor.rowcount:
+                    row = self._sql.execute(cursor, "get", (todo_id,)).fetchone()
+            if row is None:
+                return None
+            conn.commit()
+            return self._to_dict(row)
+
+    def update_many(self, changes):
+        ids = [change[0] for change in changes]
+        with self._connection() as conn:
+            cursor = conn.cursor()
+
+            # 所有行共用同一条SQL
+            self._sql.executemany(cursor, "update",
+                                  [(title, completed, todo_id) for todo_id, title, completed in changes])
+
+            rows = self._fetch_by_ids(cursor, ids)
+            found = {row["id"] for row in rows}
+            missing = [todo_id for todo_id in ids if todo_id not in found]
+            if missing:
+                conn.rollback()
+                raise TodoNotFoundError(missing)
+
+            conn.commit()
+            return rows
+
+    def delete(self, todo_id):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            self._sql.execute(cursor, "delete", (todo_id,))
+            if cursor.rowcount == 0:
+                return False
+            conn.commit()
+            return True
+
+    def delete_many(self, ids):
+        ids = list(dict.fromkeys(ids))
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            if self.returning:
+                rows = self._sql.execute(cursor, "delete_many_returning", (json.dumps(ids),)).fetchall()
+            else:
+                # 先在同一事务中查出存在的ID，再逐个删除
+                cursor.execute("BEGIN IMMEDIATE")
+                rows = self._sql.execute(cursor, "existing_ids", (json.dumps(ids),)).fetchall()
+                self._sql.executemany(cursor, "delete", [(row["id"],) for row in rows])
+            conn.commit()
+            deleted = {row["id"] for row in rows}
+            return [todo_id for todo_id in ids if todo_id in deleted]
+
+    def delete_completed(self):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            self._sql.execute(cursor, "delete_completed")
+            count = cursor.rowcount
+            conn.commit()
+            return count
+
+    def delete_all(self):
+        # rowcount 只统计 DELETE 本身删除的行，不含触发器写入的行
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            self._sql.execute(cursor, "delete_all")
+            count = cursor.rowcount
+            conn.commit()
+            return count
+
+    def changes(self, since, limit=None):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+
+            # 在同一个读事务中查询，版本号与变更记录来自同一快照
+            cursor.execute("BEGIN")
+            version, pruned_version = self._sql.execute(cursor, "sync_version").fetchone()
+            reset = since > version or since < pruned_version
+            if reset:
+                since, limit = 0, None
+
+            # 多取一条用于判断是否还有下一页
+            suffix, params = ("", (since,)) if limit is None else ("_limit", (since, limit + 1))
+            upserts = [(row["version"], self._to_dict(row))
+                       for row in self._sql.execute(cursor, "changed_since" + suffix, params)]
+
+            deleted = []
+            if not reset:
+                deleted = [(row["version"], row["id"])
+                           for row in self._sql.execute(cursor, "deleted_since" + suffix, params)]
+
+            conn.rollback()
+            return _merge_changes(upserts, deleted, limit, version, reset)
+
+    def stats(self):
+        with self._connection() as conn:
+            total, completed = self._sql.execute(conn, "stats").fetchone()
+            return {"total": total, "active": total - completed, "completed": completed}
+
+    def ping(self, write=False):
+        started = time.perf_counter()
+        with self._connection() as conn:
+            timings = {"checkout_ms": _elapsed_ms(started)}
+            started = time.perf_counter()
+            conn.execute("SELECT 1").fetchone()
+            timings["query_ms"] = _elapsed_ms(started)
+            if write:
+                # 申请写锁后立即回滚：有其他写事务长时间占着锁时这里会等待 (最长为 busy timeout)
+                started = time.perf_counter()
+                conn.execute("BEGIN IMMEDIATE")
+                conn.rollback()
+                timings["write_ms"] = _elapsed_ms(started)
+        return timings
+
+    def _has_fts(self, conn) -> bool:
+        """全文索引表是否存在 (SQLite 不支持 trigram 分词时不会创建)，首次调用后缓存"""
+        if self._fts is None:
+            row = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'todos_fts'").fetchone()
+            self._fts = row is not None
+        return self._fts
+
+    def search(self, query, status=None, limit=20, offset=0):
+        terms = _search_terms(query)
+        indexed = [term for term in terms if len(term) >= 3]
+        params = {
+            "completed": {"active": 0, "completed": 1}.get(status),
+            "limit": limit,
+            "offset": offset,
+        }
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            if indexed and self._has_fts(conn):
+                # 每个词写成 FTS5 短语 (双引号转义)，多个短语之间是 AND
+                params["match"] = " ".join('"' + term.replace('"', '""') + '"' for term in indexed)
+                params["terms"] = json.dumps([term for term in terms if len(term) < 3], ensure_ascii=False)
+                name = "search_fts"
+            else:
+                params["terms"] = json.dumps(terms, ensure_ascii=False)
+                name = "search_scan"
+            return self._rows_to_dicts(self._sql.execute(cursor, name, params).fetchall())
+
+class PostgresTodoRepository(TodoRepository):
+    """
+    基于 psycopg2 的 Postgres 存储，表结构与 api/todos_postgres.py 一致 (需要先执行其中的迁移)
+
+    连接来自实例持有的连接池 (大小和等待时间与 SQLite 连接池共用 DB_POOL_SIZE/DB_POOL_TIMEOUT)，
+    用完归还复用。请求路径上的语句都是 STATEMENTS 中的固定文本：列表查询的各种组合与
+    SQLite 形状相同，只是占位符不同；批量写入把各列作为数组参数传入再 unnest，
+    任意数量的任务都是同一条语句。
+
+    增量同步与 SQLite 相同，由迁移 5 中的触发器维护同步版本号和删除记录 (墓碑)，
+    超过 SYNC_TOMBSTONE_RETENTION_DAYS 天的墓碑在创建实例时清理。
+    """
+
+    RETURNING = " RETURNING id, title, completed, created_at, updated_at"
+    STATEMENTS = {
+        "get": "SELECT id, title, completed, created_at, updated_at FROM todos WHERE id = %s",
+        "insert": "INSERT INTO todos (title, completed) VALUES (%s, %s)" + RETURNING,
+        "insert_many": """
+            INSERT INTO todos (title, completed)
+            SELECT title, completed FROM unnest(%s::varchar[], %s::boolean[]) AS v(title, completed)
+        """ + RETURNING,
+        # 未提供的字段通过 COALESCE 保留原值
+        "update": """
+            UPDATE todos
+            SET title = COALESCE(%s, title),
+                completed = COALESCE(%s, completed),
+                updated_at = NOW()
+            WHERE id = %s
+        """ + RETURNING,
+        "update_many": """
+            UPDATE todos AS t
+            SET title = COALESCE(v.title, t.title),
+                completed = COALESCE(v.completed, t.completed),
+                updated_at = NOW()
+            FROM unnest(%s::integer[], %s::varchar[], %s::boolean[]) AS v(id, title, completed)
+            WHERE t.id = v.id
+            RETURNING t.id, t.title, t.completed, t.created_at, t.updated_at
+        """,
+        "delete": "DELETE FROM todos WHERE id = %s",
+        "delete_many": "DELETE FROM todos WHERE id = ANY(%s::integer[]) RETURNING id",
+        "delete_completed": "DELETE FROM todos WHERE completed = TRUE",
+        "delete_all": "DELETE FROM todos",
+        # 计数由迁移 4 的触发器维护，只读一行
+        "stats": "SELECT total, completed FROM todo_stats",
+        "sync_version": "SELECT version, pruned_version FROM sync_state",
+        "changed_since": """
+            SELECT id, title, completed, created_at, updated_at, version FROM todos
+            WHERE version > %s ORDER BY version
+        """,
+        "changed_since_limit": """
+            SELECT id, title, completed, created_at, updated_at, version FROM todos
+            WHERE version > %s ORDER BY version LIMIT %s
+        """,
+        "deleted_since": "SELECT version, id FROM todo_tombstones WHERE version > %s ORDER BY version",
+        "deleted_since_limit": "SELECT version, id FROM todo_tombstones WHERE version > %s ORDER BY version LIMIT %s",
+        "prune_tombstones": """
+            WITH pruned AS (
+                DELETE FROM todo_tombstones WHERE deleted_at < NOW() - make_interval(days => %s)
+                RETURNING version
+            )
+            UPDATE sync_state SET pruned_version = GREATEST(pruned_version, (SELECT MAX(version) FROM pruned))
+            WHERE EXISTS (SELECT 1 FROM pruned)
+        """,
+    }
+    if pg_handler is not None:
+        # 迁移 3 的 GIN 索引过滤候选行，strpos 确认每个词都出现在标题中，按 ts_rank 排序
+        STATEMENTS["search"] = pg_handler.statements.sql("search_todos")
+    STATEMENTS.update({
+        SqliteTodoRepository._list_name(view, paged, limited):
+            SqliteTodoRepository._list_sql(view, paged, limited).replace("?", "%s")
+        for view in ("all", "active", "completed") for paged in (False, True) for limited in (False, True)
+    })
+
+    def __init__(self, dsn: str, pool_size: Optional[int] = None, timeout: Optional[float] = None):
+        if psycopg2 is None:
+            raise RuntimeError("使用 Postgres 存储需要安装 psycopg2-binary")
+        from database import DB_POOL_SIZE, DB_POOL_TIMEOUT, SYNC_TOMBSTONE_RETENTION_DAYS
+        self.dsn = dsn
+        self.pool_size = DB_POOL_SIZE if pool_size is None else pool_size
+        self.timeout = DB_POOL_TIMEOUT if timeout is None else timeout
+        # 连接在首次需要时创建，最多 pool_size 个，归还后留在 _idle 中复用；信号量限制同时借出的数量
+        self._idle = LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+        # 开启慢查询日志时使用记录耗时的游标
+        self.cursor_factory = TimedRealDictCursor if QUERY_LOG_ENABLED else RealDictCursor
+        if SYNC_TOMBSTONE_RETENTION_DAYS > 0:
+            self._execute("prune_tombstones", (SYNC_TOMBSTONE_RETENTION_DAYS,), fetch=None)
+
+    @staticmethod
+    def _to_dict(row) -> dict:
+        return {
+            "id": row["id"],
+            "title": row["title"],
+            "completed": row["completed"],
+            "created_at": row["created_at"].isoformat(),
+            "updated_at": row["updated_at"].isoformat()
+        }
+
+    @contextmanager
+    def _connect(self):
+        """
+        从连接池取出连接，用完归还；等待和占用连接的时间计入请求指标
+
+        Raises:
+            TimeoutError: 在 timeout 秒内没有可用连接
+        """
+        started = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError("数据库连接池已耗尽，获取连接超时")
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except Empty:
+                conn = None
+            if conn is None or conn.closed:
+                # 池中没有空闲连接，或上次使用时连接已断开
+                conn = psycopg2.connect(self.dsn)
+        except Exception:
+            self._slots.release()
+            raise
+        acquired = time.perf_counter()
+        try:
+            yield conn
+        finally:
+            # 未结束的事务先回滚，已断开的连接关闭后不再放回池中
+            broken = bool(conn.closed)
+            if not broken and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            if broken:
+                conn.close()
+            else:
+                self._idle.put(conn)
+            self._slots.release()
+            record_connection(acquired - started, time.perf_counter() - acquired)
+
+    def _run(self, cursor, name, params=()):
+        """在游标上执行一条注册的语句，返回游标"""
+        record_query()
+        cursor.execute(self.STATEMENTS[name], params)
+        return cursor
+
+    def _execute(self, name, params=(), fetch="all"):
+        """在新事务中执行一条注册的语句并提交"""
+        with self._connect() as conn, conn, conn.cursor(cursor_factory=self.cursor_factory) as cursor:
+            self._run(cursor, name, params)
+            if fetch == "all":
+                return cursor.fetchall()
+            if fetch == "one":
+                return cursor.fetchone()
+            return cursor.rowcount
+
+    def close(self):
+        """关闭连接池中的所有空闲连接"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                break
+
+    def list(self, status=None, limit=None, after=None):
+        name, params = SqliteTodoRepository._list_query(status, limit, after)
+        return [self._to_dict(row) for row in self._execute(name, params)]
+
+    def get(self, todo_id):
+        row = self._execute("get", (todo_id,), fetch="one")
+        return self._to_dict(row) if row else None
+
+    def create(self, title, completed=False):
+        return self._to_dict(self._execute("insert", (title, completed), fetch="one"))
+
+    def create_many(self, todos):
+        todos = list(todos)
+        if not todos:
+            return []
+        rows = self._execute("insert_many", ([title for title, _ in todos],
+                                             [bool(completed) for _, completed in todos]))
+        return [self._to_dict(row) for row in sorted(rows, key=lambda row: row["id"])]
+
+    def update(self, todo_id, title=None, completed=None):
+        row = self._execute("update", (title, completed, todo_id), fetch="one")
+        return self._to_dict(row) if row else None
+
+    def update_many(self, changes):
+        params = ([todo_id for todo_id, _, _ in changes], [title for _, title, _ in changes],
+                  [completed for _, _, completed in changes])
+        with self._connect() as conn, conn, conn.cursor(cursor_factory=self.cursor_factory) as cursor:
+            self._run(cursor, "update_many", params)
+            by_id = {row["id"]: row for row in cursor.fetchall()}
+            missing = [change[0] for change in changes if change[0] not in by_id]
+            if missing:
+                # 抛出异常时 with conn 会回滚事务
+                raise TodoNotFoundError(missing)
+        return [self._to_dict(by_id[change[0]]) for change in changes]
+
+    def delete(self, todo_id):
+        return self._execute("delete", (todo_id,), fetch=None) > 0
+
+    def delete_many(self, ids):
+        ids = list(dict.fromkeys(ids))
+        deleted = {row["id"] for row in self._execute("delete_many", (ids,))}
+        return [todo_id for todo_id in ids if todo_id in deleted]
+
+    def delete_completed(self):
+        return self._execute("delete_completed", fetch=None)
+
+    def delete_all(self):
+        return self._execute("delete_all", fetch=None)
+
+    def changes(self, since, limit=None):
+        with self._connect() as conn, conn, conn.cursor(cursor_factory=self.cursor_factory) as cursor:
+            # 可重复读的只读事务，版本号与变更记录来自同一快照
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+            row = self._run(cursor, "sync_version").fetchone()
+            version = row["version"]
+            reset = since > version or since < row["pruned_version"]
+            if reset:
+                since, limit = 0, None
+
+            # 多取一条用于判断是否还有下一页
+            suffix, params = ("", (since,)) if limit is None else ("_limit", (since, limit + 1))
+            upserts = [(row["version"], self._to_dict(row))
+                       for row in self._run(cursor, "changed_since" + suffix, params).fetchall()]
+
+            deleted = []
+            if not reset:
+                deleted = [(row["version"], row["id"])
+                           for row in self._run(cursor, "deleted_since" + suffix, params).fetchall()]
+        return _merge_changes(upserts, deleted, limit, version, reset)
+
+    def search(self, query, status=None, limit=20, offset=0):
+        if pg_handler is None:
+            return super().search(query, status, limit, offset)
+        terms = _search_terms(query)
+        tsquery = pg_handler.search_tsquery(terms)
+        if not tsquery:
+            # 只有标点等无法索引的字符时不会匹配任何任务
+            return []
+        completed = {"active": False, "completed": True}.get(status)
+        rows = self._execute("search", (tsquery, completed, completed, terms, limit, offset))
+        return [self._to_dict(row) for row in rows]
+
+    def stats(self):
+        row = self._execute("stats", fetch="one")
+        return {"total": row["total"], "active": row["total"] - row["completed"], "completed": row["completed"]}
+
+    def ping(self, write=False):
+        started = time.perf_counter()
+        with self._connect() as conn, conn.cursor() as cursor:
+            timings = {"checkout_ms": _elapsed_ms(started)}
+            started = time.perf_counter()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            timings["query_ms"] = _elapsed_ms(started)
+            if write:
+                # 分配事务号需要可写的主库 (只读副本上会报错)，随后回滚，不写任何数据
+                started = time.perf_counter()
+                cursor.execute("SELECT txid_current()")
+                timings["write_ms"] = _elapsed_ms(started)
+            conn.rollback()
+        return timings
+
+class MemoryTodoRepository(TodoRepository):
+    """
+    进程内存存储
+
+    任务按 ID 存在字典里；全部/未完成/已完成三个视图各维护一个按 (created_at, id)
+    升序的键列表，列表查询只需二分定位再切片，不需要扫描或重新排序。
+    每次写入分配一个同步版本号，删除的任务留下墓碑，供增量同步使用。
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._todos: Dict[int, dict] = {}
+        self._views: Dict[str, List[Position]] = {"all": [], "active": [], "completed": []}
+        self._next_id = 1
+        self._version = 0
+        self._row_versions: Dict[int, int] = {}
+        self._tombstones: Dict[int, int] = {}
+
+    @staticmethod
+    def _view_name(status: Optional[str]) -> str:
+        return status if status in ("active", "completed") else "all"
+
+    @staticmethod
+    def _state_view(completed: bool) -> str:
+        return "completed" if completed else "active"
+
+    @staticmethod
+    def _remove_key(keys: List[Position], key: Position):
+        index = bisect.bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            del keys[index]
+
+    def _touch(self, todo_id: int):
+        self._version += 1
+        self._row_versions[todo_id] = self._version
+
+    def _bury(self, todo_id: int):
+        self._version += 1
+        self._row_versions.pop(todo_id, None)
+        self._tombstones[todo_id] = self._version
+
+    def _insert(self, title: str, completed: bool) -> dict:
+        now = _now()
+        todo = {
+            "id": self._next_id,
+            "title": title,
+            "completed": bool(completed),
+            "created_at": now,
+            "updated_at": now
+        }
+        self._next_id += 1
+        self._todos[todo["id"]] = todo
+        key = (todo["created_at"], todo["id"])
+        bisect.insort(self._views["all"], key)
+        bisect.insort(self._views[self._state_view(todo["completed"])], key)
+        self._touch(todo["id"])
+        return dict(todo)
+
+    def _apply(self, todo: dict, title: Optional[str], completed: Optional[bool]):
+        if title is not None:
+            todo["title"] = title
+        if completed is not None and bool(completed) != todo["completed"]:
+            key = (todo["created_at"], todo["id"])
+            self._remove_key(self._views[self._state_view(todo["completed"])], key)
+            todo["completed"] = bool(completed)
+            bisect.insort(self._views[self._state_view(todo["completed"])], key)
+        todo["updated_at"] = _now()
+        self._touch(todo["id"])
+
+    def _remove(self, todo_id: int) -> bool:
+        todo = self._todos.pop(todo_id, None)
+        if todo is None:
+            return False
+        key = (todo["created_at"], todo["id"])
+        self._remove_key(self._views["all"], key)
+        self._remove_key(self._views[self._state_view(todo["completed"])], key)
+        self._bury(todo_id)
+        return True
+
+    def list(self, status=None, limit=None, after=None):
+        with self._lock:
+            keys = self._views[self._view_name(status)]
+            end = len(keys) if after is None else bisect.bisect_left(keys, tuple(after))
+            start = 0 if limit is None else max(0, end - limit)
+            return [dict(self._todos[todo_id]) for _, todo_id in reversed(keys[start:end])]
+
+    def get(self, todo_id):
+        with self._lock:
+            todo = self._todos.get(todo_id)
+            return dict(todo) if todo else None
+
+    def create(self, title, completed=False):
+        with self._lock:
+            return self._insert(title, completed)
+
+    def create_many(self, todos):
+        with self._lock:
+            return [self._insert(title, completed) for title, completed in todos]
+
+    def update(self, todo_id, title=None, completed=None):
+        with self._lock:
+            todo = self._todos.get(todo_id)
+            if todo is None:
+                return None
+            self._apply(todo, title, completed)
+            return dict(todo)
+
+    def update_many(self, changes):
+        with self._lock:
+            missing = [change[0] for change in changes if change[0] not in self._todos]
+            if missing:
+                raise TodoNotFoundError(missing)
+            for todo_id, title, completed in changes:
+                self._apply(self._todos[todo_id], title, completed)
+            return [dict(self._todos[change[0]]) for change in changes]
+
+    def delete(self, todo_id):
+        with self._lock:
+            return self._remove(todo_id)
+
+    def delete_many(self, ids):
+        with self._lock:
+            return [todo_id for todo_id in dict.fromkeys(ids) if self._remove(todo_id)]
+
+    def delete_completed(self):
+        with self._lock:
+            completed = self._views["completed"]
+            removed = {todo_id for _, todo_id in completed}
+            for todo_id in sorted(removed):
+                del self._todos[todo_id]
+                self._bury(todo_id)
+            self._views["all"] = [key for key in self._views["all"] if key[1] not in removed]
+            self._views["completed"] = []
+            return len(removed)
+
+    def delete_all(self):
+        with self._lock:
+            count = len(self._todos)
+            for todo_id in sorted(self._todos):
+                self._bury(todo_id)
+            self._todos.clear()
+            self._views = {"all": [], "active": [], "completed": []}
+            return count
+
+    def stats(self):
+        with self._lock:
+            return {
+                "total": len(self._views["all"]),
+                "active": len(self._views["active"]),
+                "completed": len(self._views["completed"]),
+            }
+
+    def changes(self, since, limit=None):
+        with self._lock:
+            reset = since > self._version
+            if reset:
+                since, limit = 0, None
+            upserts = sorted((version, dict(self._todos[todo_id]))
+                             for todo_id, version in self._row_versions.items() if version > since)
+            deleted = [] if reset else sorted(
+                (version, todo_id) for todo_id, version in self._tombstones.items() if version > since
+            )
+            return _merge_changes(upserts, deleted, limit, self._version, reset)
+
+class KVTodoRepository(TodoRepository):
+    """
+    KV 存储 (Redis / Vercel KV)，每个任务一个键
+
+    键布局和读写操作都在 api/_kvstore.py 中，与 api/todos_kv.py 共用，两者可以指向同一个 Redis。
+    每个写操作是一个事务，任务键、状态索引和版本号一起写入；列表查询先在有序集合上取一页ID
+    (分数即ID，按ID倒序就是按创建顺序倒序)，再用一次 MGET 取回所有任务。
+    增量同步的版本号和墓碑记在 todos:changes/todos:tombstones 两个有序集合中 (分数为版本号)。
+    """
+
+    def __init__(self, client=None):
+        if kvstore is None:
+            raise RuntimeError("使用 KV 存储需要 api/_kvstore.py")
+        # 未指定客户端时使用进程内替身
+        self.kv = kvstore.InMemoryKV() if client is None else client
+
+    def list(self, status=None, limit=None, after=None):
+        return kvstore.list_todos(self.kv, status, limit, None if after is None else after[1])
+
+    def get(self, todo_id):
+        return kvstore.get_todo(self.kv, todo_id)
+
+    def create(self, title, completed=False):
+        return kvstore.create_todos(self.kv, [(title, completed)], _now())[0]
+
+    def create_many(self, todos):
+        return kvstore.create_todos(self.kv, list(todos), _now())
+
+    def update(self, todo_id, title=None, completed=None):
+        todos, missing = kvstore.update_todos(self.kv, [(todo_id, title, completed)], _now())
+        return None if missing else todos[0]
+
+    def update_many(self, changes):
+        todos, missing = kvstore.update_todos(self.kv, list(changes), _now())
+        if missing:
+            raise TodoNotFoundError(missing)
+        return todos
+
+    def delete(self, todo_id):
+        return bool(kvstore.delete_todos(self.kv, [todo_id]))
+
+    def delete_many(self, ids):
+        return kvstore.delete_todos(self.kv, ids)
+
+    def delete_completed(self):
+        return len(kvstore.delete_todos(self.kv, kvstore.list_ids(self.kv, "completed")))
+
+    def delete_all(self):
+        return len(kvstore.delete_todos(self.kv, kvstore.list_ids(self.kv)))
+
+    def changes(self, since, limit=None):
+        # 多取一条用于判断是否还有下一页
+        version, upserts, deleted = kvstore.list_changes(self.kv, since, None if limit is None else limit + 1)
+        reset = since > version
+        if reset:
+            version, upserts, _ = kvstore.list_changes(self.kv, 0)
+            deleted, limit = [], None
+        return _merge_changes(upserts, deleted, limit, version, reset)
+
+    def ping(self, write=False):
+        started = time.perf_counter()
+        self.kv.get(kvstore.NEXT_ID_KEY)
+        timings = {"query_ms": _elapsed_ms(started)}
+        if write:
+            # 写一个专用的探测键，不涉及任务数据
+            started = time.perf_counter()
+            self.kv.set(kvstore.HEALTH_KEY, str(time.time()))
+            timings["write_ms"] = _elapsed_ms(started)
+        return timings
+
+    def stats(self):
+        return {
+            "total": self.kv.zcard(kvstore.INDEX_KEYS["all"]),
+            "active": self.kv.zcard(kvstore.INDEX_KEYS["active"]),
+            "completed": self.kv.zcard(kvstore.INDEX_KEYS["completed"]),
+        }
+
+_repository = None
+
+def get_repository() -> TodoRepository:
+    """
+    获取路由使用的全局存储实例，默认为 SQLite
+    """
+    global _repository
+    if _repository is None:
+        _repository = SqliteTodoRepository()
+    return _repository
+
+def set_repository(repository: TodoRepository):
+    """
+    替换全局存储实例 (用于切换引擎或测试)
+    """
+    global _repository
+    _repository = repository
@@ -0,0 +1,141 @@
+"""
+调试相关的API路由 (需要管理员令牌)
+"""
+import hmac
+import os
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+
+from models import MessageResponse
+from profiling import PROFILE_TOKEN_MAX_TTL, profiler, sign
+from querylog import QueryLog, query_log
+
+# 管理员令牌，未设置时 /debug 下的接口全部返回 404
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+def require_admin(x_admin_token: Optional[str] = Header(None, description="管理员令牌 (环境变量 ADMIN_TOKEN)")):
+    """校验管理员令牌"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="管理员令牌无效")
+
+router = APIRouter(prefix="/debug", tags=["debug"], dependencies=[Depends(require_admin)])
+
+@router.get("/queries")
+async def get_query_log(
+    limit: int = Query(20, ge=1, le=500, description="返回的语句条数"),
+    order: str = Query("total", pattern=f"^({'|'.join(QueryLog.ORDERS)})$",
+                       description="排序依据: total (总耗时), mean, max, calls")
+):
+    """
+    SQL 语句耗时排行和最近的慢查询
+    
+    语句按指纹汇总 (字面量替换为 ?)，慢查询带参数形状和执行计划，不含参数值。
+    
+    Args:
+        limit: 返回的语句条数
+        order: 排序依据
+    
+    Returns:
+        dict: statements 为语句排行，slow 为最近的慢查询 (新的在前)
+    """
+    return query_log.report(limit, order)
+
+@router.delete("/queries", response_model=MessageResponse)
+async def reset_query_log():
+    """
+    清空语句汇总和慢查询记录
+    
+    Returns:
+        dict: 操作结果消息
+    """
+    query_log.clear()
+    return {"message": "慢查询日志已清空"}
+
+@router.post("/profiles/token")
+async def create_profile_token(
+    path: str = Query("*", description="允许剖析的请求路径，* 表示任意路径"),
+    ttl: int = Query(300, ge=1, le=PROFILE_TOKEN_MAX_TTL, description="有效期 (秒)")
+):
+    """
+    生成剖析请求头
+    
+    把返回的 header/value 加到要剖析的请求上 (可再加 X-Profile-Mode: cprofile)，
+    响应头 X-Profile-Id 为结果编号。持有请求头的人不需要管理员令牌。
+    
+    Args:
+        path: 允许剖析的请求路径
+        ttl: 有效期
+    
+    Returns:
+        dict: 请求头名称、值和过期时间
+    """
+    value = sign(ADMIN_TOKEN, path, ttl)
+    return {"header": "X-Profile", "value": value, "expires": int(value.split(".")[0])}
+
+@router.post("/profiles/arm", response_model=MessageResponse)
+async def arm_profiler(
+    path: str = Query(..., min_length=1, description="要剖析的请求路径，如 /api/v1/todos/"),
+    count: int = Query(1, ge=1, le=10, description="剖析接下来多少个请求"),
+    mode: str = Query("sample", pattern="^(sample|cprofile)$", description="剖析方式")
+):
+    """
+    预约剖析接下来访问 path 的 count 个请求，不需要改动客户端
+    
+    预约的请求同样受并发和频率限制；重复预约同一路径会覆盖剩余次数。
+    
+    Args:
+        path: 请求路径
+        count: 请求个数
+        mode: 剖析方式
+    
+    Returns:
+        MessageResponse: 操作结果消息
+    """
+    profiler.arm(path, count, mode)
+    return {"message": f"已预约剖析 {path} 的接下来 {count} 个请求"}
+
+@router.get("/profiles")
+async def list_profiles():
+    """
+    已保存的剖析结果 (新的在前)
+    
+    Returns:
+        dict: 结果列表和当前的预约
+    """
+    return {"profiles": profiler.list(), "armed": profiler.armed_paths()}
+
+@router.get("/profiles/{profile_id}")
+async def get_profile(
+    profile_id: str,
+    format: Optional[str] = Query(None, pattern="^(folded|pstats|text)$",
+                                  description="folded (sample 模式)，pstats 或 text (cprofile 模式)")
+):
+    """
+    下载剖析结果
+    
+    - sample 模式默认返回 folded stacks 文本，可直接交给 flamegraph.pl 或 speedscope
+    - cprofile 模式默认返回按累计耗时排序的文本报告，format=pstats 返回 .prof 文件
+      (snakeviz、flameprof 可读取)
+    
+    Args:
+        profile_id: 剖析结果编号 (响应头 X-Profile-Id)
+        format: 输出格式
+    
+    Returns:
+        Response: 剖析结果
+    """
+    session = profiler.get(profile_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="剖析结果不存在或已被淘汰")
+    
+    format = format or ("folded" if session.mode == "sample" else "text")
+    if (format == "folded") != (session.mode == "sample"):
+        raise HTTPException(status_code=400, detail=f"{session.mode} 模式的结果不支持 {format} 格式")
+    if format == "folded":
+        return Response(content=session.folded(), media_type="text/plain; charset=utf-8")
+    if format == "pstats":
+        return Response(content=session.pstats_data(), media_type="application/octet-stream",
+                        headers={"Content-Disposition": f'attachment; filename="{profile_id}.prof"'})
+    return Response(content=session.summary(), media_type="text/plain; charset=utf-8")
@@ -1,54 +1,326 @@
 """
 Todo相关的API路由
 """
-from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlite3 import Row
-from datetime import datetime
+import base64
+import binascii
+import json
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
 
-from database import get_db_connection
-from models import TodoCreate, TodoUpdate, TodoResponse, MessageResponse
+from cache import VIEWS, etag_matches, list_cache, table_version, view_of, views_for_states
+from database import run_db
+from events import EVENTS_KEEPALIVE_SECONDS, Subscription, event_bus
+from models import (
+    TodoCreate, TodoUpdate, TodoBatchUpdate, TodoBatchDelete,
+    TodoResponse, TodoChangesResponse, TodoStatsResponse, MessageResponse
+)
+from repository import TodoNotFoundError, get_repository
+from serialization import FAST_JSON, dumps
 
 router = APIRouter(prefix="/todos", tags=["todos"])
 
+# 流式输出时每次从游标读取的行数
+STREAM_BATCH_SIZE = 500
+
+# 支持的流式输出格式及其媒体类型
+STREAM_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "json": "application/json",
+}
+
+# 批量接口单次请求允许的最大条数
+MAX_BATCH_SIZE = 1000
+
+# 列表响应的序列化器，缓存中保存的是序列化后的 JSON
+_todo_list_adapter = TypeAdapter(List[TodoResponse])
+
+def _dump_todo_list(todos: List[dict]) -> bytes:
+    """
+    序列化一页任务
+    
+    开启 FAST_JSON 时不逐行构造 TodoResponse：各存储引擎返回的字典字段和类型
+    都与 TodoResponse 一致，直接编码即可，输出字节与校验后再编码完全相同。
+    """
+    if FAST_JSON:
+        return dumps(todos)
+    return _todo_list_adapter.dump_json(_todo_list_adapter.validate_python(todos))
+
+def _encode_cursor(created_at: str, todo_id: int) -> str:
+    """把 (created_at, id) 编码为不透明的分页游标"""
+    raw = f"{created_at}|{todo_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _decode_cursor(cursor: str) -> Tuple[str, int]:
+    """解析分页游标，格式错误时返回 400"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, todo_id = base64.urlsafe_b64decode(padded).decode("utf-8").rsplit("|", 1)
+        return created_at, int(todo_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+
+def _check_batch_size(size: int):
+    """校验批量请求的条数"""
+    if size == 0:
+        raise HTTPException(status_code=400, detail="批量请求不能为空")
+    if size > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"单次批量请求最多{MAX_BATCH_SIZE}条")
+
+def _stream_todos(todos: Iterator[dict], fmt: str) -> Iterator[str]:
+    """
+    逐批输出任务，内存占用与结果集大小无关
+    
+    todos 是存储层的惰性迭代器，SQLite 下连接直到最后一批写出后才归还连接池。
+    """
+    def chunk(batch: List[str], first: bool) -> str:
+        if fmt == "ndjson":
+            return "\n".join(batch) + "\n"
+        return ("" if first else ",") + ",".join(batch)
+    
+    batch = []
+    first = True
+    if fmt == "json":
+        yield "["
+    for todo in todos:
+        batch.append(json.dumps(todo, ensure_ascii=False))
+        if len(batch) >= STREAM_BATCH_SIZE:
+            yield chunk(batch, first)
+            batch = []
+            first = False
+    if batch:
+        yield chunk(batch, first)
+    if fmt == "json":
+        yield "]"
+
+def _list_todos(status: Optional[str], limit: Optional[int],
+                after: Optional[Tuple[str, int]]) -> Tuple[List[dict], Optional[str]]:
+    """查询一页任务，返回当前页任务和下一页游标"""
+    # 多取一条用于判断是否还有下一页
+    todos = get_repository().list(status, limit + 1 if limit is not None else None, after)
+    
+    next_cursor = None
+    if limit is not None and len(todos) > limit:
+        todos = todos[:limit]
+        last = todos[-1]
+        next_cursor = _encode_cursor(last["created_at"], last["id"])
+    
+    return todos, next_cursor
+
+async def _event_stream(subscription: Subscription, resumed: bool) -> AsyncIterator[str]:
+    """
+    把订阅中的事件写成 SSE 流
+    
+    新连接先收到带当前事件 ID 的 ready 事件；订阅跟不上或无法续传时发送 reset 并结束，
+    reset 同样带当前事件 ID，客户端重新拉取列表后自动重连即可从这里继续。
+    客户端断开时 Starlette 会取消这个生成器。
+    """
+    def reset() -> str:
+        return f"id: {event_bus.last_event_id}\nevent: reset\ndata: {{}}\n\n"
+    
+    try:
+        if subscription.lagged:
+            yield reset()
+            return
+        # 续传时不带 id，避免把客户端的 Last-Event-ID 提前到补发的事件之后
+        yield "retry: 3000\n" + ("" if resumed else f"id: {event_bus.last_event_id}\n") + "event: ready\ndata: {}\n\n"
+        while not subscription.closed:
+            events = await subscription.next_batch(EVENTS_KEEPALIVE_SECONDS)
+            if subscription.lagged:
+                yield reset()
+                return
+            if events:
+                yield "".join(event.text for event in events)
+            elif not subscription.closed:
+                yield ": keepalive\n\n"
+    finally:
+        event_bus.unsubscribe(subscription)
+
+def _record_change(views: Tuple[str, ...] = VIEWS):
+    """写操作成功后调用：失效受影响视图的缓存，并推进表版本号"""
+    list_cache.invalidate(views)
+    table_version.bump()
+
+def _updated_views(todos: List[dict], completed_changed: bool) -> Tuple[str, ...]:
+    """更新任务后需要失效的视图：修改了完成状态时任务可能从另一个视图移出"""
+    if completed_changed:
+        return VIEWS
+    return views_for_states(*{bool(todo["completed"]) for todo in todos})
+
 @router.get("/", response_model=List[TodoResponse])
 async def get_todos(
-    status: Optional[str] = Query(None, description="筛选条件: all, active, completed")
+    status: Optional[str] = Query(None, description="筛选条件: all, active, completed"),
+    limit: Optional[int] = Query(None, ge=1, le=1000, description="每页数量，不传则返回全部"),
+    cursor: Optional[str] = Query(None, description="上一页响应头 X-Next-Cursor 中的游标"),
+    stream: Optional[str] = Query(None, description="流式输出格式: ndjson 或 json"),
+    cache_control: Optional[str] = Header(None, description="传 no-cache 或 no-store 时跳过列表缓存"),
+    if_none_match: Optional[str] = Header(None, description="上次响应的 ETag，未变化时返回 304")
 ):
     """
     获取任务列表
     
+    按 (created_at, id) 倒序做键集分页：传入 limit 时最多返回 limit 条，
+    如果还有下一页，游标通过响应头 X-Next-Cursor 返回。
+    传入 stream 时边读边写，适合一次性导出大量任务 (不返回 X-Next-Cursor)。
+    
+    非流式的结果按 (视图, limit, 游标) 把序列化后的 JSON 缓存在进程内，
+    写操作会使受影响的视图失效；响应头 X-Cache 标明 HIT/MISS/BYPASS。
+    
+    响应带基于表版本号的强 ETag，If-None-Match 命中时直接返回 304，不查询数据库。
+    
     Args:
         status: 筛选条件，可选值：all(全部), active(未完成), completed(已完成)
+        limit: 每页数量
+        cursor: 分页游标
+        stream: 流式输出格式，ndjson(每行一个任务) 或 json(分块输出的JSON数组)
+        cache_control: 请求头 Cache-Control
+        if_none_match: 请求头 If-None-Match
     
     Returns:
         List[TodoResponse]: 任务列表
     """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # 构建查询SQL
-        if status == "active":
-            query = "SELECT * FROM todos WHERE completed = FALSE ORDER BY created_at DESC"
-        elif status == "completed":
-            query = "SELECT * FROM todos WHERE completed = TRUE ORDER BY created_at DESC"
-        else:  # all 或 None
-            query = "SELECT * FROM todos ORDER BY created_at DESC"
-        
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        
-        todos = []
-        for row in rows:
-            todos.append(TodoResponse(
-                id=row["id"],
-                title=row["title"],
-                completed=bool(row["completed"]),
-                created_at=row["created_at"],
-                updated_at=row["updated_at"]
-            ))
-        
-        return todos
+    after = _decode_cursor(cursor) if cursor else None
+    if stream is not None and stream not in STREAM_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="不支持的流式输出格式")
+    
+    # 先读版本号再读数据：查询期间发生的写入只会让 ETag 偏旧，下次轮询即可拿到新数据
+    etag = table_version.etag(view_of(status), limit, after, stream)
+    conditional_headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=conditional_headers)
+    
+    if stream is not None:
+        todos = get_repository().iter(status, limit, after, batch_size=STREAM_BATCH_SIZE)
+        return StreamingResponse(
+            _stream_todos(todos, stream),
+            media_type=STREAM_MEDIA_TYPES[stream],
+            headers=conditional_headers
+        )
+    
+    bypass = not list_cache.enabled or any(
+        directive in (cache_control or "").lower() for directive in ("no-cache", "no-store")
+    )
+    key = (view_of(status), limit, after)
+    cached, generation = (None, 0) if bypass else list_cache.get(key)
+    if cached is not None:
+        body, next_cursor = cached
+        cache_status = "HIT"
+    else:
+        todos, next_cursor = await run_db(_list_todos, status, limit, after)
+        body = _dump_todo_list(todos)
+        if not bypass:
+            list_cache.put(key, (body, next_cursor), generation)
+        cache_status = "BYPASS" if bypass else "MISS"
+    
+    headers = {"X-Cache": cache_status, **conditional_headers}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@router.get("/events")
+async def todo_events(
+    last_event_id: Optional[str] = Header(None, description="浏览器 EventSource 重连时自动携带"),
+    resume_from: Optional[str] = Query(None, alias="last_event_id", description="同 Last-Event-ID，供无法设置请求头的客户端使用")
+):
+    """
+    任务变更事件流 (Server-Sent Events)
+    
+    事件类型：created/updated (data 为任务)、deleted (data 为 {"ids": [...]})、
+    completed_cleared、cleared，以及连接控制用的 ready 和 reset。
+    携带 Last-Event-ID 重连时从该事件之后继续推送。
+    
+    Args:
+        last_event_id: 请求头 Last-Event-ID
+        resume_from: 查询参数 last_event_id
+    """
+    resume_id = last_event_id or resume_from
+    subscription = event_bus.subscribe(resume_id)
+    return StreamingResponse(
+        _event_stream(subscription, bool(resume_id)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.get("/changes", response_model=TodoChangesResponse)
+async def get_todo_changes(
+    since: int = Query(0, ge=0, description="上次同步响应中的 version，首次同步传 0"),
+    limit: int = Query(1000, ge=1, le=1000, description="每页最多返回的变更条数")
+):
+    """
+    增量同步：返回同步版本号 since 之后新增/修改 (upserts) 和删除 (deleted) 的任务
+    
+    客户端保存响应中的 version，下次作为 since 传入即可只拿到之后的变更；
+    has_more 为 true 时用新的 version 继续请求下一页。
+    reset 为 true 表示无法从 since 增量同步 (删除记录已过期或数据库已重建)，
+    此时返回全部任务，客户端应直接替换本地副本。
+    
+    Args:
+        since: 上次同步到的版本号
+        limit: 每页最多返回的变更条数
+    
+    Returns:
+        TodoChangesResponse: 变更列表和新的同步版本号
+    """
+    return await run_db(get_repository().changes, since, limit)
+
+@router.get("/stats", response_model=TodoStatsResponse)
+async def get_todo_stats(
+    if_none_match: Optional[str] = Header(None, description="上次响应的 ETag，数据未变化时返回 304")
+):
+    """
+    获取任务数量统计 (总数、未完成数、已完成数)
+    
+    计数由存储引擎维护 (SQLite 为触发器维护的 todo_stats 表)，不需要拉取全部任务再计数。
+    与列表接口一样带 ETag，数据未变化时条件请求返回 304。
+    
+    Args:
+        if_none_match: 请求头 If-None-Match
+    
+    Returns:
+        TodoStatsResponse: 任务数量统计
+    """
+    etag = table_version.etag("stats")
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    
+    stats = await run_db(get_repository().stats)
+    return Response(content=dumps(stats), media_type="application/json", headers=headers)
+
+@router.get("/search", response_model=List[TodoResponse])
+async def search_todos(
+    q: str = Query(..., min_length=1, max_length=255, description="搜索词，多个词用空格分隔，每个词都要出现在标题中"),
+    status: Optional[str] = Query(None, description="筛选条件: all, active, completed"),
+    limit: int = Query(20, ge=1, le=100, description="每页数量"),
+    offset: int = Query(0, ge=0, le=10000, description="跳过的条数，取上一页响应头 X-Next-Offset")
+):
+    """
+    按标题搜索任务
+    
+    每个词按子串匹配 (不区分大小写)，中文不需要分词。SQLite 存储使用 FTS5 全文索引，
+    结果按相关度排序；其他存储引擎逐条扫描，按创建时间倒序。
+    如果还有下一页，下一页的 offset 通过响应头 X-Next-Offset 返回。
+    
+    Args:
+        q: 搜索词
+        status: 筛选条件
+        limit: 每页数量
+        offset: 跳过的条数
+    
+    Returns:
+        List[TodoResponse]: 匹配的任务列表
+    """
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="搜索词不能为空")
+    
+    # 多取一条用于判断是否还有下一页
+    todos = await run_db(get_repository().search, q, status, limit + 1, offset)
+    headers = {}
+    if len(todos) > limit:
+        todos = todos[:limit]
+        headers["X-Next-Offset"] = str(offset + limit)
+    return Response(content=_dump_todo_list(todos), media_type="application/json", headers=headers)
 
 @router.post("/", response_model=TodoResponse)
 async def create_todo(todo: TodoCreate):
@@ -61,31 +333,55 @@ async def create_todo(todo: TodoCreate):
     Returns:
         TodoResponse: 创建的任务信息
     """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # 插入新任务
-        cursor.execute("""
-            INSERT INTO todos (title, completed, created_at, updated_at)
-            VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-        """, (todo.title, todo.completed))
-        
-        # 获取新插入的任务ID
-        todo_id = cursor.lastrowid
-        
-        # 查询新创建的任务
-        cursor.execute("SELECT * FROM todos WHERE id = ?", (todo_id,))
-        row = cursor.fetchone()
-        
-        conn.commit()
-        
-        return TodoResponse(
-            id=row["id"],
-            title=row["title"],
-            completed=bool(row["completed"]),
-            created_at=row["created_at"],
-            updated_at=row["updated_at"]
-        )
+    created = await run_db(get_repository().create, todo.title, todo.completed)
+    _record_change(views_for_states(bool(created["completed"])))
+    event_bus.publish("created", created)
+    return created
+
+@router.post("/batch", response_model=List[TodoResponse])
+async def create_todos_batch(todos: List[TodoCreate]):
+    """
+    批量创建任务 (单个事务)
+    
+    Args:
+        todos: 任务创建数据列表
+    
+    Returns:
+        List[TodoResponse]: 创建的任务信息，顺序与请求一致
+    """
+    _check_batch_size(len(todos))
+    created = await run_db(get_repository().create_many, [(todo.title, todo.completed) for todo in todos])
+    _record_change(views_for_states(*{bool(todo["completed"]) for todo in created}))
+    for todo in created:
+        event_bus.publish("created", todo)
+    return created
+
+@router.patch("/batch", response_model=List[TodoResponse])
+async def update_todos_batch(updates: List[TodoBatchUpdate]):
+    """
+    批量更新任务 (单个事务)，任一任务不存在时整体回滚
+    
+    Args:
+        updates: 更新数据列表，每项必须包含 id
+    
+    Returns:
+        List[TodoResponse]: 更新后的任务信息，顺序与请求一致
+    """
+    _check_batch_size(len(updates))
+    
+    for update in updates:
+        if update.title is None and update.completed is None:
+            raise HTTPException(status_code=400, detail=f"任务{update.id}没有提供要更新的字段")
+    
+    changes = [(update.id, update.title, update.completed) for update in updates]
+    try:
+        updated = await run_db(get_repository().update_many, changes)
+    except TodoNotFoundError as e:
+        raise HTTPException(status_code=404, detail=f"任务不存在: {e.ids}")
+    _record_change(_updated_views(updated, any(update.completed is not None for update in updates)))
+    for todo in updated:
+        event_bus.publish("updated", todo)
+    return updated
 
 @router.put("/{todo_id}", response_model=TodoResponse)
 async def update_todo(todo_id: int, todo_update: TodoUpdate):
@@ -99,50 +395,34 @@ async def update_todo(todo_id: int, todo_update: TodoUpdate):
     Returns:
         TodoResponse: 更新后的任务信息
     """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # 检查任务是否存在
-        cursor.execute("SELECT * FROM todos WHERE id = ?", (todo_id,))
-        existing_todo = cursor.fetchone()
-        
-        if not existing_todo:
-            raise HTTPException(status_code=404, detail="任务不存在")
-        
-        # 构建更新SQL
-        update_fields = []
-        update_values = []
-        
-        if todo_update.title is not None:
-            update_fields.append("title = ?")
-            update_values.append(todo_update.title)
-        
-        if todo_update.completed is not None:
-            update_fields.append("completed = ?")
-            update_values.append(todo_update.completed)
-        
-        if not update_fields:
-            raise HTTPException(status_code=400, detail="没有提供要更新的字段")
-        
-        update_fields.append("updated_at = CURRENT_TIMESTAMP")
-        update_values.append(todo_id)
-        
-        query = f"UPDATE todos SET {', '.join(update_fields)} WHERE id = ?"
-        cursor.execute(query, update_values)
-        
-        # 查询更新后的任务
-        cursor.execute("SELECT * FROM todos WHERE id = ?", (todo_id,))
-        row = cursor.fetchone()
-        
-        conn.commit()
-        
-        return TodoResponse(
-            id=row["id"],
-            title=row["title"],
-            completed=bool(row["completed"]),
-            created_at=row["created_at"],
-            updated_at=row["updated_at"]
-        )
+    if todo_update.title is None and todo_update.completed is None:
+        raise HTTPException(status_code=400, detail="没有提供要更新的字段")
+    
+    todo = await run_db(get_repository().update, todo_id, todo_update.title, todo_update.completed)
+    if todo is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    _record_change(_updated_views([todo], todo_update.completed is not None))
+    event_bus.publish("updated", todo)
+    return todo
+
+@router.delete("/batch", response_model=MessageResponse)
+async def delete_todos_batch(batch: TodoBatchDelete):
+    """
+    批量删除指定ID的任务 (单个事务)，不存在的ID会被忽略
+    
+    Args:
+        batch: 要删除的任务ID列表
+    
+    Returns:
+        MessageResponse: 删除结果消息
+    """
+    _check_batch_size(len(batch.ids))
+    deleted = await run_db(get_repository().delete_many, batch.ids)
+    if deleted:
+        _record_change()
+        # 只通知实际删除的任务，不存在的ID不产生事件
+        event_bus.publish("deleted", {"ids": deleted})
+    return MessageResponse(message=f"已删除{len(deleted)}个任务")
 
 @router.delete("/completed", response_model=MessageResponse)
 async def delete_completed_todos():
@@ -152,18 +432,11 @@ async def delete_completed_todos():
     Returns:
         MessageResponse: 删除结果消息
     """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # 查询已完成任务数量
-        cursor.execute("SELECT COUNT(*) FROM todos WHERE completed = TRUE")
-        count = cursor.fetchone()[0]
-        
-        # 删除已完成的任务
-        cursor.execute("DELETE FROM todos WHERE completed = TRUE")
-        conn.commit()
-        
-        return MessageResponse(message=f"已删除{count}个已完成任务")
+    count = await run_db(get_repository().delete_completed)
+    if count:
+        _record_change(views_for_states(True))
+        event_bus.publish("completed_cleared", {})
+    return MessageResponse(message=f"已删除{count}个已完成任务")
 
 @router.delete("/all", response_model=MessageResponse)
 async def delete_all_todos():
@@ -173,18 +446,11 @@ async def delete_all_todos():
     Returns:
         MessageResponse: 删除结果消息
     """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # 查询总任务数量
-        cursor.execute("SELECT COUNT(*) FROM todos")
-        count = cursor.fetchone()[0]
-        
-        # 删除所有任务
-        cursor.execute("DELETE FROM todos")
-        conn.commit()
-        
-        return MessageResponse(message=f"已清空{count}个任务")
+    count = await run_db(get_repository().delete_all)
+    if count:
+        _record_change()
+        event_bus.publish("cleared", {})
+    return MessageResponse(message=f"已清空{count}个任务")
 
 @router.delete("/{todo_id}", response_model=MessageResponse)
 async def delete_todo(todo_id: int):
@@ -197,19 +463,9 @@ async def delete_todo(todo_id: int):
     Returns:
         MessageResponse: 删除结果消息
     """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # 检查任务是否存在
-        cursor.execute("SELECT * FROM todos WHERE id = ?", (todo_id,))
-        existing_todo = cursor.fetchone()
-        
-        if not existing_todo:
-            raise HTTPException(status_code=404, detail="任务不存在")
-        
-        # 删除任务
-        cursor.execute("DELETE FROM todos WHERE id = ?", (todo_id,))
-        conn.commit()
-        
-        return MessageResponse(message="任务删除成功")
-
+    if not await run_db(get_repository().delete, todo_id):
+        raise HTTPException(status_code=404, detail="任务不存在")
+    # 不知道被删任务的状态，三个视图都失效
+    _record_change()
+    event_bus.publish("deleted", {"ids": [todo_id]})
+    return MessageResponse(message="任务删除成功")
@@ -0,0 +1,107 @@
+"""
+数据库索引管理模块
+
+索引按请求路径上的实际查询形状定义 (SqliteTodoRepository.STATEMENTS)：
+- 列表 ORDER BY created_at DESC, id DESC，按状态筛选时再加 completed = ?
+- 增量同步按 version 范围查询
+
+索引列的顺序和方向与 ORDER BY 完全一致，查询沿索引顺序读取即可，不需要临时 B-tree 排序。
+check_query_plans 用 EXPLAIN QUERY PLAN 检查这一点。
+"""
+import asyncio
+import os
+import re
+import sqlite3
+import time
+from typing import Dict, List
+
+# 定期执行 PRAGMA optimize 的间隔 (秒)，0 表示只在启动时执行
+DB_OPTIMIZE_INTERVAL = float(os.environ.get("DB_OPTIMIZE_INTERVAL", "3600"))
+
+# ANALYZE 时每个索引最多抽样的行数，大表上不做全量扫描
+DB_ANALYSIS_LIMIT = int(os.environ.get("DB_ANALYSIS_LIMIT", "1000"))
+
+INDEXES = {
+    # 全部任务列表和键集分页
+    "idx_todos_created_at_id": "ON todos(created_at DESC, id DESC)",
+    # 按状态筛选的列表：等值条件在前，排序列在后，active 和 completed 共用
+    "idx_todos_completed_created_at": "ON todos(completed, created_at DESC, id DESC)",
+    # 增量同步按版本号范围查询
+    "idx_todos_version": "ON todos(version)",
+    "idx_todo_tombstones_version": "ON todo_tombstones(version)",
+}
+
+# 已被上面的复合索引取代 (分别是它们的前缀)，保留只会增加写入开销
+OBSOLETE_INDEXES = ["idx_todos_completed", "idx_todos_created_at"]
+
+# 允许使用临时 B-tree 排序的语句及原因
+SORT_ALLOWED = {
+    "search_fts": "按 bm25 相关度排序，只能对命中的行打分后排序",
+}
+
+def ensure_indexes(cursor: sqlite3.Cursor):
+    """创建 INDEXES 中的索引，删除已被取代的旧索引"""
+    for name, definition in INDEXES.items():
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} {definition}")
+    for name in OBSOLETE_INDEXES:
+        cursor.execute(f"DROP INDEX IF EXISTS {name}")
+
+def optimize(conn: sqlite3.Connection) -> float:
+    """
+    更新查询规划器的统计信息，返回耗时 (秒)
+
+    从未 ANALYZE 过的库先执行一次 ANALYZE；之后交给 PRAGMA optimize，
+    它只重新分析行数变化较大的表，平时几乎不花时间。
+    analysis_limit 限制每个索引的抽样行数，大表上也能很快完成。
+    """
+    started = time.perf_counter()
+    conn.execute(f"PRAGMA analysis_limit = {DB_ANALYSIS_LIMIT}")
+    analyzed = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone()
+    if analyzed is None:
+        conn.execute("ANALYZE")
+    else:
+        conn.execute("PRAGMA optimize")
+    conn.commit()
+    return time.perf_counter() - started
+
+async def run_optimizer(interval: float = DB_OPTIMIZE_INTERVAL):
+    """后台任务：每隔 interval 秒在数据库线程池中执行一次 optimize"""
+    from database import get_db_connection, run_db
+
+    def optimize_once():
+        with get_db_connection() as conn:
+            return optimize(conn)
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_db(optimize_once)
+        except sqlite3.Error as e:
+            print(f"更新统计信息失败: {e}")
+
+def _null_params(sql: str):
+    """生成与语句占位符数量一致的 NULL 参数，只用于 EXPLAIN"""
+    names = re.findall(r":(\w+)", sql)
+    if names:
+        return dict.fromkeys(names)
+    return [None] * sql.count("?")
+
+def query_plan(conn: sqlite3.Connection, sql: str) -> List[str]:
+    """返回 EXPLAIN QUERY PLAN 的每一步说明"""
+    rows = conn.execute("EXPLAIN QUERY PLAN " + sql, _null_params(sql)).fetchall()
+    return [row[3] for row in rows]
+
+def check_query_plans(conn: sqlite3.Connection, statements: Dict[str, str]) -> Dict[str, List[str]]:
+    """
+    检查语句的执行计划，返回使用了临时 B-tree (排序、去重或分组) 的语句及其计划
+
+    SORT_ALLOWED 中的语句不检查。
+    """
+    problems = {}
+    for name, sql in statements.items():
+        if name in SORT_ALLOWED:
+            continue
+        plan = query_plan(conn, sql)
+        if any("USE TEMP B-TREE" in step for step in plan):
+            problems[name] = plan
+    return problems
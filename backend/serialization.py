@@ -0,0 +1,24 @@
+"""
+任务列表 JSON 序列化模块
+"""
+import json
+import os
+
+try:
+    import orjson
+except ImportError:  # orjson 是可选依赖，未安装时退回标准库 json
+    orjson = None
+
+# 设为 1 时列表接口跳过 Pydantic，直接编码存储层返回的字典 (输出字节不变)
+FAST_JSON = os.environ.get("FAST_JSON", "").lower() in ("1", "true", "yes")
+
+def dumps(value) -> bytes:
+    """
+    编码为紧凑的 UTF-8 JSON
+
+    格式与 Pydantic 的 dump_json 一致 (无空格、非 ASCII 字符不转义)，
+    两条路径生成的响应逐字节相同，ETag 和缓存不受开关影响。
+    """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
@@ -1,13 +1,26 @@
 """
-简单的API测试脚本
+Todo API 测试 (pytest)
+
+pytest 用例在进程内通过 TestClient 访问应用，数据库为临时文件，不需要启动服务器：
+游标分页、ETag/304、增量同步、全文搜索、批量操作回滚、SSE 事件流、慢查询日志、
+按需剖析、/metrics 和就绪检查，以及所有注册语句的执行计划检查。
+存储层的微基准在 test_benchmark.py 中。
+
+直接运行 python test_api.py 时检查执行计划，并对 localhost:8000 上运行中的服务做冒烟测试。
 """
+import asyncio
+import os
+import tempfile
+
+import pytest
 import requests
 import json
 
 BASE_URL = "http://localhost:8000/api/v1"
+TODOS = "/api/v1/todos"
 
-def test_api():
-    """测试API基本功能"""
+def check_live_api():
+    """对运行中的服务做冒烟测试 (需要先启动服务器，不由 pytest 收集)"""
     print("🧪 开始测试 Todo API...")
     
     try:
@@ -15,6 +28,10 @@ def test_api():
         response = requests.get("http://localhost:8000/health")
         print(f"✅ 健康检查: {response.status_code}")
         
+        # 测试就绪检查 (实际访问存储)
+        response = requests.get("http://localhost:8000/health/ready")
+        print(f"✅ 就绪检查: {response.status_code} {response.json().get('latency_ms')}ms")
+        
         # 测试获取任务列表
         response = requests.get(f"{BASE_URL}/todos")
         print(f"✅ 获取任务列表: {response.status_code}")
@@ -34,6 +51,10 @@ def test_api():
             response = requests.put(f"{BASE_URL}/todos/{todo_id}", json=update_data)
             print(f"✅ 更新任务: {response.status_code}")
             
+            # 测试搜索任务
+            response = requests.get(f"{BASE_URL}/todos/search", params={"q": "测试任务"})
+            print(f"✅ 搜索任务: {response.status_code}, 命中 {len(response.json())} 条")
+            
             # 测试删除任务
             response = requests.delete(f"{BASE_URL}/todos/{todo_id}")
             print(f"✅ 删除任务: {response.status_code}")
@@ -45,6 +66,273 @@ def test_api():
     except Exception as e:
         print(f"❌ 测试过程中出现错误: {e}")
 
+def check_query_plans():
+    """
+    离线检查 (不需要启动服务器)：所有注册的 SQL 语句都不使用临时 B-tree 排序
+    
+    在临时数据库上建表建索引，对 SqliteTodoRepository 的每条语句执行 EXPLAIN QUERY PLAN。
+    """
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "plans.db")
+    from database import get_db_connection, init_database, statements
+    from repository import SqliteTodoRepository
+    from schema import check_query_plans as find_sorts
+    
+    init_database()
+    SqliteTodoRepository()  # 注册所有语句
+    with get_db_connection() as conn:
+        problems = find_sorts(conn, statements.registered())
+    
+    for name, plan in problems.items():
+        print(f"❌ {name} 使用了临时 B-tree: {' | '.join(plan)}")
+    if not problems:
+        print(f"✅ 执行计划检查: {len(statements.registered())} 条语句都不需要临时排序")
+    return not problems
+
+@pytest.fixture(scope="module")
+def client():
+    """进程内测试客户端 (不需要启动服务器)，使用临时数据库"""
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "test.db")
+    from fastapi.testclient import TestClient
+    from main import app
+    
+    # 进入上下文才会触发 startup 建表
+    with TestClient(app) as client:
+        yield client
+
+@pytest.fixture
+def api(client):
+    """每个测试从空表开始"""
+    client.delete(f"{TODOS}/all")
+    return client
+
+def _create(api, *titles, completed=False):
+    response = api.post(f"{TODOS}/batch", json=[{"title": t, "completed": completed} for t in titles])
+    assert response.status_code == 200
+    return [todo["id"] for todo in response.json()]
+
+def _parse_events(text):
+    """把 SSE 文本解析成 [(event, data)]"""
+    events = []
+    for block in text.split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line and not line.startswith(":"))
+        if "event" in fields:
+            events.append((fields["event"], json.loads(fields.get("data", "{}"))))
+    return events
+
+def test_query_plans():
+    assert check_query_plans()
+
+def test_cursor_pagination(api):
+    ids = _create(api, *[f"分页{i}" for i in range(7)])
+    
+    seen, pages, cursor = [], [], None
+    while True:
+        params = {"limit": 3, **({"cursor": cursor} if cursor else {})}
+        response = api.get(f"{TODOS}/", params=params)
+        assert response.status_code == 200
+        pages.append(len(response.json()))
+        seen += [todo["id"] for todo in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    
+    # 同一秒创建时按 id 倒序，翻页不重不漏
+    assert pages == [3, 3, 1]
+    assert seen == sorted(ids, reverse=True)
+    assert api.get(f"{TODOS}/", params={"limit": 3, "cursor": "不是游标"}).status_code == 400
+
+def test_list_etag(api):
+    todo_id = _create(api, "缓存")[0]
+    
+    first = api.get(f"{TODOS}/")
+    etag = first.headers["ETag"]
+    cached = api.get(f"{TODOS}/", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.content == b""
+    
+    # 没有删除任何任务时不改变 ETag
+    api.request("DELETE", f"{TODOS}/batch", json={"ids": [todo_id + 1000]})
+    assert api.get(f"{TODOS}/", headers={"If-None-Match": etag}).status_code == 304
+    
+    api.put(f"{TODOS}/{todo_id}", json={"title": "已修改"})
+    changed = api.get(f"{TODOS}/", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert changed.json()[0]["title"] == "已修改"
+
+def test_changes_tombstones(api):
+    base = api.get(f"{TODOS}/changes").json()["version"]
+    keep, updated, removed = _create(api, "保留", "修改", "删除")
+    api.put(f"{TODOS}/{updated}", json={"completed": True})
+    api.delete(f"{TODOS}/{removed}")
+    
+    changes = api.get(f"{TODOS}/changes", params={"since": base}).json()
+    assert changes["reset"] is False and changes["has_more"] is False
+    assert sorted(todo["id"] for todo in changes["upserts"]) == [keep, updated]
+    assert changes["deleted"] == [removed]
+    
+    # 分页：has_more 为真时用返回的 version 继续
+    page = api.get(f"{TODOS}/changes", params={"since": base, "limit": 1}).json()
+    assert page["has_more"] is True
+    assert len(page["upserts"]) + len(page["deleted"]) == 1
+    
+    version = changes["version"]
+    api.delete(f"{TODOS}/completed")
+    after = api.get(f"{TODOS}/changes", params={"since": version}).json()
+    assert after["upserts"] == [] and after["deleted"] == [updated]
+    
+    assert api.get(f"{TODOS}/changes", params={"since": 10 ** 9}).json()["reset"] is True
+    assert api.get(f"{TODOS}/changes", params={"since": -1}).status_code == 422
+
+def test_search(api):
+    milk, report, _ = _create(api, "买牛奶和面包 bread", "写周报", "buy milk")
+    
+    def search(**params):
+        response = api.get(f"{TODOS}/search", params=params)
+        assert response.status_code == 200
+        return [todo["id"] for todo in response.json()], response.headers.get("X-Next-Offset")
+    
+    assert search(q="牛奶")[0] == [milk]
+    assert search(q="bread 牛奶")[0] == [milk]
+    assert search(q="周报")[0] == [report]
+    assert search(q="牛奶", status="completed")[0] == []
+    
+    # 非 ASCII 字母同样不区分大小写 (短词走 instr 过滤，长词走全文索引)
+    apple, hello = _create(api, "ÄPFEL kaufen", "Привет мир")
+    for q in ("äp", "ÄP", "äpfel"):
+        assert search(q=q)[0] == [apple]
+    for q in ("пр", "ПРИВЕТ", "мир"):
+        assert search(q=q)[0] == [hello]
+    
+    first, next_offset = search(q="b", limit=1)
+    assert len(first) == 1 and next_offset == "1"
+    rest, next_offset = search(q="b", limit=1, offset=1)
+    assert len(rest) == 1 and rest != first and next_offset is None
+    assert api.get(f"{TODOS}/search", params={"q": "  "}).status_code == 400
+
+def test_batch_update_rollback(api):
+    first, second = _create(api, "第一", "第二")
+    
+    response = api.patch(f"{TODOS}/batch", json=[
+        {"id": first, "title": "不应保存"},
+        {"id": second + 1000, "completed": True},
+    ])
+    assert response.status_code == 404
+    assert {todo["title"] for todo in api.get(f"{TODOS}/").json()} == {"第一", "第二"}
+    
+    assert api.patch(f"{TODOS}/batch", json=[]).status_code == 400
+    response = api.patch(f"{TODOS}/batch", json=[{"id": first, "completed": True}])
+    assert response.status_code == 200 and response.json()[0]["completed"] is True
+
+def test_batch_delete_missing_ids(api):
+    first, second = _create(api, "第一", "第二")
+    
+    response = api.request("DELETE", f"{TODOS}/batch", json={"ids": [first, second + 1000, first]})
+    assert response.status_code == 200
+    assert response.json()["message"] == "已删除1个任务"
+    assert [todo["id"] for todo in api.get(f"{TODOS}/").json()] == [second]
+
+def test_events_stream(api):
+    from events import event_bus
+    from routers.todos import _event_stream
+    
+    # 先订阅再写入，写入时订阅还没有等待者，事件只是进入队列
+    subscription = event_bus.subscribe()
+    resume_from = event_bus.last_event_id
+    first, second = _create(api, "事件一", "事件二")
+    api.request("DELETE", f"{TODOS}/batch", json={"ids": [first, second + 1000]})
+    
+    async def read(subscription, resumed, count):
+        stream = _event_stream(subscription, resumed)
+        try:
+            return [await stream.__anext__() for _ in range(count)]
+        finally:
+            await stream.aclose()
+    
+    ready, batch = asyncio.run(read(subscription, False, 2))
+    assert _parse_events(ready) == [("ready", {})]
+    events = _parse_events(batch)
+    assert [event for event, _ in events] == ["created", "created", "deleted"]
+    assert [data["id"] for _, data in events[:2]] == [first, second]
+    assert events[2][1] == {"ids": [first]}
+    
+    # 用 Last-Event-ID 续传时补发之后的全部事件
+    ready, replay = asyncio.run(read(event_bus.subscribe(resume_from), True, 2))
+    assert _parse_events(replay) == events
+    
+    # 无法续传的 ID 直接收到 reset，连接结束
+    response = api.get(f"{TODOS}/events", headers={"Last-Event-ID": "unknown-1"})
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert _parse_events(response.text) == [("reset", {})]
+
+def test_query_log_explains_single_row_statements(api, monkeypatch):
+    from querylog import query_log
+    
+    # 所有语句都算慢查询，每次都获取执行计划
+    monkeypatch.setattr(query_log, "slow_ms", 0)
+    monkeypatch.setattr(query_log, "explain_interval", 0)
+    query_log.clear()
+    todo_id = _create(api, "慢查询")[0]
+    api.put(f"{TODOS}/{todo_id}", json={"completed": True})
+    api.get(f"{TODOS}/stats")
+    api.delete(f"{TODOS}/{todo_id}")
+    
+    plans = {entry["sql"]: entry["plan"] for entry in query_log.report()["slow"]}
+    for sql in ("UPDATE todos", "FROM todo_stats", "DELETE FROM todos WHERE id"):
+        matched = [plan for statement, plan in plans.items() if sql in statement]
+        assert matched and all(plan is not None for plan in matched), sql
+    query_log.clear()
+
+def test_profiling_releases_slot_for_long_responses(monkeypatch):
+    import profiling
+    
+    monkeypatch.setattr(profiling, "PROFILE_MAX_SECONDS", 0.05)
+    registry = profiling.Profiler()
+    registry.arm("/events", 1)
+    
+    async def stream(scope, receive, send):
+        # 模拟事件流：响应开始后长时间不结束
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await asyncio.sleep(0.3)
+        await send({"type": "http.response.body", "body": b""})
+    
+    async def send(message):
+        pass
+    
+    async def run():
+        middleware = profiling.ProfilingMiddleware(stream, "secret", registry)
+        scope = {"type": "http", "method": "GET", "path": "/events", "headers": []}
+        request = asyncio.create_task(middleware(scope, None, send))
+        await asyncio.sleep(0.15)
+        # 响应还没结束，剖析已经到时结束，其他请求可以剖析
+        assert not request.done()
+        session, skipped = registry.begin("sample", "GET", "/other")
+        assert skipped is None
+        registry.finish(session, 200)
+        await request
+    
+    asyncio.run(run())
+    profiles = registry.list()
+    assert [(p["path"], p["status"]) for p in profiles] == [("/other", 200), ("/events", 200)]
+    assert profiles[1]["duration_ms"] < 300
+
+def test_metrics(api):
+    api.get(f"{TODOS}/")
+    response = api.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'todo_http_requests_total{method="GET",route="/api/v1/todos/",status="200"}' in response.text
+    assert "todo_db_pool_size" in response.text
+
+def test_readiness(api):
+    response = api.get("/health/ready")
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "no-store"
+    result = response.json()
+    assert result["status"] == "ready"
+    assert "query_ms" in result["storage"]
+
 if __name__ == "__main__":
-    test_api()
+    check_query_plans()
+    check_live_api()
 
@@ -0,0 +1,78 @@
+"""
+存储层和序列化的微基准 (pytest-benchmark)
+
+测量的调用与 benchmark.py suite 的 micro 部分相同：路由处理函数背后的存储层操作和列表序列化。
+数据用同样的随机种子预置在临时数据库中，行数由环境变量 BENCHMARK_ROWS 指定 (默认 10000)。
+
+    pytest test_benchmark.py --benchmark-autosave     # 运行并把结果保存到 .benchmarks/
+    pytest test_benchmark.py --benchmark-compare --benchmark-compare-fail=median:20%
+                                                      # 与上次保存的结果对比，中位数退化超过 20% 时失败
+    pytest --benchmark-skip                           # 只运行功能测试
+
+同一台机器、同样的行数下得到的结果才有可比性。
+"""
+import os
+import random
+import tempfile
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+BENCHMARK_ROWS = int(os.environ.get("BENCHMARK_ROWS", "10000"))
+BENCHMARK_SEED = 42
+
+@pytest.fixture(scope="module")
+def repo():
+    """预置 BENCHMARK_ROWS 条任务的默认存储"""
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+    from benchmark import seed_dataset
+    from database import init_database
+    from repository import get_repository
+
+    init_database()
+    repo = get_repository()
+    repo.delete_all()
+    seed_dataset(BENCHMARK_ROWS, random.Random(BENCHMARK_SEED))
+    yield repo
+    repo.delete_all()
+
+@pytest.mark.parametrize("status", [None, "active", "completed"])
+def test_list_page(benchmark, repo, status):
+    assert len(benchmark(repo.list, status, 50)) == 50
+
+def test_list_page_after(benchmark, repo):
+    page = repo.list(None, 50)
+    after = (page[-1]["created_at"], page[-1]["id"])
+    assert len(benchmark(repo.list, None, 50, after)) == 50
+
+def test_stats(benchmark, repo):
+    assert benchmark(repo.stats)["total"] >= BENCHMARK_ROWS
+
+def test_search_rare(benchmark, repo):
+    benchmark(repo.search, "年度总结", limit=20)
+
+def test_search_common(benchmark, repo):
+    assert benchmark(repo.search, "数学作业", limit=20)
+
+def test_changes(benchmark, repo):
+    # 无法增量同步时返回的是当前版本号，取最后 100 次写入之后的变更
+    since = repo.changes(10 ** 9)["version"] - 100
+    assert len(benchmark(repo.changes, since, 100)["upserts"]) == 100
+
+def test_serialize_page(benchmark, repo):
+    from routers.todos import _dump_todo_list
+
+    page = repo.list(None, 50)
+    assert benchmark(_dump_todo_list, page)
+
+def test_create(benchmark, repo):
+    benchmark(repo.create, "微基准任务")
+
+def test_update(benchmark, repo):
+    todo_id = repo.list(None, 1)[0]["id"]
+    assert benchmark(repo.update, todo_id, completed=True)
+
+def test_delete(benchmark, repo):
+    # 每轮删除一条新建的任务
+    benchmark.pedantic(repo.delete, setup=lambda: ((repo.create("待删除")["id"],), {}), rounds=200)